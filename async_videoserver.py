@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# Asyncio version of flask_videoserver.py for many concurrent viewers.
+#
+# The Flask server pins one thread per viewer for the lifetime of the stream.
+# This server runs every connection as a coroutine on one event loop, with one
+# helper thread per active camera to bridge the camera thread into the loop.
+# It takes the same command line arguments and serves the same routes:
+#   /                        the index page
+#   /video_feed              the --input source
+#   /video_feed/<stream_id>  the sources added with --stream
+#   ?size=half&fps=5         a smaller or slower rendition of a stream
+#   /metadata[/<stream_id>]  the detections and tracks, ?format=sse (default) or jsonl
+#   /ready, /metrics, /metrics.json, /load
+#
+# Usage:
+# python async_videoserver.py -m yoloOD --stream gate=0 --stream yard=./videos/Gantry4.mp4
+# python async_videoserver.py -m yoloOD --sendBuffer 1048576
+
+import asyncio
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from flask import render_template
+
+import flask_videoserver as server
+from base_camera import RENDITION_FPS, RENDITION_SIZES, rendition_key
+
+BOUNDARY_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                   b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                   b'Cache-Control: no-cache\r\n'
+                   b'Connection: close\r\n\r\n')
+METADATA_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                   b'Content-Type: %s\r\n'
+                   b'Cache-Control: no-cache\r\n'
+                   b'Connection: close\r\n\r\n')
+
+
+class StreamRelay(object):
+    """
+    Forwards the frames of one rendition of a camera, or its metadata, to all its
+    viewers on the event loop.
+
+    A single executor thread waits on the camera for all the viewers, and the
+    viewers wait on an asyncio condition, so the number of threads does not
+    grow with the number of viewers. The relay stops when its last viewer leaves
+    so that the camera can stop after its inactivity timeout.
+
+    `wait(generation)` is the camera method that waits for the next (generation,
+    frame, part), e.g. `camera.wait_frame` or `camera.wait_metadata`.
+    """
+    def __init__(self, camera, executor, wait):
+        self.camera = camera
+        self.executor = executor
+        self.wait = wait
+        self.generation = 0
+        self.part = None
+        self.stopped = False
+        self.viewers = 0
+        self.condition = asyncio.Condition()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        generation = 0
+        while self.viewers > 0:
+            generation, frame, part = await loop.run_in_executor(self.executor, self.wait, generation)
+            async with self.condition:
+                self.generation = generation
+                self.part = part
+                self.stopped = frame is None
+                self.condition.notify_all()
+            if self.stopped:
+                break
+
+    async def next_part(self, generation):
+        """Wait for a part newer than `generation`, returns (generation, part) with part None once stopped."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.generation != generation or self.stopped)
+            return self.generation, None if self.stopped else self.part
+
+
+class AsyncVideoServer(object):
+    """
+    Minimal HTTP/1.1 server for the index page and the MJPEG streams.
+
+    Attributes:
+    -----------
+    send_buffer: int
+        The maximum number of bytes queued on one connection. A viewer whose
+        buffer is full is not sent the frames produced meanwhile, it gets the
+        newest frame once the buffer has drained.
+    """
+    def __init__(self, send_buffer=512 * 1024, max_cameras=32):
+        self.send_buffer = send_buffer
+        # One waiting thread per rendition and for the metadata of each camera, the threads
+        # are only started when needed
+        n_renditions = len(RENDITION_SIZES) * (len(RENDITION_FPS) + 1) + 1
+        self.executor = ThreadPoolExecutor(max_workers=max_cameras * n_renditions + 4)
+        self.relays = {}  # (camera key, rendition or 'metadata') -> StreamRelay
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        try:
+            method, path, _ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        except ValueError:
+            await self.respond(writer, 400, b'Bad Request')
+            return
+        path, _, query = path.partition('?')
+        path = path.rstrip('/') or '/'
+        query = {name: values[-1] for name, values in parse_qs(query).items()}
+
+        if method != 'GET':
+            await self.respond(writer, 405, b'Method Not Allowed')
+        elif path == '/':
+            with server.app.test_request_context('/'):
+                page = render_template('index.html', streams=sorted(server.streams)).encode()
+            await self.respond(writer, 200, page, b'text/html; charset=utf-8')
+        elif path == '/ready':
+            status, body = server.readiness_status()
+            await self.respond(writer, status, body.encode())
+        elif path in ('/metrics', '/metrics.json') and server.metrics_registry.enabled:
+            if path == '/metrics':
+                await self.respond(writer, 200, server.metrics_registry.prometheus().encode(),
+                                   b'text/plain; version=0.0.4')
+            else:
+                await self.respond(writer, 200, json.dumps(server.metrics_registry.snapshot()).encode(),
+                                   b'application/json')
+        elif path == '/load' and server.BaseCamera.governor is not None:
+            await self.respond(writer, 200, json.dumps(server.BaseCamera.governor.snapshot()).encode(),
+                               b'application/json')
+        elif path == '/video_feed' or path.startswith('/video_feed/'):
+            try:
+                rendition = rendition_key(query.get('size'), query.get('fps'))
+            except ValueError as e:
+                await self.respond(writer, 400, str(e).encode())
+                return
+            await self.stream(writer, path[len('/video_feed/'):] or None, rendition)
+        elif path == '/metadata' or path.startswith('/metadata/'):
+            try:
+                mimetype = server.metadata_mimetype(query.get('format', 'sse'))
+            except ValueError as e:
+                await self.respond(writer, 400, str(e).encode())
+                return
+            await self.stream(writer, path[len('/metadata/'):] or None, 'metadata', mimetype)
+        else:
+            await self.respond(writer, 404, b'Not Found')
+
+    async def respond(self, writer, status, body, content_type=b'text/plain', retry_after=None):
+        reason = {200: b'OK', 400: b'Bad Request', 404: b'Not Found', 405: b'Method Not Allowed',
+                  500: b'Internal Server Error', 503: b'Service Unavailable'}[status]
+        headers = b'Retry-After: %d\r\n' % retry_after if retry_after is not None else b''
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%sConnection: close\r\n\r\n'
+                     % (status, reason, content_type, len(body), headers) + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def stream(self, writer, stream_id, rendition=('full', None), mimetype=None):
+        """Stream a rendition of the video, or the metadata as `mimetype` when the rendition is 'metadata'."""
+        loop = asyncio.get_running_loop()
+        # Looking the camera up may start it and wait for its first frame, or for its admission
+        try:
+            camera = await loop.run_in_executor(self.executor, server.get_camera, stream_id)
+        except server.AdmissionError as e:
+            await self.respond(writer, 503, str(e).encode(), retry_after=server.RETRY_AFTER)
+            return
+        if camera is None:
+            await self.respond(writer, 404, b'Not Found')
+            return
+
+        key = (camera.key, rendition)
+        relay = self.relays.get(key)
+        if relay is None or relay.camera is not camera or relay.stopped:
+            if rendition == 'metadata':
+                relay = StreamRelay(camera, self.executor, camera.wait_metadata)
+            else:
+                relay = StreamRelay(camera, self.executor, functools.partial(camera.wait_frame, rendition=rendition))
+            self.relays[key] = relay
+        relay.viewers += 1
+        if relay.viewers == 1:
+            loop.create_task(relay.run())
+
+        writer.transport.set_write_buffer_limits(high=self.send_buffer)
+        sse = mimetype == 'text/event-stream'
+        try:
+            writer.write(BOUNDARY_HEADER if mimetype is None else METADATA_HEADER % mimetype.encode())
+            generation = 0
+            while True:
+                generation, part = await relay.next_part(generation)
+                if part is None:
+                    break
+                if mimetype is not None:
+                    part = b'data: ' + part + b'\n\n' if sse else part + b'\n'
+                writer.write(part)
+                # Waits while the buffer is above the limit, the frames produced
+                # meanwhile are skipped by taking the newest generation next
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            relay.viewers -= 1
+            if relay.viewers == 0 and self.relays.get(key) is relay:
+                del self.relays[key]
+            writer.close()
+
+    async def serve(self, host, port):
+        listener = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://{}:{}'.format(host, port))
+        async with listener:
+            await listener.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = server.build_parser()
+    parser.add_argument('--sendBuffer', type=int, default=512 * 1024, help='Maximum bytes queued per viewer \
+                                                before frames are skipped for it')
+    args = parser.parse_args()
+    server.configure(parser, args)
+
+    try:
+        asyncio.run(AsyncVideoServer(args.sendBuffer, max_cameras=1 + len(server.streams)).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
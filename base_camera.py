@@ -1,105 +1,342 @@
+import json
 import time
 import threading
-# from queue import Queue
-try:
-    from greenlet import getcurrent as get_ident
-except ImportError:
-    try:
-        from thread import get_ident
-    except ImportError:
-        from _thread import get_ident
+
+import cv2
+
+from modules.inference.metrics import NULL_METRICS
+
+# The frame sizes and frame rate caps a viewer can ask for, see `Rendition`
+RENDITION_SIZES = {'full': 1.0, 'half': 0.5, 'quarter': 0.25}
+RENDITION_FPS = (1, 5, 10)
+
+
+def mjpeg_part(frame):
+    """Wrap a JPEG frame into one part of a multipart MJPEG stream."""
+    return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n'
 
 
 class CameraEvent(object):
     """An Event-like class that signals all active clients when a new frame is
     available.
+
+    The camera thread bumps a generation counter under a single condition
+    variable, so there is no per-client state to update or clean up. Each client
+    remembers the last generation it has seen: a slow client that comes back
+    gets the newest frame straight away and skips the ones in between, and a
+    client that goes away simply stops waiting. `waiters` counts the clients
+    waiting right now, which are still there however long the next frame takes.
     """
     def __init__(self):
-        self.events = {}
-
-    def wait(self):
-        """Invoked from each client's thread to wait for the next frame."""
-        ident = get_ident()
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.frame = None
+        self.part = None
+        self.waiters = 0
+
+    def wait(self, generation, timeout=None):
+        """Invoked from each client's thread to wait for a frame newer than
+        `generation`. Returns the newest (generation, frame, part).
+        """
+        with self.condition:
+            self.waiters += 1
+            try:
+                self.condition.wait_for(lambda: self.generation != generation, timeout)
+            finally:
+                self.waiters -= 1
+            return self.generation, self.frame, self.part
+
+    def set(self, frame, part=None):
         """Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident
-        if remove:
-            del self.events[remove]
-
-    def clear(self):
-        """Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+        with self.condition:
+            self.frame = frame
+            self.part = part
+            self.generation += 1
+            self.condition.notify_all()
+
+
+def rendition_key(size=None, fps=None):
+    """Return the (size, max_fps) rendition for the `size` and `fps` query parameters.
+
+    `fps` is rounded down to one of `RENDITION_FPS`, so that the viewers share a
+    few renditions, and no `fps` means every frame. Raises ValueError for an
+    unknown size or an invalid fps.
+    """
+    size = size or 'full'
+    if size not in RENDITION_SIZES:
+        raise ValueError('Unknown size {}, use one of {}'.format(size, ', '.join(RENDITION_SIZES)))
+    if fps is None or fps == '':
+        return size, None
+    fps = float(fps)
+    if not fps > 0:
+        raise ValueError('fps must be positive')
+    if fps > RENDITION_FPS[-1]:
+        return size, None
+    return size, max([cap for cap in RENDITION_FPS if cap <= fps] or [RENDITION_FPS[0]])
+
+
+class Rendition(object):
+    """
+    One encoding of the frames of a camera, shared by every viewer that asks for it.
+
+    The camera only encodes a rendition while it has viewers, i.e. while a
+    viewer is waiting for its next frame or has asked for one within
+    `idle_timeout` seconds (e.g. it is still sending the last one), and at
+    most `max_fps` times per second.
+    """
+    idle_timeout = 1.0
+
+    def __init__(self, size='full', max_fps=None, quality=80):
+        self.size = size
+        self.scale = RENDITION_SIZES[size]
+        self.max_fps = max_fps
+        self.quality = quality
+        self.event = CameraEvent()
+        self.last_access = 0
+        self.next_encode = 0
+        self.n_encoded = 0
+
+    def has_viewers(self, now):
+        return self.event.waiters > 0 or now - self.last_access <= self.idle_timeout
+
+    def is_wanted(self, now):
+        """Whether the rendition has viewers and its next frame is due under the fps cap."""
+        if not self.has_viewers(now):
+            return False
+        return self.max_fps is None or now >= self.next_encode
+
+    def encode(self, frame, now, jpeg=None):
+        """Encode a frame and hand it to the viewers. `jpeg` is the full size frame
+        at this quality, when it was already encoded.
+        """
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            jpeg = None
+        if jpeg is None:
+            _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            jpeg = jpeg.tobytes()
+        if self.max_fps is not None:
+            self.next_encode = max(self.next_encode + 1.0 / self.max_fps, now)
+        self.n_encoded += 1
+        self.event.set(jpeg, mjpeg_part(jpeg))
 
 
 class BaseCamera(object):
-    thread = None  # background thread that reads frames from camera
-    frame = None  # current frame is stored here by background thread
-    last_access = 0  # time of last client access to the camera
-    event = CameraEvent()
+    """A camera that produces frames on a background thread for its clients.
+
+    The cameras are kept in a registry by key, so the clients asking for the
+    same stream share one camera, and each camera owns its own capture thread,
+    frame slot, renditions and inactivity timer.
+
+    `frames` yields (frame, jpeg, metadata): the frame to show and, if it was
+    already encoded at full size and `jpeg_quality` (e.g. for a recording),
+    its JPEG. Each frame is only encoded for the renditions that have viewers.
+    The frame may be None when no one watches the video, see `video_wanted`.
+    The metadata, a dict of the detections and tracks of the frame, is sent to
+    the metadata subscribers as one JSON line, see `wait_metadata`.
+
+    With a `governor`, a new camera is only started once the governor admits
+    it, and it charges its `budget` with the CPU time of its frames.
+    """
+    cameras = {}  # running cameras by key
+    lock = threading.Lock()  # protects the registry
+    jpeg_quality = 80
+    governor = None  # a `ResourceGovernor`, see governor.py
 
     def __init__(self):
-        """Start the background camera thread if it isn't running yet."""
-        if BaseCamera.thread is None:
-            BaseCamera.last_access = time.time()
+        self.key = None
+        self.thread = None  # background thread that reads frames from camera
+        self.frame = None  # current frame is stored here by background thread
+        self.n_frames = 0  # frames produced, drawn or not
+        self.last_access = 0  # time of last client access to the camera
+        self.renditions = {}  # (size, max_fps) -> Rendition
+        self.renditions_lock = threading.Lock()
+        self.clients = threading.local()  # last generation seen by each client of get_frame
+        self.metadata_event = CameraEvent()
+        self.metadata_access = 0  # time of last metadata subscriber access
+        self.stopped = False
+        self.metrics = NULL_METRICS
+        self.budget = None  # the `StreamBudget` given by the governor
 
-            # start background frame thread
-            BaseCamera.thread = threading.Thread(target=self._thread)
-            BaseCamera.thread.start()
+    @staticmethod
+    def make_key(*args, **kwargs):
+        """Return the registry key of a camera built with these arguments."""
+        raise RuntimeError('Must be implemented by subclasses.')
 
-            # wait until frames are available
-            while self.get_frame() is None:
-                time.sleep(0)
+    @classmethod
+    def get(cls, *args, **kwargs):
+        """Return the camera for these arguments, starting it if it isn't running yet.
+        Raises `AdmissionError` when the governor does not admit a new camera.
+        """
+        key = (cls.__name__,) + cls.make_key(*args, **kwargs)
+        with BaseCamera.lock:
+            camera = BaseCamera.cameras.get(key)
+            if camera is not None:
+                camera.last_access = time.time()
+        if camera is None:
+            # Admitted outside the lock, the governor may queue the camera for a while
+            camera = cls(*args, **kwargs)
+            budget = None
+            if BaseCamera.governor is not None:
+                budget = BaseCamera.governor.admit(getattr(camera, 'stream_name', None) or str(key))
+            with BaseCamera.lock:
+                running = BaseCamera.cameras.get(key)
+                if running is None:
+                    camera.key = key
+                    camera.budget = budget
+                    BaseCamera.cameras[key] = camera
+                    camera.start()
+                elif budget is not None:
+                    # Another client started it meanwhile
+                    BaseCamera.governor.release(budget)
+                camera = running or camera
+                camera.last_access = time.time()
 
-    def get_frame(self):
-        """Return the current camera frame."""
-        BaseCamera.last_access = time.time()
+        # wait until frames are available
+        while camera.n_frames == 0 and not camera.stopped:
+            time.sleep(0.01)
+        return camera
+
+    def start(self):
+        """Start the background camera thread."""
+        self.last_access = time.time()
+        self.thread = threading.Thread(target=self._thread)
+        self.thread.start()
+
+    def rendition(self, key=('full', None)):
+        """Return the rendition of a (size, max_fps) key, see `rendition_key`."""
+        with self.renditions_lock:
+            rendition = self.renditions.get(key)
+            if rendition is None:
+                rendition = self.renditions[key] = Rendition(key[0], key[1], self.jpeg_quality)
+                if self.stopped:
+                    rendition.event.set(None)
+            return rendition
+
+    def wait_frame(self, generation=0, rendition=('full', None)):
+        """Wait for a frame of a rendition newer than `generation`, which is 0 for a new client.
+
+        Returns the new generation, the JPEG frame and the frame as a multipart
+        MJPEG part shared by all the clients of the rendition. The frame and part
+        are None once the camera has stopped.
+        """
+        now = time.time()
+        self.last_access = now
+        rendition = self.rendition(rendition)
+        rendition.last_access = now
 
         # wait for a signal from the camera thread
-        BaseCamera.event.wait()
-        BaseCamera.event.clear()
+        return rendition.event.wait(generation)
 
-        return BaseCamera.frame
+    def wait_metadata(self, generation=0):
+        """Wait for the metadata of a frame newer than `generation`, which is 0 for a
+        new subscriber: it waits for the next frame rather than getting an old one.
 
-    @staticmethod
-    def frames():
+        Returns the new generation, the metadata dict and its JSON encoding
+        shared by all the subscribers, both None once the camera has stopped.
+        """
+        now = time.time()
+        self.last_access = now
+        self.metadata_access = now
+        if generation == 0 and not self.stopped:
+            generation = self.metadata_event.generation
+        return self.metadata_event.wait(generation)
+
+    def video_wanted(self, now=None):
+        """Whether any rendition has a viewer waiting for its next frame or that asked lately."""
+        now = time.time() if now is None else now
+        with self.renditions_lock:
+            renditions = list(self.renditions.values())
+        return any(rendition.has_viewers(now) for rendition in renditions)
+
+    def metadata_wanted(self, now=None):
+        """Whether a metadata subscriber is waiting for the next frame or asked lately."""
+        now = time.time() if now is None else now
+        return self.metadata_event.waiters > 0 or now - self.metadata_access <= Rendition.idle_timeout
+
+    def get_frame(self):
+        """Return the next camera frame, or None once the camera has stopped."""
+        generation, frame, _ = self.wait_frame(getattr(self.clients, 'generation', 0))
+        self.clients.generation = generation
+        return frame
+
+    def frames(self):
         """"Generator that returns frames from the camera."""
         raise RuntimeError('Must be implemented by subclasses.')
 
-    @classmethod
-    def _thread(cls):
+    def _unregister(self):
+        """Remove the camera from the registry, the caller holds the registry lock."""
+        if BaseCamera.cameras.get(self.key) is self:
+            del BaseCamera.cameras[self.key]
+        self.stopped = True
+
+    def has_waiters(self):
+        """Whether a client is waiting for a frame or for metadata, however long it has waited."""
+        with self.renditions_lock:
+            renditions = list(self.renditions.values())
+        return self.metadata_event.waiters > 0 or any(rendition.event.waiters > 0 for rendition in renditions)
+
+    def _stop_if_inactive(self):
+        with BaseCamera.lock:
+            # checked under the lock, a client may have just been handed this camera
+            if time.time() - self.last_access <= 10 or self.has_waiters():
+                return False
+            self._unregister()
+            return True
+
+    def publish(self, frame, jpeg=None, metadata=None):
+        """Encode a frame for each rendition that is wanted, send the metadata to its
+        subscribers, and signal their clients.
+        """
+        if metadata is not None:
+            self.metadata_event.set(metadata, json.dumps(metadata, separators=(',', ':')).encode())
+        if frame is None:
+            return
+        now = time.time()
+        with self.renditions_lock:
+            renditions = list(self.renditions.values())
+        for rendition in renditions:
+            if rendition.is_wanted(now):
+                full = jpeg if rendition.quality == self.jpeg_quality else None
+                with self.metrics.time('encode'):
+                    rendition.encode(frame, now, full)
+
+    def _thread(self):
         """Camera background thread."""
         print('Starting camera thread.')
-        frames_iterator = cls.frames()
-        for frame in frames_iterator:
-            BaseCamera.frame = frame
-            BaseCamera.event.set()  # send signal to clients
-            time.sleep(0)
-
-            # if there hasn't been any clients asking for frames in
-            # the last 10 seconds then stop the thread
-            if time.time() - BaseCamera.last_access > 10:
-                frames_iterator.close()
-                print('Stopping camera thread due to inactivity.')
-                break
-        BaseCamera.thread = None
\ No newline at end of file
+        frames_iterator = self.frames()
+        cpu = time.thread_time()
+        try:
+            for frame, jpeg, metadata in frames_iterator:
+                if frame is not None:
+                    self.frame = frame
+                self.n_frames += 1
+                # The clients blocked until this frame are still there, even
+                # when a frame takes longer than the timeouts
+                if self.has_waiters():
+                    self.last_access = time.time()
+                self.publish(frame, jpeg, metadata)  # send signal to clients
+                if self.budget is not None:
+                    # The frame was read and processed on this thread, unless pipelined
+                    now = time.thread_time()
+                    self.budget.charge(now - cpu, 1)
+                    cpu = now
+                time.sleep(0)
+
+                # if there hasn't been any clients asking for frames in
+                # the last 10 seconds then stop the thread
+                if time.time() - self.last_access > 10 and self._stop_if_inactive():
+                    print('Stopping camera thread due to inactivity.')
+                    break
+        finally:
+            with BaseCamera.lock:
+                self._unregister()
+            frames_iterator.close()
+            with self.renditions_lock:
+                renditions = list(self.renditions.values())
+            for rendition in renditions:
+                rendition.event.set(None)  # wake up the clients still waiting
+            self.metadata_event.set(None)
+            if self.budget is not None:
+                self.governor.release(self.budget)
+            self.thread = None
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Headless batch processing of recorded videos with the yoloOD detector and tracker.
+#
+# Every video is processed as fast as the CPU allows by a pool of worker processes,
+# each of which loads the network once. For every video it writes
+# <outDir>/<name>.npz with:
+#   detections: float32 rows (frame, x, y, w, h, area, confidence, class id), on the frames the detector ran
+#   tracks: int32 rows (frame, track id, x, y, w, h, color code, class id), the drawn tracks of every frame
+#   classes: the class names of the class ids
+#   fps, width, height, frames: the video properties
+# The color codes index (Yellow, Green, Red), see `centroid_track.TRACK_COLORS`.
+#
+# With --segments K, each video is also split into K overlapping time segments that
+# run in parallel. Each segment starts its tracker `--overlap` frames early, and the
+# track ids are stitched across the segments on those frames, see `stitching`.
+#
+# Usage:
+#   python batch_process.py "./videos/*.mp4" --outDir ./results --isTiny --safetyAssist
+#   python batch_process.py ./videos/Gantry4.mp4 --outDir ./results --annotate --workers 4
+#   python batch_process.py ./videos/night.mp4 --outDir ./results --safetyAssist --segments 4
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+
+from detector_args import add_detector_arguments, parse_detector_options, parse_labels
+from modules.tracking_algorithm.centroid_tracker import Tracker
+from modules.tracking_algorithm.stitching import segment_bounds, stitch_segments, track_rows, warmup_frames
+
+WIN_LENGTH = 21
+
+# Set in each worker process by `init_worker`
+worker_options = None
+
+
+def expand_inputs(patterns):
+    """Return the video paths matching a list of paths and glob patterns, in order and without duplicates."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or ([pattern] if os.path.exists(pattern) else [])
+        if not matches:
+            print("No video matches {}".format(pattern))
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def plan_segments(path, n_segments, overlap):
+    """Return the (path, index, warmup_start, start, end) tasks of a video."""
+    n_frames = 0
+    if n_segments > 1:
+        video = cv2.VideoCapture(path)
+        n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        video.release()
+    if n_frames <= 0:
+        # A single segment, also when the frame count is unknown
+        return [(path, 0, 0, 0, None)]
+    return [(path, i, warmup_start, start, end)
+            for i, (warmup_start, start, end) in enumerate(segment_bounds(n_frames, n_segments, overlap))]
+
+
+def open_at(path, n_frame):
+    """Open a video positioned on frame `n_frame`."""
+    video = cv2.VideoCapture(path)
+    if not video.isOpened():
+        raise RuntimeError("Could not open the video")
+    if n_frame > 0:
+        video.set(cv2.CAP_PROP_POS_FRAMES, n_frame)
+        if int(video.get(cv2.CAP_PROP_POS_FRAMES)) != n_frame:
+            # Not seekable to the exact frame: decode up to it
+            video.release()
+            video = cv2.VideoCapture(path)
+            for _ in range(n_frame):
+                video.grab()
+    return video
+
+
+def init_worker(options):
+    """Load and warm up the network once in this worker process."""
+    global worker_options
+    worker_options = options
+    from modules.yoloOD import load_model
+    load_model(options['isTiny'], options['detector_options']['backend']).warm_up()
+
+
+class TrackRecorder(object):
+    """Collects the per-frame detections and tracks of one video into arrays."""
+
+    def __init__(self):
+        self.detections = []
+        self.tracks = []
+
+    def record(self, n_frame, ai_frame, detected):
+        if detected:
+            detections = ai_frame.last_detections
+            self.detections.append(np.hstack([np.full((len(detections), 1), n_frame), detections]))
+        self.tracks.append(track_rows(n_frame, ai_frame.tracker))
+
+    def arrays(self):
+        detections = np.concatenate(self.detections) if self.detections else np.empty((0, 8))
+        tracks = np.concatenate(self.tracks) if self.tracks else np.empty((0, 8))
+        return detections.astype(np.float32), tracks.astype(np.int32)
+
+
+def annotated_path(out_dir, name, index=None):
+    suffix = '_annotated.mp4' if index is None else '_annotated.part{}.mp4'.format(index)
+    return os.path.join(out_dir, name + suffix)
+
+
+def process_segment(task):
+    """Run detection + tracking over the frames [warmup_start, end) of a video.
+
+    Returns a dict with the detections of the frames from `start` on, the
+    tracks from `warmup_start` on (the warm-up ones are used for stitching),
+    or with the error.
+    """
+    from modules.yoloOD import SmartAssistModule
+    from modules.inference.preprocess import FrameRing
+    path, index, warmup_start, start, end = task
+    options = worker_options
+    name = os.path.splitext(os.path.basename(path))[0]
+    result = {'path': path, 'name': name, 'index': index, 'start': start, 'end': end, 'error': None}
+    began = time.time()
+    try:
+        video = open_at(path, warmup_start)
+        result['fps'] = video.get(cv2.CAP_PROP_FPS) or 25.0
+        result['width'] = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        result['height'] = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        ai_frame = SmartAssistModule(options['labels'], options['isTiny'], **options['detector_options'])
+        ai_frame.set_source(path, warmup_start)
+        recorder = TrackRecorder()
+        # A frame is done with before the next one is read
+        frames = FrameRing()
+        writer = None
+        n_frame = warmup_start
+        try:
+            while end is None or n_frame < end:
+                success, frame = frames.read(video)
+                if not success:
+                    break
+                n_detected = ai_frame.scheduler.n_detected
+                overlays, _ = ai_frame.analyse(frame, options['safety'], WIN_LENGTH)
+                detected = ai_frame.scheduler.n_detected > n_detected and n_frame >= start
+                recorder.record(n_frame, ai_frame, detected)
+                if options['annotate'] and n_frame >= start:
+                    annotated = ai_frame.render(frame, overlays)
+                    if writer is None:
+                        writer = cv2.VideoWriter(
+                            annotated_path(options['outDir'], name, index if options['segments'] > 1 else None),
+                            cv2.VideoWriter_fourcc(*'mp4v'), result['fps'],
+                            (annotated.shape[1], annotated.shape[0]))
+                    writer.write(annotated)
+                n_frame += 1
+        finally:
+            video.release()
+            ai_frame.close()
+            if writer is not None:
+                writer.release()
+        result['detections'], result['tracks'] = recorder.arrays()
+        result['end'] = n_frame
+        result['classes'] = ai_frame.tracker.class_names
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - began
+    return result
+
+
+def concat_videos(paths, output):
+    """Append the annotated segment videos into one file and remove them."""
+    writer = None
+    for path in paths:
+        video = cv2.VideoCapture(path)
+        while True:
+            success, frame = video.read()
+            if not success:
+                break
+            if writer is None:
+                writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'mp4v'),
+                                         video.get(cv2.CAP_PROP_FPS) or 25.0, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+        video.release()
+        os.remove(path)
+    if writer is not None:
+        writer.release()
+
+
+def save_video_results(results, options):
+    """Stitch the segments of one video and write its results. Returns its number of frames."""
+    results = sorted(results, key=lambda result: result['start'])
+    tracks = stitch_segments([(result['start'], result['end'], result['tracks']) for result in results])
+    detections = np.concatenate([result['detections'] for result in results])
+    first, name = results[0], results[0]['name']
+    n_frames = results[-1]['end']
+    np.savez_compressed(os.path.join(options['outDir'], name + '.npz'), detections=detections,
+                        tracks=tracks.astype(np.int32), classes=np.array(first['classes']), fps=first['fps'],
+                        width=first['width'], height=first['height'], frames=n_frames)
+    if options['annotate'] and options['segments'] > 1:
+        parts = [annotated_path(options['outDir'], name, result['index']) for result in results]
+        concat_videos([part for part in parts if os.path.exists(part)], annotated_path(options['outDir'], name))
+    return n_frames
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run yoloOD detection and tracking over recorded videos, \
+                                                  without a server, on a pool of worker processes.')
+    parser.add_argument('inputs', nargs='+', help='Videos or glob patterns of videos (quote the patterns)')
+    parser.add_argument('--outDir', default='./results', help='Directory of the .npz results and annotated videos')
+    parser.add_argument('--annotate', help='Also write <name>_annotated.mp4 with the boxes drawn',
+                        action='store_true')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes, \
+                                                each one loads its own network')
+    parser.add_argument('--segments', type=int, default=1, help='Split each video into this many overlapping \
+                                                segments processed in parallel, e.g. the number of workers')
+    parser.add_argument('--overlap', type=int, default=None, help='Frames each segment starts early to stitch \
+                                                its tracks to the previous one, by default enough for the \
+                                                tracks to be the ones of a sequential run')
+    add_detector_arguments(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.threads is None:
+        # One process per core: more runtime threads per process would oversubscribe the cores
+        args.threads = max((os.cpu_count() or 1) // args.workers, 1)
+    if args.segments < 1:
+        parser.error('--segments must be at least 1')
+    if args.overlap is None:
+        tracker = Tracker()
+        args.overlap = warmup_frames(WIN_LENGTH, tracker.max_disappeared, tracker.n_init)
+    videos = expand_inputs(args.inputs)
+    if not videos:
+        parser.error('no video to process')
+    os.makedirs(args.outDir, exist_ok=True)
+    options = {'labels': parse_labels(args.classes), 'isTiny': args.isTiny, 'safety': args.safetyAssist,
+               'annotate': args.annotate, 'outDir': args.outDir, 'segments': args.segments,
+               'detector_options': parse_detector_options(parser, args)}
+
+    start = time.time()
+    tasks = [task for path in videos for task in plan_segments(path, args.segments, args.overlap)]
+    pending = {path: [] for path in videos}
+    n_segments = {path: sum(task[0] == path for task in tasks) for path in videos}
+    total_frames, failed = 0, 0
+    # spawn: forking a process that already runs OpenCV threads can deadlock
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(args.workers, len(tasks)), initializer=init_worker, initargs=(options,)) as pool:
+        for result in pool.imap_unordered(process_segment, tasks):
+            path = result['path']
+            pending[path].append(result)
+            if len(pending[path]) < n_segments[path]:
+                continue
+            results = pending.pop(path)
+            errors = [result['error'] for result in results if result['error'] is not None]
+            if errors:
+                failed += 1
+                print("{}: failed ({})".format(path, '; '.join(errors)))
+                continue
+            n_frames = save_video_results(results, options)
+            worker_seconds = sum(result['seconds'] for result in results)
+            total_frames += n_frames
+            print("{}: {} frames in {} segment(s), {:.1f} s of worker time".format(
+                path, n_frames, len(results), worker_seconds))
+    elapsed = time.time() - start
+    print("{} videos, {} failed, {} frames in {:.1f} s: {:.1f} fps overall".format(
+        len(videos), failed, total_frames, elapsed, total_frames / elapsed if elapsed else 0.0))
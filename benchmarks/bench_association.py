@@ -0,0 +1,76 @@
+"""Scaling benchmark of the track/detection association in `Tracker.update`.
+
+Compares the original dense `cdist` + greedy matching against the gated
+KD-tree + optimal assignment at 10, 100 and 1000 objects per frame. The objects
+move between two frames and the detections are shuffled, so the benchmark also
+reports the fraction of tracks matched to their own object.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_association
+    python -m benchmarks.bench_association --objects 10 100 1000 5000 --repeat 5
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial import distance as dist
+
+from modules.tracking_algorithm.association import associate
+
+
+def legacy_associate(track_boxes, detection_boxes):
+    """The greedy matching as it was in Tracker.update."""
+    inputcentroids = (detection_boxes[:, :2] + detection_boxes[:, 2:] / 2.0).astype(int)
+    trackcentroids = (track_boxes[:, :2] + track_boxes[:, 2:] / 2.0).astype(int)
+    D = dist.cdist(trackcentroids, inputcentroids)
+    rows = D.min(axis=1).argsort()
+    cols = D.argmin(axis=1)[rows]
+    usedRows = set()
+    usedCols = set()
+    matches = []
+    for (row, col) in zip(rows, cols):
+        if row in usedRows or col in usedCols:
+            continue
+        matches.append((row, col))
+        usedRows.add(row)
+        usedCols.add(col)
+    return matches
+
+
+def make_frame(n_objects, rng, width=3840, height=2160):
+    """Return the track boxes and the shuffled detection boxes of the next frame, and the true matching."""
+    size = rng.uniform(20, 120, size=(n_objects, 2))
+    position = rng.uniform(0, 1, size=(n_objects, 2)) * ([width, height] - size)
+    track_boxes = np.hstack([position, size])
+    moved = track_boxes.copy()
+    moved[:, :2] += rng.normal(0, 0.1, size=(n_objects, 2)) * size
+    moved[:, 2:] *= rng.uniform(0.95, 1.05, size=(n_objects, 2))
+    order = rng.permutation(n_objects)
+    return track_boxes, moved[order], np.argsort(order)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def accuracy(matches, truth):
+    return sum(1 for row, col in matches if truth[row] == col) / len(truth)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the track/detection association')
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_objects in args.objects:
+        track_boxes, detection_boxes, truth = make_frame(n_objects, rng)
+        legacy_ms, legacy_matches = timeit(lambda: legacy_associate(track_boxes, detection_boxes), args.repeat)
+        gated_ms, (gated_matches, _, _) = timeit(lambda: associate(track_boxes, detection_boxes), args.repeat)
+        print('objects={:5d}  greedy: {:9.3f} ms ({:.1%} correct)  gated: {:8.3f} ms ({:.1%} correct)'.format(
+            n_objects, legacy_ms, accuracy(legacy_matches, truth), gated_ms, accuracy(gated_matches, truth)))
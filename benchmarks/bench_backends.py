@@ -0,0 +1,129 @@
+"""Latency and throughput of the detector on each CPU inference backend.
+
+Runs the network of `--isTiny`/yolov3 (or an ONNX export with `--onnxModel`)
+on every backend configuration available on this machine: OpenCV DNN on the
+CPU with 1 thread and with all the cores, its fp16 CPU target, OpenCL when
+present, and ONNX Runtime in fp32 and int8. For each one it reports the
+latency of single frames, the throughput of batches, and the detections
+after the shared decode + NMS, compared to the fp32 run of the same model.
+
+Usage (from the repository root, with the weights in ./yolo-coco):
+    python -m benchmarks.bench_backends --isTiny
+    python -m benchmarks.bench_backends --isTiny --onnxModel ./yolo-coco/yolov3-tiny.onnx --repeat 50
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from modules.inference.backends import BackendConfig, OPENCV_TARGETS, load_backend
+from modules.inference.batching import split_batch_outputs
+from modules.inference.decode import decode_outputs, nms_boxes
+from modules.yoloOD import yolo_files
+
+INPUT_SIZE = (416, 416)
+
+
+def configurations(args):
+    """Return the (model, BackendConfig) pairs to run, the fp32 reference of each model first."""
+    cores = os.cpu_count() or 1
+    darknet = yolo_files(args.isTiny)
+    configs = [(darknet, BackendConfig('opencv', 'cpu', threads)) for threads in sorted({1, cores})]
+    if 'cpu_fp16' in OPENCV_TARGETS:
+        configs.append((darknet, BackendConfig('opencv', 'cpu_fp16', cores)))
+    if cv2.ocl.haveOpenCL():
+        configs.append((darknet, BackendConfig('opencv', 'opencl')))
+    if args.onnxModel:
+        onnx = (args.onnxModel, None)
+        for precision in ('fp32', 'int8'):
+            configs.extend((onnx, BackendConfig('onnx', 'cpu', threads, precision, args.onnxModel))
+                           for threads in sorted({1, cores}))
+    return configs
+
+
+def detect(outs, frame, args):
+    """The decode + NMS of `yoloOD.get_boxes_dimension`."""
+    height, width = frame.shape[:2]
+    boxes, areas, confidences, class_ids = decode_outputs(outs, height, width, args.confidence)
+    return boxes[nms_boxes(boxes, confidences, class_ids, args.confidence, 0.3)]
+
+
+def agreement(boxes, reference):
+    """Fraction of the reference boxes found again with an IoU of at least 0.5."""
+    if len(reference) == 0:
+        return 1.0 if len(boxes) == 0 else 0.0
+    found = 0
+    for x, y, w, h in reference:
+        if len(boxes) == 0:
+            break
+        x0 = np.maximum(boxes[:, 0], x)
+        y0 = np.maximum(boxes[:, 1], y)
+        x1 = np.minimum(boxes[:, 0] + boxes[:, 2], x + w)
+        y1 = np.minimum(boxes[:, 1] + boxes[:, 3], y + h)
+        inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+        iou = inter / np.maximum(boxes[:, 2] * boxes[:, 3] + w * h - inter, 1)
+        # Degenerate boxes only match themselves
+        iou[(boxes == (x, y, w, h)).all(axis=1)] = 1.0
+        found += iou.max() >= 0.5
+    return found / len(reference)
+
+
+def load_frames(args):
+    if args.video:
+        video = cv2.VideoCapture(args.video)
+        frames = []
+        while len(frames) < args.batch:
+            success, frame = video.read()
+            if not success:
+                break
+            frames.append(frame)
+        video.release()
+        if frames:
+            return frames
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8) for _ in range(args.batch)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the detector on each CPU inference backend')
+    parser.add_argument('--isTiny', action='store_true', help='yolov3-tiny instead of yolov3')
+    parser.add_argument('--onnxModel', default=None, help='ONNX export of the network, to include ONNX Runtime')
+    parser.add_argument('--video', default=None, help='Frames to run on, random images by default')
+    parser.add_argument('--batch', type=int, default=8, help='Frames per batch in the throughput run')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--confidence', type=float, default=0.5)
+    args = parser.parse_args()
+
+    frames = load_frames(args)
+    single = cv2.dnn.blobFromImage(frames[0], 1/255.0, INPUT_SIZE, (0, 0, 0), swapRB=True, crop=False)
+    batch = cv2.dnn.blobFromImages(frames, 1/255.0, INPUT_SIZE, (0, 0, 0), swapRB=True, crop=False)
+    references = {}
+    for model, config in configurations(args):
+        try:
+            backend = load_backend(model[0], model[1], config)
+            backend.forward(single)
+        except Exception as e:
+            print('{}: not available ({})'.format(config, e))
+            continue
+
+        latencies = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outs = backend.forward(single)
+            latencies.append((time.perf_counter() - start) * 1000)
+        backend.forward(batch)
+        start = time.perf_counter()
+        for _ in range(max(args.repeat // len(frames), 1)):
+            batch_outs = backend.forward(batch)
+        throughput = max(args.repeat // len(frames), 1) * len(frames) / (time.perf_counter() - start)
+
+        detections = [detect(image_outs, frame, args)
+                      for image_outs, frame in zip(split_batch_outputs(batch_outs, len(frames)), frames)]
+        reference = references.setdefault(model, detections)
+        match = np.mean([agreement(boxes, ref) for boxes, ref in zip(detections, reference)])
+        print('{:6s} {:11s} {:4s} threads={:<4}  latency: mean {:7.2f} ms  p95 {:7.2f} ms  '
+              'throughput: {:7.1f} frames/s  detections: {:4d} ({:.0%} of the fp32 ones)'.format(
+                  config.name, config.target, config.precision, str(config.threads), np.mean(latencies),
+                  np.percentile(latencies, 95), throughput, sum(len(boxes) for boxes in detections), match))
@@ -0,0 +1,101 @@
+"""Micro-benchmark of the YOLO output decoding in `yoloOD.get_boxes_dimension`.
+
+Compares the original per-row Python loop against the vectorized decode path on
+synthetic output tensors shaped like yolov3-tiny and yolov3 at 416x416.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_decode
+    python -m benchmarks.bench_decode --repeat 200 --positives 0.01
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from modules.inference.decode import decode_outputs, nms_boxes
+
+# Number of candidate rows per output layer at 416x416 (3 anchors per cell)
+LAYER_SHAPES = {
+    'yolov3-tiny': [13 * 13 * 3, 26 * 26 * 3],
+    'yolov3': [13 * 13 * 3, 26 * 26 * 3, 52 * 52 * 3],
+}
+
+
+def make_outputs(rows_per_layer, n_classes, positives, rng):
+    """Build random output layers where roughly `positives` of the rows pass the threshold."""
+    outs = []
+    for rows in rows_per_layer:
+        out = np.zeros((rows, 5 + n_classes), dtype=np.float32)
+        out[:, 0:2] = rng.uniform(0.05, 0.95, size=(rows, 2))
+        out[:, 2:4] = rng.uniform(0.02, 0.3, size=(rows, 2))
+        out[:, 4] = rng.uniform(0, 1, size=rows)
+        out[:, 5:] = rng.uniform(0, 0.3, size=(rows, n_classes))
+        hits = rng.uniform(size=rows) < positives
+        out[hits, 5 + rng.integers(0, n_classes, size=hits.sum())] = rng.uniform(0.5, 1, size=hits.sum())
+        outs.append(out)
+    return outs
+
+
+def legacy_decode(outs, height, width, classes, labels, confidence_threshold=0.5):
+    """The per-row decoding loop as it was before vectorization."""
+    detections = []
+    boxes, areas, class_ids, confidences = [], [], [], []
+    for out in outs:
+        for detection in out:
+            scores = detection[5:]
+            class_id = np.argmax(scores)
+            confidence = scores[class_id]
+            if confidence > confidence_threshold:
+                center_x = int(detection[0] * width)
+                center_y = int(detection[1] * height)
+                w = int(detection[2] * width)
+                h = int(detection[3] * height)
+                x = int(center_x - w / 2)
+                y = int(center_y - h / 2)
+                boxes.append([x, y, w, h])
+                confidences.append(float(confidence))
+                class_ids.append(class_id)
+                areas.append(detection[2] * detection[3])
+    indices = cv2.dnn.NMSBoxes(boxes, confidences, confidence_threshold, 0.3)
+    for i in range(len(boxes)):
+        if i in indices:
+            class_name = str(classes[class_ids[i]])
+            if class_name in labels:
+                detections.append((boxes[i], class_name))
+    return detections
+
+
+def vectorized_decode(outs, height, width, classes, label_ids, confidence_threshold=0.5):
+    boxes, areas, confidences, class_ids = decode_outputs(outs, height, width, confidence_threshold, label_ids)
+    indices = nms_boxes(boxes, confidences, class_ids, confidence_threshold, 0.3)
+    return [(boxes[i].tolist(), classes[class_ids[i]]) for i in indices]
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark YOLO output decoding')
+    parser.add_argument('--repeat', type=int, default=50, help='Number of timed runs per case')
+    parser.add_argument('--positives', type=float, default=0.005, help='Fraction of rows above the threshold')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    classes = ['class{}'.format(i) for i in range(80)]
+    for model, rows_per_layer in LAYER_SHAPES.items():
+        outs = make_outputs(rows_per_layer, len(classes), args.positives, rng)
+        for labels in (classes, classes[:3]):
+            label_ids = None if labels is classes else np.arange(len(labels))
+            legacy_ms = timeit(lambda: legacy_decode(outs, args.height, args.width, classes, labels), args.repeat)
+            fast_ms = timeit(lambda: vectorized_decode(outs, args.height, args.width, classes, label_ids),
+                             args.repeat)
+            print('{:12s} rows={:6d} labels={:2d}  loop: {:8.3f} ms  vectorized: {:7.3f} ms  speedup: {:6.1f}x'.format(
+                model, sum(rows_per_layer), len(labels), legacy_ms, fast_ms, legacy_ms / fast_ms))
@@ -0,0 +1,119 @@
+"""Allocations and time per frame of reading a video and turning the frames into network blobs.
+
+Compares the original path, `video.read()` into a new frame and
+`cv2.dnn.blobFromImage` into a new blob, with the reused buffers of
+`FrameRing` and `BlobBuffer`, stretched and letterboxed, at several frame
+sizes. The allocations are the bytes of the arrays allocated while a frame is
+processed (numpy reports them to tracemalloc, and OpenCV returns numpy arrays),
+measured on a separate pass since tracing slows everything down.
+
+The frames come from a short MJPEG clip written into a temporary directory at
+each size, or from `--video`.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_preprocess
+    python -m benchmarks.bench_preprocess --sizes 1920x1080,3840x2160 --frames 200
+    python -m benchmarks.bench_preprocess --video ./videos/Gantry4.mp4
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from modules.inference.preprocess import BlobBuffer, FrameRing, INPUT_SIZE
+
+
+def write_clip(path, width, height, n_frames, rng):
+    """Write a clip of moving noise blocks, so that the decoder has real work to do."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25.0, (width, height))
+    base = rng.integers(0, 255, size=(height // 8, width // 8, 3), dtype=np.uint8)
+    for i in range(n_frames):
+        frame = cv2.resize(np.roll(base, i, axis=1), (width, height), interpolation=cv2.INTER_NEAREST)
+        writer.write(frame)
+    writer.release()
+
+
+class Original(object):
+    """`video.read()` into a new frame, `cv2.dnn.blobFromImage` into a new blob."""
+    def read(self, video):
+        return video.read()
+
+    def blob(self, frame):
+        return cv2.dnn.blobFromImage(frame, scalefactor=1/255.0, size=INPUT_SIZE, mean=(0, 0, 0), swapRB=True,
+                                     crop=False)
+
+
+class Reused(object):
+    """The frames read into a `FrameRing`, the blobs made in a `BlobBuffer`."""
+    def __init__(self, letterbox):
+        self.frames = FrameRing()
+        self.blobs = BlobBuffer(letterbox=letterbox)
+
+    def read(self, video):
+        return self.frames.read(video)
+
+    def blob(self, frame):
+        return self.blobs.prepare([frame])
+
+
+def measure(path, method, n_frames, traced):
+    """Return the mean (read, blob) ms per frame, or with `traced` the mean bytes allocated per frame."""
+    video = cv2.VideoCapture(path)
+    _, frame = method.read(video)
+    method.blob(frame)  # the first frame fills the buffers
+    allocated, read_s, blob_s, n = 0, 0.0, 0.0, 0
+    while n < n_frames:
+        if traced:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        # The last frame is only released after the measure, so that a new one shows up in the peak
+        success, next_frame = method.read(video)
+        if not success:
+            break
+        read = time.perf_counter()
+        blob = method.blob(next_frame)
+        blob_s += time.perf_counter() - read
+        read_s += read - start
+        if traced:
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        frame = blob = next_frame = None
+        n += 1
+    video.release()
+    n = max(n, 1)
+    return allocated / n if traced else (read_s * 1000 / n, blob_s * 1000 / n)
+
+
+def run_clip(label, path, n_frames):
+    for name, make in (('read + blobFromImage', Original), ('FrameRing + BlobBuffer', lambda: Reused(False)),
+                       ('  letterboxed', lambda: Reused(True))):
+        read_ms, blob_ms = measure(path, make(), n_frames, traced=False)
+        tracemalloc.start()
+        allocated = measure(path, make(), min(n_frames, 50), traced=True)
+        tracemalloc.stop()
+        print('{:10s} {:24s} read {:6.2f} ms  blob {:5.2f} ms  {:9.1f} KB allocated/frame'.format(
+            label, name, read_ms, blob_ms, allocated / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the frame reading and blob preprocessing')
+    parser.add_argument('--sizes', default='1280x720,1920x1080,3840x2160', help='Comma separated WIDTHxHEIGHT')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--video', default=None, help='Read this video instead of synthetic clips')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.video:
+        run_clip(os.path.basename(args.video), args.video, args.frames)
+    else:
+        rng = np.random.default_rng(args.seed)
+        with tempfile.TemporaryDirectory() as directory:
+            for size in args.sizes.split(','):
+                width, height = (int(v) for v in size.lower().split('x'))
+                path = os.path.join(directory, '{}.avi'.format(size))
+                write_clip(path, width, height, args.frames + 1, rng)
+                run_clip(size, path, args.frames)
@@ -0,0 +1,53 @@
+"""Benchmark of the streaming area smoothing in `Track.update_color`.
+
+Times the update of a track fed a random area sequence against the original
+implementation, which called `scipy.signal.savgol_filter` on every update.
+That both decide the same colors is checked by tests/test_smoothing.py.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_smoothing
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from modules.tracking_algorithm.centroid_track import Track
+
+
+def legacy_update_color(area, winLength):
+    """The original per-update cost: a savgol_filter call and a list conversion."""
+    filtered_data = savgol_filter(area, winLength, 1)
+    return filtered_data.tolist()
+
+
+def area_sequence(n, rng):
+    """A random walk of areas that grows, shrinks and stays still, so that every color shows up."""
+    start = rng.uniform(0.01, 0.3)
+    trend = rng.choice([-0.02, 0.0, 0.02], size=n // 20 + 1).repeat(20)[:n]
+    return start * np.exp(np.cumsum(trend + rng.normal(0, 0.01, size=n)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the streaming area smoothing')
+    parser.add_argument('--updates', type=int, default=400)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for winLength in (11, 21):
+        track = Track(0, 3, 30, [0, 0, 10, 10], 0.05, winLength, 'person')
+        areas = area_sequence(args.updates, rng)
+        start = time.perf_counter()
+        for area in areas:
+            track.push_area(area)
+        streaming_us = (time.perf_counter() - start) / len(areas) * 1e6
+        window = [0.05] * winLength
+        start = time.perf_counter()
+        for area in areas:
+            del window[0]
+            window.append(area)
+            window = legacy_update_color(window, winLength)
+        legacy_us = (time.perf_counter() - start) / len(areas) * 1e6
+        print('winLength={}: savgol_filter per update: {:.1f} us  streaming: {:.1f} us'.format(
+            winLength, legacy_us, streaming_us))
@@ -0,0 +1,118 @@
+"""Benchmark of the array-backed track table in `Tracker.update` on crowded frames.
+
+Runs the same scene, objects moving with some missed detections, through the
+original per-object tracker (a `Track` per object in an OrderedDict, fed
+`Detection` objects) and through `Tracker` fed (N, 7) detection arrays. Checks
+that both keep the same tracks, boxes and colors, and reports the time per
+frame.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_track_table
+    python -m benchmarks.bench_track_table --objects 10 100 1000 --frames 100
+"""
+import argparse
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from modules.tracking_algorithm.association import associate
+from modules.tracking_algorithm.centroid_detection import Detection
+from modules.tracking_algorithm.centroid_track import Track
+from modules.tracking_algorithm.centroid_tracker import Tracker
+
+WIN_LENGTH = 11
+
+
+class LegacyTracker(object):
+    """The per-object tracker as it was before the track table."""
+    def __init__(self, max_disappeared=30, n_init=3):
+        self.max_disappeared = max_disappeared
+        self.n_init = n_init
+        self.tracks = OrderedDict()
+        self.next_id = 0
+
+    def register(self, detection, winLength):
+        self.tracks[self.next_id] = Track(self.next_id, self.n_init, self.max_disappeared, detection.get_bbox(),
+                                          detection.get_area(), winLength, detection.get_class())
+        self.next_id += 1
+
+    def update(self, detections, winLength):
+        if len(detections) == 0:
+            for track in self.tracks.values():
+                track.mark_missed()
+        elif len(self.tracks) == 0:
+            for detection in detections:
+                self.register(detection, winLength)
+        else:
+            track_ids = list(self.tracks.keys())
+            track_boxes = np.array([track.bbox for track in self.tracks.values()], dtype=float)
+            detection_boxes = np.array([detection.get_bbox() for detection in detections], dtype=float)
+            track_steps = np.array([track.steps_since_measurement + 1 for track in self.tracks.values()])
+            matches, unmatched_tracks, unmatched_detections = associate(
+                track_boxes, detection_boxes, track_steps=track_steps)
+            for (row, col) in matches:
+                self.tracks[track_ids[row]].update(detections[col])
+            for row in unmatched_tracks:
+                self.tracks[track_ids[row]].mark_missed()
+            for col in unmatched_detections:
+                self.register(detections[col], winLength)
+        for track_id in list(self.tracks.keys()):
+            if self.tracks[track_id].is_deleted():
+                del self.tracks[track_id]
+
+
+def make_scene(n_objects, n_frames, rng, width=3840, height=2160):
+    """Return the (N, 7) detection array of each frame."""
+    size = rng.uniform(20, 120, size=(n_objects, 2))
+    position = rng.uniform(0, 1, size=(n_objects, 2)) * ([width, height] - size)
+    velocity = rng.normal(0, 2, size=(n_objects, 2))
+    frames = []
+    for _ in range(n_frames):
+        position += velocity
+        size *= rng.uniform(0.98, 1.03, size=(n_objects, 2))
+        seen = rng.random(n_objects) > 0.1
+        boxes = np.hstack([position, size])[seen].astype(int)
+        detections = np.empty((len(boxes), 7))
+        detections[:, :4] = boxes
+        detections[:, 4] = boxes[:, 2] * boxes[:, 3] / float(width * height)
+        detections[:, 5] = 0.9
+        detections[:, 6] = 0
+        frames.append(detections)
+    return frames
+
+
+def as_objects(detections):
+    return [Detection(row[:4].astype(int).tolist(), float(row[4]), float(row[5]), 'person') for row in detections]
+
+
+def state(tracks):
+    return [(track_id, list(track.bbox), track.color) for track_id, track in tracks.items()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the array-backed track table')
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--frames', type=int, default=60)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_objects in args.objects:
+        frames = make_scene(n_objects, args.frames, rng)
+        objects = [as_objects(detections) for detections in frames]
+
+        legacy = LegacyTracker()
+        start = time.perf_counter()
+        for detections in objects:
+            legacy.update(detections, WIN_LENGTH)
+        legacy_ms = (time.perf_counter() - start) / len(frames) * 1000
+
+        tracker = Tracker(class_names=['person'])
+        start = time.perf_counter()
+        for detections in frames:
+            tracker.update(detections, WIN_LENGTH)
+        table_ms = (time.perf_counter() - start) / len(frames) * 1000
+
+        same = state(legacy.tracks) == state(tracker.tracks)
+        print('objects={:5d}  per-object tracks: {:8.3f} ms/frame  track table: {:8.3f} ms/frame  same tracks: {}'.format(
+            n_objects, legacy_ms, table_ms, same))
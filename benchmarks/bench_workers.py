@@ -0,0 +1,107 @@
+"""Throughput of the detector in the server process and in 1 to N worker processes.
+
+Runs `--streams` stream threads that each detect in their frames as fast as
+they can, for `--seconds`: the forward pass, then the decode + NMS of
+`yoloOD.get_boxes_dimension` on the stream thread. The network runs first in
+the server process, one model shared by the streams with all the cores, then
+in `ProcessInferenceService` workers with the cores split between them.
+Reports the frames per second of all the streams together and the speedup
+over one worker. The workers can only scale up to the number of cores.
+
+Usage (from the repository root, with the weights in ./yolo-coco):
+    python -m benchmarks.bench_workers --isTiny
+    python -m benchmarks.bench_workers --workers 1,2,4,8 --streams 8 --video ./videos/Gantry4.mp4
+"""
+import argparse
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from modules.inference.decode import decode_outputs, nms_boxes
+from modules.inference.preprocess import BlobBuffer
+from modules.inference.workers import ProcessInferenceService
+from modules.yoloOD import CONFIDENCE_THRESHOLD, load_model, yolo_files
+
+
+class InProcess(object):
+    """The detector of a stream without a service: its own blob, the shared model."""
+    def __init__(self, model):
+        self.model = model
+        self.blobs = {}
+
+    def infer(self, frame, stream_id):
+        blobs = self.blobs.setdefault(stream_id, BlobBuffer())
+        return self.model.forward(blobs.prepare([frame]))
+
+
+def run_streams(service, frames, n_streams, seconds):
+    """Return the frames per second detected by `n_streams` threads together."""
+    counts = [0] * n_streams
+    deadline = time.time() + seconds
+
+    def stream(index):
+        n = index
+        while time.time() < deadline:
+            frame = frames[n % len(frames)]
+            height, width = frame.shape[:2]
+            outs = service.infer(frame, index)
+            boxes, areas, confidences, class_ids = decode_outputs(outs, height, width, CONFIDENCE_THRESHOLD)
+            nms_boxes(boxes, confidences, class_ids, CONFIDENCE_THRESHOLD, 0.3)
+            counts[index] += 1
+            n += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(n_streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.time() - start)
+
+
+def load_frames(video_path, n_frames=30):
+    if video_path:
+        video = cv2.VideoCapture(video_path)
+        frames = []
+        while len(frames) < n_frames:
+            success, frame = video.read()
+            if not success:
+                break
+            frames.append(frame)
+        video.release()
+        if frames:
+            return frames
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8) for _ in range(n_frames)]
+
+
+if __name__ == '__main__':
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Benchmark the detector in 1 to N worker processes')
+    parser.add_argument('--isTiny', action='store_true', help='yolov3-tiny instead of yolov3')
+    parser.add_argument('--video', default=None, help='Frames to run on, random images by default')
+    parser.add_argument('--workers', default=','.join(str(n) for n in sorted({1, 2, cores})),
+                        help='Comma separated worker counts, 1, 2 and the number of cores by default')
+    parser.add_argument('--streams', type=int, default=max(2 * cores, 4), help='Concurrent stream threads')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Duration of each run')
+    args = parser.parse_args()
+
+    frames = load_frames(args.video)
+    print('{} cores, {} streams, {:.0f} s per run'.format(cores, args.streams, args.seconds))
+    model = load_model(args.isTiny)
+    model.warm_up()
+    fps = run_streams(InProcess(model), frames, args.streams, args.seconds)
+    print('in process          {:7.1f} frames/s'.format(fps))
+
+    baseline = None
+    for n_workers in (int(n) for n in args.workers.split(',')):
+        service = ProcessInferenceService(*yolo_files(args.isTiny), workers=n_workers,
+                                          score_threshold=CONFIDENCE_THRESHOLD)
+        service.wait_ready()
+        fps = run_streams(service, frames, args.streams, args.seconds)
+        service.stop()
+        baseline = baseline or fps
+        print('{:2d} worker processes  {:7.1f} frames/s  x{:.2f}'.format(n_workers, fps, fps / baseline))
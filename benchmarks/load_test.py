@@ -0,0 +1,100 @@
+"""Load test of the MJPEG streaming servers with many simulated viewers.
+
+Opens N concurrent connections to a video feed, reads the multipart stream for
+a fixed duration and reports the frames per second delivered to each client.
+With --pid, the resident memory of the server process is sampled as well.
+
+Usage (from the repository root, with a server running):
+    python -m benchmarks.load_test --url http://127.0.0.1:5010/video_feed --clients 200 --duration 30
+    python -m benchmarks.load_test --clients 500 --pid $(pgrep -f async_videoserver.py)
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+BOUNDARY = b'--frame\r\n'
+
+
+def rss_mb(pid):
+    """Return the resident memory of a process in MB, from /proc (Linux only)."""
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return float('nan')
+
+
+async def client(host, port, path, duration, stats, index):
+    frames, received = 0, 0
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        stats[index] = (0, 0, str(e))
+        return
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode())
+    start = time.time()
+    tail = b''
+    try:
+        while time.time() - start < duration:
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), timeout=max(duration - (time.time() - start), 0.01))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+            # Count the boundaries, including one split across two reads
+            data = tail + chunk
+            frames += data.count(BOUNDARY)
+            tail = data[-(len(BOUNDARY) - 1):] if not data.endswith(BOUNDARY) else b''
+    except ConnectionError as e:
+        stats[index] = (frames, received, str(e))
+        return
+    finally:
+        writer.close()
+    stats[index] = (frames, received, None)
+
+
+async def sample_memory(pid, duration, samples):
+    start = time.time()
+    while time.time() - start < duration:
+        samples.append(rss_mb(pid))
+        await asyncio.sleep(1)
+
+
+async def main(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    stats = {}
+    tasks = []
+    for i in range(args.clients):
+        tasks.append(asyncio.create_task(client(host, port, url.path or '/', args.duration, stats, i)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / args.clients)
+    memory = []
+    if args.pid:
+        tasks.append(asyncio.create_task(sample_memory(args.pid, args.duration, memory)))
+    await asyncio.gather(*tasks)
+
+    fps = sorted(frames / args.duration for frames, _, _ in stats.values())
+    errors = [error for _, _, error in stats.values() if error]
+    total_mb = sum(received for _, received, _ in stats.values()) / 1e6
+    print('clients: {}  errors: {}  received: {:.1f} MB'.format(args.clients, len(errors), total_mb))
+    if fps:
+        print('delivered fps per client: min {:.2f}  median {:.2f}  mean {:.2f}  max {:.2f}'.format(
+            fps[0], fps[len(fps) // 2], sum(fps) / len(fps), fps[-1]))
+    if memory:
+        print('server RSS: start {:.1f} MB  peak {:.1f} MB  end {:.1f} MB'.format(memory[0], max(memory), memory[-1]))
+    if errors:
+        print('first error: {}'.format(errors[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Open many MJPEG viewers and report the delivered fps')
+    parser.add_argument('--url', default='http://127.0.0.1:5010/video_feed', help='Video feed to load')
+    parser.add_argument('--clients', type=int, default=100, help='Number of simulated viewers')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds each viewer stays connected')
+    parser.add_argument('--ramp', type=float, default=2, help='Seconds over which the viewers connect')
+    parser.add_argument('--pid', type=int, default=None, help='Server process id to sample the memory of')
+    asyncio.run(main(parser.parse_args()))
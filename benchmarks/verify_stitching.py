@@ -0,0 +1,149 @@
+"""Checks that a video processed as stitched segments gives the tracks of a sequential run.
+
+By default, runs a synthetic clip (the detections of objects that appear, move,
+approach or recede, are missed on some frames and leave) through one `Tracker`
+over all the frames, and through one `Tracker` per overlapping segment whose
+tracks are joined by `stitch_segments`. With `--video`, runs the real
+detector + tracker of `batch_process.py` over the video instead, segment by
+segment in this process.
+
+Both runs must draw the same boxes with the same colors on every frame, and
+the stitched track ids must map one to one onto the sequential ones, or the
+script exits with status 1 (tests/test_stitching.py runs the synthetic check
+under pytest). This
+holds when the matching of detections to tracks has no ties: with many
+identical overlapping boxes (e.g. an untrained network), equally good matches
+are decided by the order of the tracks, which a segment does not reproduce.
+
+Usage (from the repository root):
+    python -m benchmarks.verify_stitching
+    python -m benchmarks.verify_stitching --frames 5000 --segments 8
+    python -m benchmarks.verify_stitching --video ./videos/Gantry4.mp4 --isTiny --safetyAssist --segments 4
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import batch_process
+from detector_args import add_detector_arguments, parse_detector_options, parse_labels
+from modules.tracking_algorithm.centroid_tracker import Tracker
+from modules.tracking_algorithm.stitching import (FRAME, TRACK_ID, X, CLASS_ID, N_COLUMNS, segment_bounds,
+                                                  stitch_segments, track_rows, warmup_frames)
+
+WIN_LENGTH = batch_process.WIN_LENGTH
+
+
+def make_clip(n_frames, rng, width=1280, height=720, birth_rate=0.05):
+    """Return the (N, 7) detection array of each frame of a synthetic clip."""
+    objects = []
+    frames = []
+    for _ in range(n_frames):
+        if rng.random() < birth_rate or not objects:
+            size = rng.uniform(30, 150, size=2)
+            objects.append({'position': rng.uniform(0, 1, size=2) * ([width, height] - size), 'size': size,
+                            'velocity': rng.normal(0, 3, size=2), 'growth': rng.choice([0.98, 1.0, 1.02]),
+                            'life': int(rng.integers(30, 400)), 'class_id': int(rng.integers(0, 3))})
+        rows = []
+        for obj in objects:
+            obj['position'] += obj['velocity']
+            obj['size'] = np.clip(obj['size'] * obj['growth'], 10, 400)
+            obj['life'] -= 1
+            if rng.random() < 0.1:
+                continue
+            x, y = obj['position']
+            w, h = obj['size']
+            rows.append((int(x), int(y), int(w), int(h), int(w) * int(h) / float(width * height), 0.9,
+                         obj['class_id']))
+        objects = [obj for obj in objects if obj['life'] > 0]
+        frames.append(np.array(rows, dtype=float).reshape(-1, 7))
+    return frames
+
+
+def run_tracker(frames, first_frame=0):
+    """Track the detection arrays and return the track rows of every frame."""
+    tracker = Tracker(class_names=['person', 'car', 'truck'])
+    rows = []
+    for n_frame, detections in enumerate(frames, first_frame):
+        tracker.update(detections, WIN_LENGTH)
+        rows.append(track_rows(n_frame, tracker))
+    return np.concatenate(rows) if rows else np.empty((0, N_COLUMNS), dtype=np.int64)
+
+
+def synthetic_runs(args):
+    frames = make_clip(args.frames, np.random.default_rng(args.seed))
+    start = time.perf_counter()
+    sequential = run_tracker(frames)
+    sequential_s = time.perf_counter() - start
+    segments, segment_s = [], []
+    for warmup_start, first, end in segment_bounds(len(frames), args.segments, args.overlap):
+        start = time.perf_counter()
+        segments.append((first, end, run_tracker(frames[warmup_start:end], warmup_start)))
+        segment_s.append(time.perf_counter() - start)
+    return sequential, stitch_segments(segments), sequential_s, segment_s
+
+
+def video_runs(args, parser):
+    batch_process.worker_options = {
+        'labels': parse_labels(args.classes), 'isTiny': args.isTiny, 'safety': args.safetyAssist,
+        'annotate': False, 'outDir': '.', 'segments': args.segments,
+        'detector_options': parse_detector_options(parser, args)}
+    sequential = batch_process.process_segment(batch_process.plan_segments(args.video, 1, args.overlap)[0])
+    results = [batch_process.process_segment(task)
+               for task in batch_process.plan_segments(args.video, args.segments, args.overlap)]
+    for result in [sequential] + results:
+        if result['error'] is not None:
+            raise RuntimeError(result['error'])
+    stitched = stitch_segments([(result['start'], result['end'], result['tracks']) for result in results])
+    return (sequential['tracks'].astype(np.int64), stitched, sequential['seconds'],
+            [result['seconds'] for result in results])
+
+
+def compare(sequential, stitched):
+    """Return the number of frames that differ, and whether the ids map one to one."""
+    def by_frame(rows):
+        rows = rows[np.lexsort(rows[:, ::-1].T)]
+        return {n_frame: rows[rows[:, FRAME] == n_frame] for n_frame in np.unique(rows[:, FRAME])}
+
+    a, b = by_frame(sequential), by_frame(stitched)
+    mismatched = 0
+    mapping, reverse, one_to_one = {}, {}, True
+    for n_frame in set(a) | set(b):
+        rows_a = a.get(n_frame, np.empty((0, N_COLUMNS), dtype=np.int64))
+        rows_b = b.get(n_frame, np.empty((0, N_COLUMNS), dtype=np.int64))
+        # Sort on the box, color and class, not on the id
+        rows_a = rows_a[np.lexsort(rows_a[:, X:CLASS_ID + 1][:, ::-1].T)]
+        rows_b = rows_b[np.lexsort(rows_b[:, X:CLASS_ID + 1][:, ::-1].T)]
+        if rows_a.shape != rows_b.shape or (rows_a[:, X:] != rows_b[:, X:]).any():
+            mismatched += 1
+            continue
+        for id_a, id_b in zip(rows_a[:, TRACK_ID].tolist(), rows_b[:, TRACK_ID].tolist()):
+            one_to_one &= mapping.setdefault(id_a, id_b) == id_b and reverse.setdefault(id_b, id_a) == id_a
+    return mismatched, len(set(a) | set(b)), one_to_one
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare stitched segment tracks with a sequential run')
+    parser.add_argument('--frames', type=int, default=3000, help='Length of the synthetic clip')
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--overlap', type=int, default=None, help='Warm-up frames of each segment')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--video', default=None, help='Run the detector over this video instead')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+    if args.overlap is None:
+        tracker = Tracker()
+        args.overlap = warmup_frames(WIN_LENGTH, tracker.max_disappeared, tracker.n_init)
+
+    if args.video:
+        sequential, stitched, sequential_s, segment_s = video_runs(args, parser)
+    else:
+        sequential, stitched, sequential_s, segment_s = synthetic_runs(args)
+    mismatched, n_frames, one_to_one = compare(sequential, stitched)
+    print('{} segments, {} warm-up frames each: {} of {} frames differ, track ids one to one: {}'.format(
+        args.segments, args.overlap, mismatched, n_frames, one_to_one))
+    print('sequential {:.2f} s, longest segment {:.2f} s: {:.1f}x faster with one worker per segment'.format(
+        sequential_s, max(segment_s), sequential_s / max(max(segment_s), 1e-9)))
+    if mismatched or not one_to_one:
+        sys.exit(1)
@@ -1,6 +1,10 @@
 import time
 import cv2
 from base_camera import BaseCamera
+from pipeline import Pipeline
+from recorder import EventRecorder
+from capture import LatestFrameReader, PacedFileReader
+from modules.inference.metrics import registry as metrics_registry
 import os
 import sys
 
@@ -11,61 +15,190 @@ import sys
 '''
 
 class VideoCamera(BaseCamera):
+    """
+    A camera that reads one input source and streams it through a SmartAssist module.
+
+    Use `VideoCamera.get(...)` rather than the constructor: the cameras are shared
+    by key (source + module + options), so every client of the same stream reuses
+    the same capture thread and model. The stage latencies are recorded under
+    `stream_name` (the input source by default) when the metrics are enabled.
+    With an `output`, the frames around detections are recorded into clip files
+    by an `EventRecorder` made with the `recorder_options`.
+
+    The detections and tracks of each frame are sent to the metadata subscribers
+    while there are some. With `draw_on_demand`, the frames are not drawn, and
+    so not encoded, while no one watches the video nor records it.
+
+    Live sources (webcams, network streams) are read by a `LatestFrameReader`,
+    so the frames shown are the newest ones however slow the detector is.
+    Files are played at their frame rate, or as fast as they are processed
+    without `pace_files`.
+
+    The frame rate is held to the `max_fps` of the budget of the governor,
+    when it lowers it: the live sources skip the frames in between, the files
+    play slower.
+    """
+    queue_size = 4
+    draw_on_demand = False
+    pace_files = True
+    # Module name -> the Python module loaded from the modules directory, loaded once per process
+    loaded_modules = {}
     
-    input_source = None
-    output = None
-    __selected_module__ = ''
-    safety = None
-    isTiny = None
-    labels = []
-    
-    def __init__(self, input_source, output, modulename, labels, safetyAssist, isTiny):
-        VideoCamera.__selected_module__= '{}'.format(modulename)
-        VideoCamera.safety = safetyAssist
-        VideoCamera.isTiny = isTiny
-        VideoCamera.labels = labels
-        VideoCamera.input_source = input_source
-        VideoCamera.output = output
+    def __init__(self, input_source, output, modulename, labels, safetyAssist, isTiny, inference=None,
+                 pipeline=False, detector_options=None, stream_name=None, recorder_options=None):
+        self.selected_module = '{}'.format(modulename)
+        self.safety = safetyAssist
+        self.isTiny = isTiny
+        self.labels = labels
+        self.input_source = input_source
+        self.output = output
+        self.inference = inference
+        self.pipeline = pipeline
+        self.detector_options = detector_options or {}
+        self.recorder_options = recorder_options or {}
+        self.stages = None
+        self.stream_name = stream_name or input_source
+        self.next_frame = 0  # the time the next frame is due, see `throttle`
         super().__init__()
-        
-    @staticmethod
-    def importSmartAssistModule():
-        sys.path.append(os.getcwd())
-        import importlib.util
-        spec = importlib.util.spec_from_file_location(VideoCamera.__selected_module__, '{}/modules/{}.py'.format(os.getcwd(), VideoCamera.__selected_module__))
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        if VideoCamera.__selected_module__ == 'yoloOD':
-            return module.SmartAssistModule(VideoCamera.labels, VideoCamera.isTiny)
-        return module.SmartAssistModule()
-    
+        self.metrics = metrics_registry.stream(self.stream_name)
 
     @staticmethod
-    def frames():
-        ai_frame = VideoCamera.importSmartAssistModule()
+    def make_key(input_source, output, modulename, labels, safetyAssist, isTiny, inference=None,
+                 pipeline=False, detector_options=None, stream_name=None, recorder_options=None):
+        return (input_source, output, modulename, tuple(labels), safetyAssist, isTiny, id(inference), pipeline,
+                tuple(sorted((detector_options or {}).items())))
 
-        if VideoCamera.__selected_module__ == 'yoloOD' and VideoCamera.output is not None:
-            frameCount = 0
-            maxFrameCount = 30
-            outVidDir = VideoCamera.output
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            outframe = cv2.VideoWriter(outVidDir, fourcc, 20, (640, 480))
+    def importSmartAssistModule(self):
+        module = self.loaded_modules.get(self.selected_module)
+        if module is None:
+            sys.path.append(os.getcwd())
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(self.selected_module, '{}/modules/{}.py'.format(os.getcwd(), self.selected_module))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            # A race between two cameras only loads the module twice
+            module = self.loaded_modules.setdefault(self.selected_module, module)
+        if self.selected_module == 'yoloOD':
+            return module.SmartAssistModule(self.labels, self.isTiny, self.inference, metrics=self.metrics,
+                                            **self.detector_options)
+        return module.SmartAssistModule()
+    
 
-        font = cv2.FONT_HERSHEY_COMPLEX_SMALL
-        n_frame = 0
-        start_time = time.time()
+    def open_video(self):
         # Using OpenCV to capture from either from the camera view, or
         # a camera view
         try:
-            video = cv2.VideoCapture(int(VideoCamera.input_source))
+            video = cv2.VideoCapture(int(self.input_source))
         except:
-            video = cv2.VideoCapture(VideoCamera.input_source)
+            video = cv2.VideoCapture(self.input_source)
 
         if not video.isOpened():
             raise RuntimeError("Could not start the camera")
-        
+        return video
+
+    def queue_depths(self):
+        """Return the depth of each pipeline queue, empty when not pipelined."""
+        if self.stages is None:
+            return {}
+        return self.stages.depths()
+
+    def frames(self):
+        ai_frame = self.importSmartAssistModule()
+
+        video = self.open_video()
+        outframe = None
+        if self.selected_module == 'yoloOD' and self.output is not None:
+            # Webcams may not report their frame rate
+            outframe = EventRecorder(self.output, video.get(cv2.CAP_PROP_FPS) or 20.0, metrics=self.metrics,
+                                     **self.recorder_options)
+        isLive = self.input_source.isdigit()
+        isFile = os.path.isfile(self.input_source)
+        if isFile:
+            # Replayed files reuse the cached detections of the earlier plays
+            ai_frame.set_source(self.input_source)
+        if self.safety and isLive:
+            winLength = 11
+        else:
+            winLength = 21
+        if isFile:
+            # A buffer is decoded into again once the frames after it fill the capture,
+            # detect and encode queues and their workers
+            ring_size = 3 * (self.queue_size + 1) + 2 if self.pipeline else 1
+            fps = video.get(cv2.CAP_PROP_FPS) if self.pace_files else None
+            reader = PacedFileReader(video, fps, ring_size, self.metrics)
+        else:
+            # The pipeline copies the live frames, see pipelined_frames
+            fps = video.get(cv2.CAP_PROP_FPS)
+            reader = LatestFrameReader(video, 1, self.metrics)
+        if self.budget is not None:
+            # What the stream would process without a limit, unknown for unthrottled files
+            self.budget.source_fps = fps or None
+        try:
+            if self.pipeline:
+                yield from self.pipelined_frames(ai_frame, reader, outframe, winLength, not isFile)
+            else:
+                yield from self.sequential_frames(ai_frame, reader, outframe, winLength)
+        finally:
+            reader.release()
+            if not isFile:
+                stats = reader.stats()
+                print('Read {} frames, {} stale frames skipped'.format(stats['read'], stats['skipped']))
+            video.release()
+            ai_frame.close()
+            if outframe is not None:
+                outframe.release()
+                stats = outframe.stats()
+                print('Recorded {} events into {} files, {} frames dropped'.format(
+                    stats['events'], stats['segments'], stats['dropped']))
+
+    def throttle(self):
+        """Wait until the next frame is due under the frame rate limit of the governor."""
+        max_fps = self.budget.max_fps if self.budget is not None else None
+        if not max_fps:
+            return
+        now = time.time()
+        self.next_frame = max(self.next_frame + 1.0 / max_fps, now)
+        if self.next_frame > now:
+            time.sleep(self.next_frame - now)
+
+    def describe(self, ai_frame, image, n_frame, captured):
+        """Return the metadata of the frame just analysed, None without subscribers."""
+        if not self.metadata_wanted():
+            return None
+        height, width = image.shape[:2]
+        metadata = {'stream': self.stream_name, 'frame': n_frame, 'timestamp': captured, 'processed': time.time(),
+                    'width': width, 'height': height}
+        metadata.update(ai_frame.metadata())
+        return metadata
+
+    def should_draw(self, outframe):
+        """Whether the frame has to be drawn, for the viewers or for the recording."""
+        return not self.draw_on_demand or outframe is not None or self.video_wanted()
+
+    def record(self, outframe, frame, detected):
+        """Hand the frame to the recorder as a full size JPEG, which is returned so
+        that the full size rendition does not encode it again. Returns None when
+        not recording.
+        """
+        if outframe is None:
+            return None
+        with self.metrics.time('encode'):
+            _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        jpeg = jpeg.tobytes()
+        # Queued for the recorder thread, the clips are made from the stream JPEGs
+        outframe.write(jpeg, detected)
+        return jpeg
+
+    def sequential_frames(self, ai_frame, reader, outframe, winLength):
+        font = cv2.FONT_HERSHEY_COMPLEX_SMALL
+        n_frame = 0
+        start_time = time.time()
+        metrics = self.metrics
         while True:
-            success, image = video.read()
+            # The frame is drawn and published before the next one is read into its buffer
+            self.throttle()
+            success, image = reader.read()
+            captured = time.time()
             # We are using Motion JPEG, but OpenCV defaults to capture raw images,
             # so we must encode it into JPEG in order to correctly display the
             # video stream.
@@ -75,26 +208,88 @@ class VideoCamera(BaseCamera):
                 n_frame += 1
                 elapsed_time = time.time() - start_time
                 fps = n_frame/elapsed_time
+
+            # The FPS counter is drawn after the analysis so that the detector
+            # (and the motion gate) only sees the camera image
+            overlays, write = ai_frame.analyse(image, self.safety, winLength)
+            metadata = self.describe(ai_frame, image, n_frame, captured)
+            if not self.should_draw(outframe):
+                yield None, None, metadata
+                continue
+            with metrics.time('draw'):
                 cv2.putText(image, "FPS: " + str(round(fps, 2)), (10, 40), font, 1, (255, 255, 255), 2)
+                frame = ai_frame.render(image, overlays)
+            yield frame, self.record(outframe, frame, write), metadata
 
-            # Control the producing frame rate for process implementation
-            if VideoCamera.__selected_module__ == 'dummy_AI':
-                frame = ai_frame.img_detect(image)
-            else:
-                if VideoCamera.safety and VideoCamera.input_source.isdigit():
-                    frame, write = ai_frame.img_detect(image, VideoCamera.safety, winLength=11)
-                else:
-                    frame, write = ai_frame.img_detect(image, VideoCamera.safety, winLength=21)
-                if VideoCamera.output is not None:
-                    if write:
-                        frameCount = 0
-                    else:
-                        frameCount += 1
-
-                    if frameCount < maxFrameCount:
-                        outframe.write(frame)
-
-            _, jpeg = cv2.imencode('.jpg', frame)
-            yield jpeg.tobytes()
-        
-        video.release()
\ No newline at end of file
+    def pipelined_frames(self, ai_frame, reader, outframe, winLength, live):
+        """Run capture, detection + tracking and drawing on separate workers, the
+        camera thread encodes the renditions and the recorder writes the files on
+        its own thread. Live sources drop the oldest frame of a full queue so
+        that the stream stays current, files block so that every frame is processed.
+        As the capture of a live source never waits for the queues, its reused
+        buffer could be decoded into while the frame is still analysed or drawn,
+        so a live frame is copied before it enters the pipeline.
+        """
+        stages = Pipeline(self.budget.charge if self.budget is not None else None)
+        stages.add_queue('capture', self.queue_size, drop_oldest=live)
+        stages.add_queue('detect', self.queue_size, drop_oldest=live)
+        stages.add_queue('encode', self.queue_size, drop_oldest=live)
+        self.stages = stages
+        font = cv2.FONT_HERSHEY_COMPLEX_SMALL
+        metrics = self.metrics
+
+        def capture(emit):
+            n_frame = 0
+            start_time = time.time()
+            while True:
+                self.throttle()
+                success, image = reader.read()
+                if not success:
+                    break
+                captured = time.time()
+                if live:
+                    image = image.copy()
+                n_frame += 1
+                fps = n_frame/(captured - start_time)
+                if not emit('capture', (image, fps, n_frame, captured)):
+                    break
+
+        # The tracker is only updated by this single worker, in frame order
+        def detect(item, emit):
+            image, fps, n_frame, captured = item
+            overlays, write = ai_frame.analyse(image, self.safety, winLength)
+            # Described here, the tracks change with the next frame
+            metadata = self.describe(ai_frame, image, n_frame, captured)
+            emit('detect', (image, fps, overlays, write, metadata))
+
+        def encode(item, emit):
+            image, fps, overlays, write, metadata = item
+            if not self.should_draw(outframe):
+                emit('encode', (None, None, metadata))
+                return
+            with metrics.time('draw'):
+                cv2.putText(image, "FPS: " + str(round(fps, 2)), (10, 40), font, 1, (255, 255, 255), 2)
+                frame = ai_frame.render(image, overlays)
+            emit('encode', (frame, self.record(outframe, frame, write), metadata))
+
+        stages.add_source('capture', capture, ['capture'])
+        stages.add_stage('detect', detect, 'capture', ['detect'])
+        stages.add_stage('encode', encode, 'detect', ['encode'])
+
+        n_frame = 0
+        try:
+            while True:
+                item = stages.queues['encode'].get()
+                if item is None:
+                    break
+                yield item
+                n_frame += 1
+                if n_frame % 120 == 0:
+                    print('Pipeline queue depths: ' + ', '.join('{}={}/{} (dropped {})'.format(
+                        name, q['depth'], q['maxsize'], q['dropped']) for name, q in stages.depths().items()))
+        finally:
+            stages.stop()
+            stages.join()
+            self.stages = None
+        if stages.error is not None:
+            raise stages.error
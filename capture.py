@@ -0,0 +1,104 @@
+import threading
+import time
+
+from modules.inference.metrics import NULL_METRICS
+from modules.inference.preprocess import FrameRing
+
+
+class LatestFrameReader(object):
+    """
+    Reads a live source so that the consumer always gets its newest frame.
+
+    A background thread grabs the frames as fast as the source produces them,
+    so the driver buffer never fills up while the detector runs. `read` only
+    decodes the frame grabbed last, and the frames grabbed in between are
+    skipped and counted: however slow the consumer is, the frame it gets is
+    at most one grab old.
+
+    The frames are decoded into a `FrameRing` of `ring_size` buffers, at the
+    pace of the consumer, and the decoding is timed as the 'capture' stage.
+    """
+    def __init__(self, video, ring_size=1, metrics=None):
+        self.video = video
+        self.frames = FrameRing(ring_size)
+        self.metrics = metrics or NULL_METRICS
+        self.video_lock = threading.Lock()  # grab and retrieve can't run at the same time
+        self.condition = threading.Condition()
+        self.grabbed = 0
+        self.retrieved = 0  # the grab count at the last read
+        self.n_read = 0
+        self.skipped = 0
+        self.ended = False
+        self.running = True
+        self.thread = threading.Thread(target=self._thread, name='capture', daemon=True)
+        self.thread.start()
+
+    def read(self):
+        """Wait for a frame newer than the last one read, returns (success, frame) like `video.read()`."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.grabbed > self.retrieved or self.ended)
+            if self.grabbed == self.retrieved:
+                return False, None
+        with self.video_lock, self.metrics.time('capture'):
+            n_grabbed = self.grabbed
+            success, frame = self.frames.retrieve(self.video)
+        self.skipped += n_grabbed - self.retrieved - 1
+        self.retrieved = n_grabbed
+        self.n_read += success
+        return success, frame
+
+    def release(self):
+        """Stop grabbing, the video itself is released by its owner."""
+        with self.condition:
+            self.running = False
+        self.thread.join()
+
+    def stats(self):
+        return {'read': self.n_read, 'skipped': self.skipped}
+
+    def _thread(self):
+        while self.running:
+            with self.video_lock:
+                success = self.video.grab()
+            with self.condition:
+                if not success:
+                    self.ended = True
+                    self.condition.notify_all()
+                    break
+                self.grabbed += 1
+                self.condition.notify_all()
+
+
+class PacedFileReader(object):
+    """
+    Reads a video file in order, at most at `fps` frames per second, or as fast
+    as the consumer goes without `fps` (e.g. for offline analysis).
+
+    Every frame is delivered. A consumer that falls behind the pace is not
+    sent a burst of frames to catch up, the pace restarts from the late frame.
+    Only the decoding is timed as the 'capture' stage, not the waits.
+    """
+    def __init__(self, video, fps=None, ring_size=1, metrics=None):
+        self.video = video
+        self.frames = FrameRing(ring_size)
+        self.metrics = metrics or NULL_METRICS
+        self.period = 1.0 / fps if fps else 0.0
+        self.due = None
+        self.n_read = 0
+
+    def read(self):
+        with self.metrics.time('capture'):
+            success, frame = self.frames.read(self.video)
+        if success and self.period:
+            now = time.time()
+            self.due = now if self.due is None else max(self.due + self.period, now - self.period)
+            if self.due > now:
+                time.sleep(self.due - now)
+        self.n_read += success
+        return success, frame
+
+    def release(self):
+        pass
+
+    def stats(self):
+        return {'read': self.n_read, 'skipped': 0}
@@ -0,0 +1,72 @@
+"""Command line options of the yoloOD detector, shared by the servers and the batch processing."""
+
+
+def add_detector_arguments(parser):
+    """Add the options of the yoloOD detector and tracker to an argument parser."""
+    parser.add_argument('--classes', default=None, help='[Only work if -m yoloOD] Store class names here')
+    parser.add_argument('--isTiny', help='[Only work if -m yoloOD] yolov3 or yolov3-tiny', action='store_true')
+    parser.add_argument('--safetyAssist', help='[Only work if -m yoloOD] Turn on Safety Assist \
+                                                to get the object movement status', action='store_true')
+    parser.add_argument('--keyframeInterval', type=int, default=1, help='[Only work if -m yoloOD] Run the detector \
+                                                on every Nth frame and propagate the tracks in between')
+    parser.add_argument('--latencyBudget', type=float, default=None, help='[Only work if -m yoloOD] Target mean \
+                                                processing time per frame in ms, the detector runs as often as it fits')
+    parser.add_argument('--opticalFlow', help='[Only work with --keyframeInterval or --latencyBudget] Refine the \
+                                                propagated tracks with optical flow', action='store_true')
+    parser.add_argument('--motionThreshold', type=float, default=None, help='[Only work if -m yoloOD] Skip the \
+                                                detector while less than this fraction of the pixels changes \
+                                                (e.g. 0.002), and only detect in the changed region when it is small')
+    parser.add_argument('--tileSize', type=int, default=None, help='[Only work if -m yoloOD] Detect on overlapping \
+                                                tiles of this many frame pixels, plus the whole frame, in one batch')
+    parser.add_argument('--tileOverlap', type=float, default=0.2, help='[Only work with --tileSize] Fraction of a \
+                                                tile that overlaps its neighbours')
+    parser.add_argument('--roi', action='append', default=[], help='[Only work with --tileSize] x,y,w,h area to \
+                                                detect in instead of the whole frame, can be repeated')
+    parser.add_argument('--activeTiles', help='[Only work with --tileSize] Only detect on the tiles holding a known \
+                                                object, and on all of them every 10 frames', action='store_true')
+    parser.add_argument('--letterbox', help='[Only work if -m yoloOD] Keep the aspect ratio of the frames in the \
+                                                network input, with borders, instead of stretching them',
+                        action='store_true')
+    parser.add_argument('--detectionCache', default=None, metavar='DIR', help='[Only work if -m yoloOD] Cache the \
+                                                detections of the video files in this directory, so that replaying \
+                                                a file skips the network')
+    parser.add_argument('--detectionCacheSize', type=int, default=1024, help='[Only work with --detectionCache] \
+                                                Maximum size of the cache in MB, the least recently used videos go first')
+    parser.add_argument('--backend', default='opencv', choices=['opencv', 'openvino', 'onnx'], help='[Only work if \
+                                                -m yoloOD] Runtime of the detector network')
+    parser.add_argument('--target', default='cpu', choices=['cpu', 'cpu_fp16', 'opencl', 'opencl_fp16'],
+                        help='[Only work with --backend opencv/openvino] OpenCV DNN target')
+    parser.add_argument('--threads', type=int, default=None, help='[Only work if -m yoloOD] Number of threads of \
+                                                the detector runtime, e.g. the cores divided by the processes')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'int8'], help='[Only work with --backend \
+                                                onnx] int8 runs a dynamically quantized copy of the model')
+    parser.add_argument('--onnxModel', default=None, help='[Only work with --backend onnx] ONNX export of the \
+                                                network, taking the same 416x416 blob and returning YOLO rows')
+
+def parse_labels(classes):
+    """Return the lower case class names of --classes, an empty list for all the classes."""
+    if classes == None:
+        return []
+    return [i.strip().lower() for i in classes.split(',')]
+
+def parse_detector_options(parser, args):
+    """Return the keyword arguments of `yoloOD.SmartAssistModule` from the parsed options."""
+    detector_options = {'keyframe_interval': args.keyframeInterval, 'latency_budget': args.latencyBudget,
+                        'optical_flow': args.opticalFlow, 'motion_threshold': args.motionThreshold,
+                        'letterbox': args.letterbox, 'cache_dir': args.detectionCache,
+                        'cache_mb': args.detectionCacheSize}
+    if args.tileSize:
+        try:
+            rois = tuple(tuple(int(v) for v in roi.split(',')) for roi in args.roi)
+        except ValueError:
+            parser.error('--roi expects x,y,w,h')
+        if any(len(roi) != 4 for roi in rois):
+            parser.error('--roi expects x,y,w,h')
+        detector_options.update({'tile_size': args.tileSize, 'tile_overlap': args.tileOverlap,
+                                 'rois': rois or None, 'active_tiles': args.activeTiles})
+    if args.backend == 'onnx' and args.onnxModel is None:
+        parser.error('--backend onnx needs --onnxModel')
+    from modules.inference.backends import BackendConfig
+    detector_options['backend'] = BackendConfig(args.backend, args.target, args.threads, args.precision,
+                                                args.onnxModel if args.backend == 'onnx' else None)
+    return detector_options
@@ -15,29 +15,46 @@
 # 3. Navigate the browser to the local webpage.
 # 4. use http://127.0.0.1:5010/video_feed to watch the video
 
-from flask import Flask, render_template, Response
+from flask import Flask, render_template, Response, abort, jsonify, request
+from base_camera import BaseCamera, rendition_key
 from camera import VideoCamera
+from modules.inference.metrics import registry as metrics_registry
+from detector_args import add_detector_arguments, parse_detector_options, parse_labels
+from governor import AdmissionError, ResourceGovernor, POLICIES, parse_cpus
+import os
 import time
 import argparse
+import threading
 
 #Can be any module from modules directory. Runtime can specify from command line args
 default_active_module = 'dummy_AI'
 active_module = default_active_module
+#Named input sources served on /video_feed/<stream_id>, set with --stream
+streams = {}
+#Set once the model is loaded and warmed up, see /ready
+ready = threading.Event()
+load_error = None
+#Seconds a client refused by the admission control is told to wait before retrying
+RETRY_AFTER = 10
 
 app = Flask(__name__)
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', streams=sorted(streams))
 
-def gen(camera):
+def gen(camera, rendition=('full', None)):
     target_frames = 120
     n_frames = 0
     prev = 0
+    generation = 0
     while True:
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+        # Every client shares the same multipart bytes, a slow client skips to the newest frame
+        generation, frame, part = camera.wait_frame(generation, rendition)
+        if frame is None:
+            # the camera has stopped (end of the video or inactivity)
+            break
+        yield part
         # My implementation that checks the fps of the output
         n_frames += 1
         if n_frames == target_frames:
@@ -46,42 +63,268 @@ def gen(camera):
             prev = time.time()
             n_frames = 0
 
+def gen_metadata(camera, sse=True):
+    generation = 0
+    while True:
+        # The JSON of a frame is encoded once for every subscriber
+        generation, metadata, line = camera.wait_metadata(generation)
+        if metadata is None:
+            break
+        yield b'data: ' + line + b'\n\n' if sse else line + b'\n'
+
+def metadata_mimetype(format):
+    """Return the content type of a metadata `?format=`, raises ValueError for an unknown one."""
+    mimetypes = {'sse': 'text/event-stream', 'jsonl': 'application/x-ndjson'}
+    if format not in mimetypes:
+        raise ValueError('Unknown format {}, use one of {}'.format(format, ', '.join(mimetypes)))
+    return mimetypes[format]
+
+def stream_output(stream_id):
+    """Each named stream records into its own file next to --output."""
+    if output is None or stream_id is None:
+        return output
+    root, ext = os.path.splitext(output)
+    return '{}_{}{}'.format(root, stream_id, ext)
+
+def get_camera(stream_id=None):
+    """Return the running camera of a stream (None for the --input source), or None if the id is unknown."""
+    if stream_id is None:
+        source = input_source
+    elif stream_id in streams:
+        source = streams[stream_id]
+    else:
+        return None
+    return VideoCamera.get(source, stream_output(stream_id), active_module, labels, isSafetyTurnedOn, isTiny,
+                           inference, isPipelined, detector_options, stream_id or 'default', recorder_options)
+
+@app.route('/ready')
+def readiness():
+    """200 once the model is loaded and warmed up, 503 while it is loading."""
+    status, body = readiness_status()
+    return Response(body, status=status, mimetype='text/plain')
+
+def readiness_status():
+    if load_error is not None:
+        return 500, 'error: {}'.format(load_error)
+    if ready.is_set():
+        return 200, 'ready'
+    return 503, 'loading'
+
+def warm_start():
+    """Load the network into the model cache and run a first forward pass, so that
+    the cameras started for the viewers do not pay for it.
+    """
+    global load_error
+    try:
+        if active_module == 'yoloOD' and inference_workers:
+            # The workers load their own networks
+            start = time.time()
+            inference.wait_ready()
+            print("{} inference workers ready in {:.0f} ms".format(inference_workers, (time.time() - start) * 1000))
+        elif active_module == 'yoloOD':
+            from modules.yoloOD import load_model
+            start = time.time()
+            model = load_model(isTiny, detector_options.get('backend'))
+            model.warm_up()
+            print("Model loaded in {:.0f} ms, ready in {:.0f} ms".format(model.load_ms, (time.time() - start) * 1000))
+        ready.set()
+    except Exception as e:
+        load_error = e
+        print("Could not load the model: {}".format(e))
+
+@app.route('/metrics')
+def metrics():
+    """The stage latency histograms of every stream, for Prometheus."""
+    if not metrics_registry.enabled:
+        abort(404)
+    return Response(metrics_registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics.json')
+def metrics_json():
+    """The stage latencies of every stream over the last minute: rate, mean, percentiles and busy fraction."""
+    if not metrics_registry.enabled:
+        abort(404)
+    return jsonify(metrics_registry.snapshot())
+
+@app.route('/load')
+def load():
+    """The CPU capacity, load and admitted streams of the server, for placing streams across hosts."""
+    if BaseCamera.governor is None:
+        abort(404)
+    return jsonify(BaseCamera.governor.snapshot())
+
+@app.errorhandler(AdmissionError)
+def not_admitted(e):
+    return Response(str(e), status=503, mimetype='text/plain', headers={'Retry-After': str(RETRY_AFTER)})
+
 @app.route('/video_feed')
-def video_feed():
-    return Response(gen(VideoCamera(input_source, output, active_module, labels, isSafetyTurnedOn, isTiny)),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+@app.route('/video_feed/<stream_id>')
+def video_feed(stream_id=None):
+    """The MJPEG stream. `?size=half` or `quarter` and `?fps=1`, `5` or `10` select a
+    smaller or slower rendition, encoded once for all the viewers that ask for it.
+    """
+    try:
+        rendition = rendition_key(request.args.get('size'), request.args.get('fps'))
+    except ValueError as e:
+        abort(400, str(e))
+    camera = get_camera(stream_id)
+    if camera is None:
+        abort(404)
+    return Response(gen(camera, rendition), mimetype='multipart/x-mixed-replace; boundary=frame')
 
-if __name__ == '__main__':
+@app.route('/metadata')
+@app.route('/metadata/<stream_id>')
+def metadata_feed(stream_id=None):
+    """The detections and confirmed tracks of every frame of a stream, as Server-Sent
+    Events or, with `?format=jsonl`, as one JSON object per line.
+    """
+    try:
+        mimetype = metadata_mimetype(request.args.get('format', 'sse'))
+    except ValueError as e:
+        abort(400, str(e))
+    camera = get_camera(stream_id)
+    if camera is None:
+        abort(404)
+    return Response(gen_metadata(camera, mimetype == 'text/event-stream'), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache'})
+
+def build_parser():
     #Creating an argumnet parser so that we can select the module from the modules directory.
     #By default the base module is used. But then just select the one you want. For examle
     # python .\flask_videoserver.py
     # python .\flask_videoserver.py -m yoloOD
     # python .\flask_videoserver.py -m yoloOD --classes Person,Truck,Car --safetyAssist
     # python .\flask_videoserver.py -m yoloOD --input 0 --output ./videos/result.mp4 --safetyAssist --isTiny
+    # python .\flask_videoserver.py -m yoloOD --batchSize 8 --maxWait 10
+    # python .\flask_videoserver.py -m yoloOD --pipeline
+    # python .\flask_videoserver.py -m yoloOD --stream gate=0 --stream yard=./videos/Gantry4.mp4 --inferenceWorkers 4
+    # python .\flask_videoserver.py -m yoloOD --stream gate=0 --stream yard=./videos/Gantry4.mp4 --batchSize 2
+    # python .\flask_videoserver.py -m yoloOD --safetyAssist --keyframeInterval 5 --opticalFlow
+    # python .\flask_videoserver.py -m yoloOD --stream gate=0 --metrics
+    # python .\flask_videoserver.py -m yoloOD --safetyAssist --drawOnDemand
+    # python .\flask_videoserver.py -m yoloOD --stream gate=0 --stream yard=1 --admission degrade --cpuBudget 4
     # python .\flask_videoserver.py -h
     parser = argparse.ArgumentParser(description='Can specify the SmartAssist module to be used with the video source, \
                                                      and select the video source to be used.')
     parser.add_argument('--input', default='./videos/Gantry4.mp4', help='Input source')
-    parser.add_argument('--output', default=None, help='Specify the output path if you want to save the stream video')
+    parser.add_argument('--stream', action='append', default=[], metavar='ID=SOURCE', help='Add an input source \
+                                                served on /video_feed/ID, can be repeated')
+    parser.add_argument('--output', default=None, help='Specify the output path if you want to save the stream video. \
+                                                The clips around the detections are written next to it')
+    parser.add_argument('--preRoll', type=float, default=5.0, help='[Only work with --output] Seconds recorded \
+                                                before the detection that starts a clip')
+    parser.add_argument('--postRoll', type=float, default=2.0, help='[Only work with --output] Seconds without \
+                                                detection that end a clip')
+    parser.add_argument('--segmentLength', type=float, default=60.0, help='[Only work with --output] Maximum \
+                                                seconds per clip file, longer events go on in the next file')
     parser.add_argument('-m', '--module', default=default_active_module, help='SmartAssist module to use when processing \
                                                                                 video. Available modules: dummy_AI, yoloOD')
-    parser.add_argument('--classes', default=None, help='[Only work if -m yoloOD] Store class names here')
-    parser.add_argument('--isTiny', help='[Only work if -m yoloOD] yolov3 or yolov3-tiny', action='store_true')
-    parser.add_argument('--safetyAssist', help='[Only work if -m yoloOD] Turn on Safety Assist \
-                                                to get the object movement status', action='store_true')
-    args = parser.parse_args()
-    
+    add_detector_arguments(parser)
+    parser.add_argument('--batchSize', type=int, default=0, help='[Only work if -m yoloOD] Share one network between \
+                                                all the streams and batch up to this many frames per forward pass')
+    parser.add_argument('--maxWait', type=float, default=10, help='[Only work with --batchSize] Maximum time in ms \
+                                                a frame waits for the batch to fill')
+    parser.add_argument('--inferenceWorkers', type=int, default=0, help='[Only work if -m yoloOD] Run the network \
+                                                in this many processes shared by all the streams, the frames are \
+                                                passed through shared memory')
+    parser.add_argument('--pipeline', help='Run capture, detection, encoding and file writing on separate threads',
+                        action='store_true')
+    parser.add_argument('--jpegQuality', type=int, default=80, help='JPEG quality (0-100) of the streams and of \
+                                                the recorded frames')
+    parser.add_argument('--unthrottled', help='Process the video files as fast as possible (e.g. for offline \
+                                                analysis) instead of at their frame rate', action='store_true')
+    parser.add_argument('--drawOnDemand', help='Only draw and encode the frames while someone watches the video, \
+                                                e.g. when only the /metadata feed is used', action='store_true')
+    parser.add_argument('--metrics', help='Record the time spent in each stage of every stream, served on \
+                                                /metrics (Prometheus) and /metrics.json', action='store_true')
+    parser.add_argument('--admission', default=None, choices=POLICIES, help='Keep the streams within the CPU budget, \
+                                                a new stream that does not fit is rejected, queued until another \
+                                                one stops, or admitted by lowering the fps of every stream. The \
+                                                load is served on /load')
+    parser.add_argument('--cpuBudget', type=float, default=None, help='[Only work with --admission] Cores the \
+                                                streams may use, all the usable cores by default')
+    parser.add_argument('--cpus', default=None, help='Run the server on these cores only, e.g. 0-3,6 (Linux)')
+    parser.add_argument('--streamCost', type=float, default=1.0, help='[Only work with --admission] Cores a \
+                                                stream is expected to use until streams have been measured')
+    parser.add_argument('--minFps', type=float, default=1.0, help='[Only work with --admission degrade] Lowest \
+                                                frame rate a stream is degraded to')
+    parser.add_argument('--admissionTimeout', type=float, default=30.0, help='[Only work with --admission queue] \
+                                                Seconds a new stream waits for room before it is rejected')
+    parser.add_argument('--host', default='0.0.0.0', help='Address the server listens on')
+    parser.add_argument('--port', type=int, default=5010, help='Port the server listens on')
+    return parser
+
+def configure(parser, args, serving=True):
+    """Set up the streams, module and options shared by every server entry point.
+    The inference services and the governor are only started, and the network only
+    loaded, in the process `serving` the requests, not in the parent process of the
+    debug reloader.
+    """
+    global input_source, output, active_module, isSafetyTurnedOn, isTiny, isPipelined, detector_options
+    global labels, inference, recorder_options, inference_workers
     #Set up which module we will use...
     input_source = args.input
+    for stream in args.stream:
+        stream_id, _, source = stream.partition('=')
+        if not source:
+            parser.error('--stream expects ID=SOURCE, got {}'.format(stream))
+        streams[stream_id.strip()] = source.strip()
     output = args.output
+    recorder_options = {'pre_roll': args.preRoll, 'post_roll': args.postRoll, 'segment_length': args.segmentLength}
     active_module = args.module
     isSafetyTurnedOn = args.safetyAssist
     isTiny = args.isTiny
-    if args.classes == None:
-        labels = []
-    else:
-        labels = [i.strip().lower() for i in args.classes.split(',')]
+    isPipelined = args.pipeline
+    metrics_registry.enabled = args.metrics
+    BaseCamera.jpeg_quality = args.jpegQuality
+    VideoCamera.draw_on_demand = args.drawOnDemand
+    VideoCamera.pace_files = not args.unthrottled
+    detector_options = {}
+    if active_module == 'yoloOD':
+        detector_options = parse_detector_options(parser, args)
+    labels = parse_labels(args.classes)
+    inference = None
+    inference_workers = 0
+    if args.batchSize > 0 and args.inferenceWorkers > 0:
+        parser.error('--batchSize and --inferenceWorkers can not be combined')
+    if serving and active_module == 'yoloOD' and args.inferenceWorkers > 0:
+        from modules.yoloOD import model_files, CONFIDENCE_THRESHOLD
+        from modules.inference.workers import ProcessInferenceService
+        inference_workers = args.inferenceWorkers
+        inference = ProcessInferenceService(*model_files(isTiny, detector_options['backend']),
+                                            backend=detector_options['backend'], workers=inference_workers,
+                                            letterbox=detector_options['letterbox'],
+                                            score_threshold=CONFIDENCE_THRESHOLD)
+    elif serving and active_module == 'yoloOD' and args.batchSize > 0:
+        from modules.yoloOD import load_model
+        from modules.inference.batching import BatchInferenceService
+        model = load_model(isTiny, detector_options['backend'])
+        inference = BatchInferenceService(model, batch_size=args.batchSize, max_wait_ms=args.maxWait,
+                                          letterbox=detector_options['letterbox'])
+    if args.cpus is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            parser.error('--cpus is not supported on this platform')
+        try:
+            os.sched_setaffinity(0, parse_cpus(args.cpus))
+        except (ValueError, OSError) as e:
+            parser.error('--cpus: {}'.format(e))
+    BaseCamera.governor = None
+    if args.admission is not None and serving:
+        # The thread count of the networks is left alone when it is set, or when they run in other processes
+        manage_threads = args.threads is None and inference_workers == 0
+        BaseCamera.governor = ResourceGovernor(args.cpuBudget, args.admission, args.streamCost, args.minFps,
+                                               args.admissionTimeout, manage_threads)
+    # Eager loading, the server answers /ready meanwhile
+    if serving:
+        threading.Thread(target=warm_start, daemon=True).start()
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    # With debug, Werkzeug's reloader serves from a child process (which it marks
+    # with WERKZEUG_RUN_MAIN) and the parent process only restarts it on changes
+    configure(parser, args, serving=os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
     
     # app.run(host='0.0.0.0', debug=True)
     # app.run(host='127.0.0.1', port=5010, debug=True)
-    app.run(host='0.0.0.0', port=5010, debug=True)
\ No newline at end of file
+    app.run(host=args.host, port=args.port, debug=True)
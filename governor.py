@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+
+import cv2
+
+# What to do with a new stream that does not fit in the CPU budget
+POLICIES = ('reject', 'queue', 'degrade')
+
+
+class AdmissionError(RuntimeError):
+    """A new stream that does not fit in the CPU budget of the server."""
+
+
+def usable_cores():
+    """Return the number of cores the process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parse_cpus(text):
+    """Return the set of cores of a list like `0-3,6`, raises ValueError for an invalid one."""
+    cpus = set()
+    for part in text.split(','):
+        low, _, high = part.strip().partition('-')
+        low, high = int(low), int(high or low)
+        if low < 0 or high < low:
+            raise ValueError('Invalid core range {}'.format(part))
+        cpus.update(range(low, high + 1))
+    return cpus
+
+
+class StreamBudget(object):
+    """
+    The CPU accounting and the limits of one admitted stream.
+
+    The threads of the stream `charge` the CPU time they spend on its frames.
+    The governor turns it into `cost`, the cores the stream uses, by sharing
+    out the CPU time of the whole process in proportion, so that the threads
+    of OpenCV are paid for too. Until it is measured, a stream is expected to
+    use `estimate` cores. What it would use freely is its CPU time per frame
+    at the `source_fps` of its source, or at the frame rate it reached
+    without a limit when the source has none (e.g. an unthrottled file).
+    The stream is held to `max_fps` frames per second, None when it runs freely.
+    """
+    smoothing = 0.5
+
+    def __init__(self, name, estimate):
+        self.name = name
+        self.estimate = estimate
+        self.admitted = time.time()
+        self.lock = threading.Lock()  # charged by the camera and pipeline threads
+        self.cpu = 0.0  # charged since the last sample
+        self.frames = 0
+        self.cost = None
+        self.fps = 0.0
+        self.source_fps = None  # set by the camera for the paced sources
+        self.natural_fps = None  # the frame rate measured without a limit
+        self.max_fps = None
+        self.threads = None
+
+    def charge(self, cpu_seconds, frames=0):
+        with self.lock:
+            self.cpu += cpu_seconds
+            self.frames += frames
+
+    def take(self):
+        """Return and reset the (cpu seconds, frames) charged since the last call."""
+        with self.lock:
+            cpu, frames = self.cpu, self.frames
+            self.cpu, self.frames = 0.0, 0
+        return cpu, frames
+
+    def update(self, cost, fps):
+        if self.cost is None:
+            self.cost, self.fps = cost, fps
+        else:
+            self.cost += self.smoothing * (cost - self.cost)
+            self.fps += self.smoothing * (fps - self.fps)
+        if self.max_fps is None:
+            self.natural_fps = self.fps
+
+    def frame_cost(self):
+        """The CPU seconds of a frame, None until measured."""
+        if self.cost is None or not self.fps:
+            return None
+        return self.cost / self.fps
+
+    def full_cost(self):
+        """The cores the stream would use without a limit."""
+        if self.frame_cost() is None:
+            return self.estimate if self.cost is None else self.cost
+        return self.frame_cost() * (self.source_fps or self.natural_fps)
+
+    def cost_at(self, fps):
+        """The cores the stream would use at `fps`, its estimate until measured."""
+        frame_cost = self.frame_cost()
+        return self.estimate if frame_cost is None else frame_cost * fps
+
+    def summary(self):
+        return {'name': self.name, 'admitted': self.admitted, 'cost': self.cost, 'full_cost': self.full_cost(),
+                'fps': self.fps, 'source_fps': self.source_fps, 'max_fps': self.max_fps, 'threads': self.threads}
+
+
+class ResourceGovernor(object):
+    """
+    Keeps the streams of the server within a budget of `capacity` cores.
+
+    Each camera is admitted before it starts, and charges its `StreamBudget`
+    with the CPU time of its frames. Every `interval` seconds the governor
+    measures the CPU used by the process and shares it out between the
+    streams, so it knows what each stream costs and what a new one is
+    likely to cost (the mean of the streams, `stream_cost` cores before any
+    is measured).
+
+    A new stream that would take the committed cores above the capacity is,
+    by `policy`:
+    - 'reject': refused with an `AdmissionError`.
+    - 'queue': held until streams stop and make room, refused after
+      `queue_timeout` seconds.
+    - 'degrade': admitted, and the capacity is shared out evenly: the
+      streams that need more than their share are held to the frame rate
+      that fits in it, not below `min_fps`. It is only refused when the
+      streams would not fit even at `min_fps`.
+    A stream is always admitted when it is the only one.
+
+    With `manage_threads`, the OpenCV thread count (shared by the whole
+    process) is the capacity split between the admitted streams, so that
+    their forward passes do not oversubscribe the cores.
+    The CPU of the inference worker processes is not measured.
+    """
+    def __init__(self, capacity=None, policy='reject', stream_cost=1.0, min_fps=1.0, queue_timeout=30.0,
+                 manage_threads=True, interval=2.0):
+        if policy not in POLICIES:
+            raise ValueError('Unknown admission policy {}, use one of {}'.format(policy, ', '.join(POLICIES)))
+        self.capacity = capacity or usable_cores()
+        self.policy = policy
+        self.stream_cost = stream_cost
+        self.min_fps = min_fps
+        self.queue_timeout = queue_timeout
+        self.manage_threads = manage_threads
+        self.interval = interval
+        self.streams = []
+        self.queued = 0
+        self.rejected = 0
+        self.load = 0.0  # cores used by the process over the last interval
+        self.threads = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._thread, name='governor', daemon=True)
+        self.thread.start()
+
+    def admit(self, name):
+        """Return the budget of a new stream, or raise `AdmissionError` when it does not fit."""
+        with self.condition:
+            if self.policy == 'queue':
+                self.queued += 1
+                try:
+                    fits = self.condition.wait_for(lambda: self._fits(self.estimate()), self.queue_timeout)
+                finally:
+                    self.queued -= 1
+            else:
+                fits = self._fits(self.estimate())
+            estimate = self.estimate()
+            if not fits:
+                self.rejected += 1
+                raise AdmissionError('The server is full: {:.2f} of {:.2f} cores committed, the stream {} needs '
+                                     'about {:.2f}'.format(self.committed(), self.capacity, name, estimate))
+            budget = StreamBudget(name, estimate)
+            self.streams.append(budget)
+            self._plan()
+            return budget
+
+    def release(self, budget):
+        """Forget a stream that stopped, a queued stream may take its place."""
+        with self.condition:
+            if budget in self.streams:
+                self.streams.remove(budget)
+                self._plan()
+                self.condition.notify_all()
+
+    def estimate(self):
+        """The cores a new stream is expected to use: the mean of the measured streams."""
+        costs = [budget.full_cost() for budget in self.streams if budget.cost is not None]
+        return sum(costs) / len(costs) if costs else self.stream_cost
+
+    def committed(self):
+        """The cores the admitted streams use at their natural frame rate."""
+        return sum(budget.full_cost() for budget in self.streams)
+
+    def snapshot(self):
+        """Return the capacity, load and admitted streams, for the /load view."""
+        with self.condition:
+            committed = self.committed()
+            return {'capacity': self.capacity, 'load': self.load, 'committed': committed,
+                    'available': max(self.capacity - committed, 0.0), 'estimate': self.estimate(),
+                    'policy': self.policy, 'threads': self.threads, 'queued': self.queued,
+                    'rejected': self.rejected, 'streams': [budget.summary() for budget in self.streams]}
+
+    def _fits(self, estimate):
+        """Whether a new stream of `estimate` cores fits. Called with the condition held."""
+        if not self.streams or self.committed() + estimate <= self.capacity:
+            return True
+        if self.policy != 'degrade':
+            return False
+        frame_costs = [budget.frame_cost() for budget in self.streams if budget.frame_cost() is not None]
+        new_cost = self.min_fps * sum(frame_costs) / len(frame_costs) if frame_costs else estimate
+        return sum(budget.cost_at(self.min_fps) for budget in self.streams) + new_cost <= self.capacity
+
+    def _plan(self):
+        """Set the frame rate limits and the thread count of the streams. Called with the condition held."""
+        for budget in self.streams:
+            budget.max_fps = None
+        if self.policy == 'degrade' and self.committed() > self.capacity:
+            # The cheapest streams run freely if they fit in their share, what
+            # they leave is shared out between the others
+            remaining = self.capacity
+            streams = sorted(self.streams, key=lambda budget: budget.full_cost())
+            for i, budget in enumerate(streams):
+                share = remaining / (len(streams) - i)
+                frame_cost = budget.frame_cost()
+                if frame_cost is not None and budget.full_cost() > share:
+                    budget.max_fps = max(share / frame_cost, self.min_fps)
+                    remaining -= budget.cost_at(budget.max_fps)
+                else:
+                    remaining -= budget.full_cost()
+        threads = max(int(self.capacity // max(len(self.streams), 1)), 1)
+        for budget in self.streams:
+            budget.threads = threads
+        if self.manage_threads and threads != self.threads:
+            cv2.setNumThreads(threads)
+        self.threads = threads
+
+    def _thread(self):
+        """Sampling background thread: measures the load and the cost of each stream."""
+        last_cpu, last_time = time.process_time(), time.time()
+        while True:
+            time.sleep(self.interval)
+            cpu, now = time.process_time(), time.time()
+            elapsed = max(now - last_time, 1e-6)
+            load = (cpu - last_cpu) / elapsed
+            last_cpu, last_time = cpu, now
+            with self.condition:
+                self.load = load
+                samples = [(budget,) + budget.take() for budget in self.streams]
+                total = sum(stream_cpu for _, stream_cpu, _ in samples)
+                for budget, stream_cpu, frames in samples:
+                    # A stream that is still opening its source has nothing to measure yet
+                    if frames and total > 0:
+                        budget.update(load * stream_cpu / total, frames / elapsed)
+                self._plan()
+                self.condition.notify_all()
@@ -16,6 +16,30 @@ class SmartAssistModule(object):
             self.frame = cv2.resize(self.frame, self.frame_size)
         return self.frame
     
+    #Split of img_detect used by the pipelined camera: analyse runs on the detection
+    #worker and returns what render needs to draw the frame on the encoding worker
+    def analyse(self, frame, *args):
+        self.load_image(frame)
+        return None, False
+
+    #Called with the path of the video file that the frames come from, in order from first_frame
+    def set_source(self, path, first_frame=0):
+        pass
+
+    #Called once the source is done with
+    def close(self):
+        pass
+
+    #The results of the last analysed frame, sent to the metadata subscribers as JSON
+    def metadata(self):
+        return {'detected': False, 'detections': [], 'tracks': []}
+
+    def render(self, frame, overlays):
+        height, width, _ = frame.shape
+        if height > self.frame_size[1] and width > self.frame_size[0]:
+            frame = cv2.resize(frame, self.frame_size)
+        return frame
+
     #Takes the frame from the thread and the implementation can keep copy to process
     def load_image(self, frame):
         self.frame = frame
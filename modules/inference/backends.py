@@ -0,0 +1,128 @@
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+
+def read_network(weights, cfg):
+    """Load a Darknet network and return it with the names of its output layers."""
+    net = cv2.dnn.readNet(weights, cfg)
+    layer_names = net.getLayerNames()
+    output_layers = [layer_names[i - 1] for i in np.asarray(net.getUnconnectedOutLayers()).reshape(-1)]
+    return net, output_layers
+
+BackendConfig = namedtuple('BackendConfig', ['name', 'target', 'threads', 'precision', 'onnx_model'])
+BackendConfig.__new__.__defaults__ = ('opencv', 'cpu', None, 'fp32', None)
+BackendConfig.__doc__ = """
+How the detector network runs, also part of its model cache key.
+
+name: str
+    'opencv' (OpenCV DNN), 'openvino' (OpenCV DNN with the Inference Engine backend)
+    or 'onnx' (ONNX Runtime on the CPU, needs the optional `onnxruntime` package).
+target: str
+    The OpenCV DNN target: 'cpu', 'cpu_fp16', 'opencl' or 'opencl_fp16'.
+threads: int
+    The number of threads of the runtime, None for its default.
+precision: str
+    'fp32', or 'int8' to run an ONNX model dynamically quantized to 8 bit weights.
+onnx_model: str
+    The path of the ONNX export of the network, for the 'onnx' backend.
+"""
+
+OPENCV_BACKENDS = {
+    'opencv': cv2.dnn.DNN_BACKEND_OPENCV,
+    'openvino': cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE,
+}
+OPENCV_TARGETS = {
+    'cpu': cv2.dnn.DNN_TARGET_CPU,
+    'opencl': cv2.dnn.DNN_TARGET_OPENCL,
+    'opencl_fp16': cv2.dnn.DNN_TARGET_OPENCL_FP16,
+}
+if hasattr(cv2.dnn, 'DNN_TARGET_CPU_FP16'):
+    OPENCV_TARGETS['cpu_fp16'] = cv2.dnn.DNN_TARGET_CPU_FP16
+
+
+class OpenCVBackend(object):
+    """
+    A Darknet network run by OpenCV DNN with an explicit backend and target.
+
+    `cv2.setNumThreads` applies to the whole process, so the last backend
+    created with `threads` sets the thread count of every OpenCV network.
+    """
+    def __init__(self, weights, cfg, config):
+        if config.name not in OPENCV_BACKENDS:
+            raise ValueError('Unknown OpenCV backend {}, use one of {}'.format(config.name, sorted(OPENCV_BACKENDS)))
+        if config.target not in OPENCV_TARGETS:
+            raise ValueError('Unknown target {}, use one of {}'.format(config.target, sorted(OPENCV_TARGETS)))
+        if config.precision != 'fp32':
+            raise ValueError('The OpenCV backends run fp32, or fp16 with the cpu_fp16 and opencl_fp16 targets')
+        self.net, self.output_layers = read_network(weights, cfg)
+        self.net.setPreferableBackend(OPENCV_BACKENDS[config.name])
+        self.net.setPreferableTarget(OPENCV_TARGETS[config.target])
+        if config.threads:
+            cv2.setNumThreads(config.threads)
+
+    def forward(self, blob):
+        """Return the output layers for an NCHW blob, as `net.forward` does."""
+        self.net.setInput(blob)
+        return self.net.forward(self.output_layers)
+
+
+def quantized_path(model_path):
+    root, ext = os.path.splitext(model_path)
+    return '{}.int8{}'.format(root, ext)
+
+
+class OnnxBackend(object):
+    """
+    An ONNX export of the network run by ONNX Runtime on the CPU.
+
+    The model takes the same NCHW blob as the Darknet network and returns
+    YOLO rows (cx, cy, w, h, objectness, class scores...) normalized to the
+    input, as one or more outputs of shape (N, rows, 5 + n_classes). With the
+    'int8' precision, the weights are quantized once next to the model file.
+    """
+    def __init__(self, model_path, config):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend needs the onnxruntime package: pip install onnxruntime')
+        if config.precision not in ('fp32', 'int8'):
+            raise ValueError('The onnx backend runs fp32 or int8')
+        if config.precision == 'int8':
+            model_path = self.quantize(model_path)
+        options = onnxruntime.SessionOptions()
+        if config.threads:
+            options.intra_op_num_threads = config.threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_layers = [output.name for output in self.session.get_outputs()]
+
+    @staticmethod
+    def quantize(model_path):
+        """Return the path of the int8 model, quantizing it on first use."""
+        path = quantized_path(model_path)
+        if not os.path.exists(path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(model_path, path, weight_type=QuantType.QInt8)
+        return path
+
+    def forward(self, blob):
+        """Return the output layers for an NCHW blob, without the batch axis for a
+        single image like `net.forward`.
+        """
+        outs = self.session.run(self.output_layers, {self.input_name: blob.astype(np.float32, copy=False)})
+        if len(blob) == 1:
+            return [out.reshape(-1, out.shape[-1]) for out in outs]
+        return [out.reshape(len(blob), -1, out.shape[-1]) for out in outs]
+
+
+def load_backend(weights, cfg, config=None):
+    """Create the backend of a `BackendConfig`. For 'onnx', `weights` is the ONNX
+    model and `cfg` is not used.
+    """
+    config = config or BackendConfig()
+    if config.name == 'onnx':
+        return OnnxBackend(weights, config)
+    return OpenCVBackend(weights, cfg, config)
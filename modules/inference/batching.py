@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import deque
+
+from modules.inference.preprocess import BlobBuffer
+
+
+def split_batch_outputs(outs, n_images):
+    """Split the output layers of a batched forward pass into one list of layers per image.
+
+    OpenCV drops the batch axis of the YOLO layers when the batch holds a single image.
+    """
+    if n_images == 1 and outs[0].ndim == 2:
+        return [list(outs)]
+    return [[out[i] for out in outs] for i in range(n_images)]
+
+
+class _InferenceRequest(object):
+    """A frame waiting for the shared forward pass, and its result once done."""
+
+    def __init__(self, stream_id, frame):
+        self.stream_id = stream_id
+        self.frame = frame
+        self.arrival = time.time()
+        self.outs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchInferenceService(object):
+    """
+    A shared detector which runs one forward pass for the frames of many streams.
+
+    Every stream thread calls `infer` with its current frame and blocks until the
+    result is ready. Since a stream can only have one frame waiting at a time,
+    the batch is always made of the latest frame of each stream. The batch is
+    run as soon as every active stream has submitted a frame, `batch_size` frames
+    are waiting, or the oldest frame has waited `max_wait_ms`.
+
+    Attributes:
+    -----------
+    batch_size: int
+        The maximum number of frames in one forward pass.
+    max_wait_ms: float
+        The maximum time the oldest waiting frame is held back to fill the batch.
+    stream_timeout: float
+        A stream that has not submitted a frame for this many seconds is not
+        waited for anymore.
+    letterbox: bool
+        Whether the frames keep their aspect ratio in the network input, as
+        the `letterbox` of the modules that use the service.
+    """
+    def __init__(self, model, batch_size=8, max_wait_ms=10, input_size=(416, 416), stream_timeout=2.0,
+                 letterbox=False):
+        # Any object with `forward(blob)`, e.g. a `CachedModel`
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.input_size = input_size
+        self.stream_timeout = stream_timeout
+        # The batch slots are reused for every batch
+        self.blobs = BlobBuffer(input_size, letterbox, capacity=batch_size)
+
+        self.pending = deque()
+        self.streams = {}  # stream id -> time of the last submitted frame
+        self.condition = threading.Condition()
+        self.running = True
+        self.n_batches = 0
+        self.n_frames = 0
+        self.thread = threading.Thread(target=self._thread, daemon=True)
+        self.thread.start()
+
+    def infer(self, frame, stream_id):
+        """Submit a frame and wait for the raw output layers of the network for it."""
+        return self.infer_many([frame], stream_id)[0]
+
+    def infer_many(self, frames, stream_id):
+        """Submit several images of one stream (e.g. the tiles of a frame) and wait
+        for the output layers of each of them.
+        """
+        if not frames:
+            return []
+        requests = [_InferenceRequest(stream_id, frame) for frame in frames]
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('The inference service has been stopped')
+            self.streams[stream_id] = time.time()
+            self.pending.extend(requests)
+            self.condition.notify()
+        for request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+        return [request.outs for request in requests]
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def stats(self):
+        """Return the number of batches, frames and the achieved batch occupancy."""
+        with self.condition:
+            n_batches, n_frames = self.n_batches, self.n_frames
+        return {
+            'batches': n_batches,
+            'frames': n_frames,
+            'mean_batch_size': n_frames / n_batches if n_batches else 0.0,
+            'occupancy': n_frames / (n_batches * self.batch_size) if n_batches else 0.0,
+        }
+
+    def _active_streams(self, now):
+        for stream_id, last_seen in list(self.streams.items()):
+            if now - last_seen > self.stream_timeout:
+                del self.streams[stream_id]
+        return len(self.streams)
+
+    def _next_batch(self):
+        """Wait until a batch is ready and take it out of the pending queue."""
+        with self.condition:
+            while not self.pending and self.running:
+                self.condition.wait()
+            if not self.running:
+                return None
+            deadline = self.pending[0].arrival + self.max_wait_ms / 1000.0
+            while True:
+                now = time.time()
+                target = min(self.batch_size, max(self._active_streams(now), 1))
+                if len(self.pending) >= target or now >= deadline:
+                    break
+                self.condition.wait(deadline - now)
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            self.n_batches += 1
+            self.n_frames += len(batch)
+            return batch
+
+    def _thread(self):
+        """Inference background thread."""
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                blob = self.blobs.prepare([request.frame for request in batch])
+                outs = self.model.forward(blob)
+                for request, image_outs in zip(batch, split_batch_outputs(outs, len(batch))):
+                    request.outs = image_outs
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+            if self.n_batches % 120 == 0:
+                stats = self.stats()
+                print('Inference batches: {}, mean batch size: {:.2f}, occupancy: {:.0%}'.format(
+                    stats['batches'], stats['mean_batch_size'], stats['occupancy']))
+        # Release the streams still waiting
+        with self.condition:
+            for request in self.pending:
+                request.error = RuntimeError('The inference service has been stopped')
+                request.done.set()
+            self.pending.clear()
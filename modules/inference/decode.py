@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+
+def decode_outputs(outs, height, width, confidence_threshold, label_ids=None, transform=None):
+    """Decode the raw YOLO output layers of one image into candidate boxes.
+
+    Parameters
+    ----------
+    outs: List[ndarray]
+        The output layers returned by `net.forward`, each of shape (N, 5 + n_classes)
+        with (cx, cy, w, h) normalized to the input image.
+    height, width: int
+        The frame size that the boxes are scaled to.
+    confidence_threshold: float
+        Candidates whose best class score is not above this value are dropped.
+    label_ids: ndarray or None
+        The class ids to keep. `None` keeps every class.
+    transform: (scale_x, scale_y, offset_x, offset_y) or None
+        Maps the normalized coordinates into the frame when the input was not
+        the stretched frame, e.g. letterboxed, see `preprocess.box_transform`.
+
+    Returns
+    -------
+    boxes: ndarray (K, 4) of int
+        The (x, y, w, h) boxes in frame coordinates.
+    areas: ndarray (K,)
+        The box areas normalized by the frame area.
+    confidences: ndarray (K,)
+        The score of the best class.
+    class_ids: ndarray (K,)
+        The index of the best class.
+    """
+    preds = outs[0] if len(outs) == 1 else np.concatenate(outs, axis=0)
+    scores = preds[:, 5:]
+    # Threshold on the best score first so that argmax only runs on the survivors
+    keep = np.flatnonzero(scores.max(axis=1) > confidence_threshold)
+    class_ids = scores[keep].argmax(axis=1)
+    if label_ids is not None:
+        in_labels = np.isin(class_ids, label_ids)
+        keep, class_ids = keep[in_labels], class_ids[in_labels]
+    preds = preds[keep]
+    confidences = scores[keep, class_ids]
+
+    scale_x, scale_y, offset_x, offset_y = (width, height, 0, 0) if transform is None else transform
+    # Same integer rounding as the per-row implementation
+    center_x = np.trunc(preds[:, 0] * scale_x - offset_x)
+    center_y = np.trunc(preds[:, 1] * scale_y - offset_y)
+    w = np.trunc(preds[:, 2] * scale_x)
+    h = np.trunc(preds[:, 3] * scale_y)
+    boxes = np.empty((len(preds), 4), dtype=np.int32)
+    boxes[:, 0] = np.trunc(center_x - w / 2)
+    boxes[:, 1] = np.trunc(center_y - h / 2)
+    boxes[:, 2] = w
+    boxes[:, 3] = h
+    areas = preds[:, 2] * preds[:, 3]
+    if transform is not None:
+        areas *= scale_x * scale_y / (width * height)
+    return boxes, areas, confidences, class_ids
+
+
+def nms_boxes(boxes, confidences, class_ids, score_threshold, nms_threshold):
+    """Run class-aware non-maximum suppression over all classes in one call.
+
+    Returns the kept indices in ascending order, so that the detections keep
+    the order of the network output.
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    if hasattr(cv2.dnn, 'NMSBoxesBatched'):
+        indices = cv2.dnn.NMSBoxesBatched(boxes, confidences.astype(np.float32), class_ids.astype(np.int32),
+                                          score_threshold, nms_threshold)
+    else:
+        # Older OpenCV: shift each class into its own region so boxes of
+        # different classes never overlap
+        offset = int(boxes[:, :2].max() - boxes[:, :2].min() + boxes[:, 2:].max()) + 1
+        shifted = boxes.copy()
+        shifted[:, :2] += (class_ids * offset)[:, None].astype(np.int32)
+        indices = cv2.dnn.NMSBoxes(shifted, confidences.astype(np.float32), score_threshold, nms_threshold)
+    return np.sort(np.asarray(indices, dtype=np.int64).reshape(-1))
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+# An entry file: the header, then the first row and the row count of each frame
+# (-1 for a frame that is not cached), then the float32 rows
+HEADER = np.dtype([('magic', 'S8'), ('n_frames', '<i8'), ('n_rows', '<i8')])
+MAGIC = b'SADETC01'
+# The columns of a row: x, y, w, h, area, confidence, class id
+ROW_COLUMNS = 7
+
+
+def file_fingerprint(path, samples=16, chunk=64 * 1024):
+    """Return a hash of the size and of `samples` chunks spread over the file.
+
+    Videos and weights are large, so they are sampled rather than read whole:
+    a file that is replaced or re-encoded changes the size or the samples.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        for i in range(samples):
+            f.seek(max(size - chunk, 0) * i // max(samples - 1, 1))
+            digest.update(f.read(chunk))
+    return digest.hexdigest()
+
+
+def candidates_to_rows(boxes, areas, confidences, class_ids):
+    rows = np.empty((len(boxes), ROW_COLUMNS), dtype=np.float32)
+    rows[:, :4] = boxes
+    rows[:, 4] = areas
+    rows[:, 5] = confidences
+    rows[:, 6] = class_ids
+    return rows
+
+
+def rows_to_candidates(rows):
+    """Return the (boxes, areas, confidences, class_ids) of `decode_outputs` stored in the rows."""
+    return (rows[:, :4].astype(np.int32), rows[:, 4].copy(), rows[:, 5].copy(), rows[:, 6].astype(np.int64))
+
+
+def read_entry(path):
+    """Map an entry file and return its (starts, counts, rows), None if it is missing or invalid."""
+    try:
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+    except (OSError, ValueError):
+        return None
+    if len(data) < HEADER.itemsize:
+        return None
+    header = data[:HEADER.itemsize].view(HEADER)[0]
+    n_frames, n_rows = int(header['n_frames']), int(header['n_rows'])
+    index_end = HEADER.itemsize + 12 * n_frames
+    if header['magic'] != MAGIC or len(data) != index_end + 4 * ROW_COLUMNS * n_rows:
+        return None
+    starts = data[HEADER.itemsize:HEADER.itemsize + 8 * n_frames].view('<i8')
+    counts = data[HEADER.itemsize + 8 * n_frames:index_end].view('<i4')
+    rows = data[index_end:].view('<f4').reshape(n_rows, ROW_COLUMNS)
+    return starts, counts, rows
+
+
+def write_entry(path, starts, counts, rows):
+    """Write an entry into a temporary file and move it over `path`, so that a reader
+    sees either the old or the new file.
+    """
+    header = np.array([(MAGIC, len(starts), len(rows))], dtype=HEADER)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(starts, dtype='<i8').tobytes())
+        f.write(np.ascontiguousarray(counts, dtype='<i4').tobytes())
+        f.write(np.ascontiguousarray(rows, dtype='<f4').tobytes())
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # e.g. the file is mapped by another process on Windows, written next time
+        os.remove(tmp)
+        raise
+
+
+class CacheEntry(object):
+    """
+    The cached detections of one video for one detector configuration.
+
+    `get` reads a frame from the mapped entry file, `put` keeps the frames
+    detected meanwhile in memory, and `flush` merges them into the file. The
+    mapped file is never written: a flush writes a new file and moves it over
+    the old one, so the other streams reading it keep a consistent view.
+    A flush rewrites the whole entry, so it only happens on `close` and when
+    the pending frames take more than `flush_bytes` of memory: a video is
+    written once, unless its detections do not fit in the memory cap.
+    """
+    flush_bytes = 64 * 1024 * 1024
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.mapped = read_entry(path)
+        self.pending = {}  # frame -> rows
+        self.pending_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if self.mapped is not None:
+            cache.touch(path)
+
+    def get(self, n_frame):
+        """Return the candidates of frame `n_frame`, None when it is not cached."""
+        rows = self.pending.get(n_frame)
+        if rows is None and self.mapped is not None:
+            starts, counts, mapped_rows = self.mapped
+            if 0 <= n_frame < len(starts) and counts[n_frame] >= 0:
+                start = int(starts[n_frame])
+                rows = mapped_rows[start:start + int(counts[n_frame])]
+        if rows is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rows_to_candidates(rows)
+
+    def put(self, n_frame, candidates):
+        rows = candidates_to_rows(*candidates)
+        replaced = self.pending.get(n_frame)
+        if replaced is not None:
+            self.pending_bytes -= sys.getsizeof(replaced)
+        self.pending[n_frame] = rows
+        self.pending_bytes += sys.getsizeof(rows)
+        if self.pending_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Merge the pending frames into the entry file, with the frames other streams wrote meanwhile."""
+        if not self.pending:
+            return
+        with self.cache.lock_for(self.path):
+            current = read_entry(self.path)
+            n_old = len(current[0]) if current is not None else 0
+            n_frames = max(n_old, max(self.pending) + 1)
+            starts = np.zeros(n_frames, dtype=np.int64)
+            counts = np.full(n_frames, -1, dtype=np.int32)
+            parts = []
+            n_rows = 0
+            if current is not None:
+                starts[:n_old], counts[:n_old] = current[0], current[1]
+                parts.append(current[2])
+                n_rows = len(current[2])
+            for n_frame, rows in sorted(self.pending.items()):
+                if n_frame < n_old and counts[n_frame] >= 0:
+                    continue
+                starts[n_frame], counts[n_frame] = n_rows, len(rows)
+                parts.append(rows)
+                n_rows += len(rows)
+            rows = np.concatenate(parts) if parts else np.empty((0, ROW_COLUMNS), dtype=np.float32)
+            self.mapped = current = None  # the new file replaces the mapped one
+            try:
+                write_entry(self.path, starts, counts, rows)
+            except OSError as e:
+                print('Could not write the detection cache {}: {}'.format(self.path, e))
+                self.mapped = read_entry(self.path)
+                return
+            self.pending = {}
+            self.pending_bytes = 0
+            self.mapped = read_entry(self.path)
+        self.cache.evict(keep=self.path)
+
+    def close(self):
+        self.flush()
+        self.mapped = None
+
+
+class DetectionCache(object):
+    """
+    A directory of cached detections of video files, at most `max_bytes` large.
+
+    An entry is keyed by the content of the video and of the model files, and
+    by the input size, letterbox, confidence threshold and backend that the
+    detections depend on. It holds the decoded candidate boxes of each frame,
+    before the class filter and NMS, so that the streams with other `--classes`
+    share it. The least recently opened entries are removed when the directory
+    grows above `max_bytes`.
+
+    Use `DetectionCache.shared` so that the streams of a process share one
+    instance, and its locks.
+    """
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.locks = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def shared(cls, directory, max_bytes=1024 * 1024 * 1024):
+        with cls.instances_lock:
+            key = os.path.abspath(directory)
+            cache = cls.instances.get(key)
+            if cache is None:
+                cache = cls.instances[key] = cls(directory, max_bytes)
+            cache.max_bytes = max_bytes
+            return cache
+
+    def entry(self, video_path, model_paths, config):
+        """Return the entry of a video for the model files and the detector `config` (a JSON-able dict)."""
+        key = json.dumps({'video': file_fingerprint(video_path),
+                          'model': [file_fingerprint(path) for path in model_paths if path is not None],
+                          'config': config}, sort_keys=True)
+        name = hashlib.sha1(key.encode()).hexdigest() + '.det'
+        return CacheEntry(self, os.path.join(self.directory, name))
+
+    def lock_for(self, path):
+        with self.lock:
+            return self.locks.setdefault(path, threading.Lock())
+
+    def touch(self, path):
+        """Mark an entry as used now, for the LRU eviction."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the directory fits in `max_bytes`."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.det'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                # A stream still reading it keeps its mapping
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
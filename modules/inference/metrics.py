@@ -0,0 +1,224 @@
+import bisect
+import threading
+import time
+
+# The stages of a frame, in pipeline order
+STAGES = ('capture', 'blob', 'forward', 'decode', 'nms', 'track', 'draw', 'encode', 'write')
+
+# Upper bounds of the latency buckets in ms, the last bucket is unbounded
+BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750, 1000,
+              2000, 5000)
+
+
+class LatencyHistogram(object):
+    """
+    The latencies of one stage of one stream, in fixed buckets.
+
+    The lifetime counts are what Prometheus scrapes. The rolling counts cover
+    the last `window` seconds, in `slots` slots that are cleared as time moves
+    on, for the percentiles and rates of the JSON view. A stage may be written
+    by several threads (e.g. 'encode' by the pipeline encoder for the recording
+    and by the camera thread for the renditions) and is read by the HTTP
+    threads, so the counts are updated and read under `lock`.
+    """
+    def __init__(self, window=60.0, slots=6):
+        self.lock = threading.Lock()
+        self.slot_seconds = window / slots
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.slots = [[0] * (len(BUCKETS_MS) + 1) for _ in range(slots)]
+        self.slot_sums = [0.0] * slots
+        # The time index of the counts held by each slot
+        self.slot_ids = [None] * slots
+        self.created = time.time()
+
+    def observe(self, ms):
+        bucket = bisect.bisect_left(BUCKETS_MS, ms)
+        index = int(time.time() // self.slot_seconds)
+        slot = index % len(self.slots)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.total += 1
+            self.sum_ms += ms
+            if self.slot_ids[slot] != index:
+                # Only the writers clear a slot, the readers skip the stale ones
+                self.slots[slot] = [0] * len(self.counts)
+                self.slot_sums[slot] = 0.0
+                self.slot_ids[slot] = index
+            self.slots[slot][bucket] += 1
+            self.slot_sums[slot] += ms
+
+    def lifetime_counts(self):
+        """Return the lifetime bucket counts, count and latency sum."""
+        with self.lock:
+            return list(self.counts), self.total, self.sum_ms
+
+    def window_counts(self):
+        """Return the bucket counts and latency sum of the rolling window."""
+        index = int(time.time() // self.slot_seconds)
+        with self.lock:
+            live = [i for i, slot_id in enumerate(self.slot_ids)
+                    if slot_id is not None and index - slot_id < len(self.slots)]
+            counts = [sum(column) for column in zip(*(self.slots[i] for i in live))] or [0] * len(self.counts)
+            return counts, sum(self.slot_sums[i] for i in live)
+
+    def summary(self):
+        """Return the rolling window statistics: count, rate, mean and percentiles in ms, and
+        the fraction of the time the stage was busy.
+        """
+        counts, sum_ms = self.window_counts()
+        n = sum(counts)
+        # A young histogram has not filled its window yet
+        window = min(self.slot_seconds * len(self.slots), max(time.time() - self.created, self.slot_seconds))
+        summary = {'count': self.lifetime_counts()[1], 'window_count': n, 'rate': n / window,
+                   'mean_ms': sum_ms / n if n else 0.0, 'busy': sum_ms / 1000.0 / window}
+        for q in (50, 95, 99):
+            summary['p{}_ms'.format(q)] = percentile(counts, q)
+        return summary
+
+
+def percentile(counts, q):
+    """Estimate the q-th percentile of bucket counts, interpolating inside the bucket."""
+    n = sum(counts)
+    if n == 0:
+        return 0.0
+    rank = q / 100.0 * n
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = BUCKETS_MS[i - 1] if i > 0 else 0.0
+            high = BUCKETS_MS[i] if i < len(BUCKETS_MS) else BUCKETS_MS[-1]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return BUCKETS_MS[-1]
+
+
+class _StageTimer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe((time.perf_counter() - self.start) * 1000)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class StreamMetrics(object):
+    """The stage histograms of one stream. `time(stage)` is a context manager that
+    records how long its block took.
+    """
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.histograms = {}
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def time(self, stage):
+        return _StageTimer(self.histogram(stage))
+
+    def observe(self, stage, ms):
+        self.histogram(stage).observe(ms)
+
+
+class NullMetrics(object):
+    """The metrics of a stream when instrumentation is disabled, recording nothing."""
+    enabled = False
+    name = None
+
+    def time(self, stage):
+        return NULL_TIMER
+
+    def observe(self, stage, ms):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsRegistry(object):
+    """
+    The stage metrics of every stream of the process.
+
+    Disabled by default: `stream` then returns `NULL_METRICS`, whose timers do
+    nothing, so the instrumented code only pays for a method call per stage.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def stream(self, name):
+        """Return the metrics of a stream, shared by the cameras that serve it."""
+        if not self.enabled:
+            return NULL_METRICS
+        with self.lock:
+            metrics = self.streams.get(name)
+            if metrics is None:
+                metrics = self.streams[name] = StreamMetrics(name)
+            return metrics
+
+    def snapshot(self):
+        """Return {stream: {stage: summary}} over the rolling window, for the JSON view."""
+        with self.lock:
+            streams = list(self.streams.values())
+        # The stream threads may add stages meanwhile, the histograms are copied first
+        return {metrics.name: {stage: histogram.summary()
+                               for stage, histogram in sorted(list(metrics.histograms.items()),
+                                                              key=lambda item: stage_order(item[0]))}
+                for metrics in streams}
+
+    def prometheus(self):
+        """Return the lifetime histograms in the Prometheus text exposition format."""
+        with self.lock:
+            streams = list(self.streams.values())
+        name = 'smartassist_stage_latency_seconds'
+        lines = ['# HELP {} Time spent in each stage of the frame processing.'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        for metrics in streams:
+            for stage, histogram in sorted(list(metrics.histograms.items()), key=lambda item: stage_order(item[0])):
+                labels = 'stream="{}",stage="{}"'.format(escape_label(metrics.name), stage)
+                counts, total, sum_ms = histogram.lifetime_counts()
+                cumulative = 0
+                for bound, count in zip(BUCKETS_MS, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound / 1000.0, cumulative))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, total))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels, sum_ms / 1000.0))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, total))
+        return '\n'.join(lines) + '\n'
+
+
+def stage_order(stage):
+    return (STAGES.index(stage) if stage in STAGES else len(STAGES), stage)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The metrics of this process, enabled with --metrics
+registry = MetricsRegistry()
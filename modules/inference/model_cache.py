@@ -0,0 +1,106 @@
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from modules.inference.backends import BackendConfig, load_backend
+
+
+@lru_cache(maxsize=None)
+def read_class_names(path):
+    """Return the class names of a names file, one per line, read once per process."""
+    with open(path, "r") as f:
+        return tuple(line.strip() for line in f.readlines())
+
+
+class CachedModel(object):
+    """
+    A loaded network shared by every stream of the process.
+
+    A network is not safe to run from several threads at once, so `forward`
+    holds `lock`.
+
+    Attributes:
+    -----------
+    key: (weights, cfg, BackendConfig)
+        The cache key of the network.
+    backend: OpenCVBackend or OnnxBackend
+        Runs the network, see `backends`.
+    load_ms: float
+        The time it took to read the network.
+    warm: bool
+        Whether a warm-up forward pass has run.
+    """
+    def __init__(self, key, backend, load_ms):
+        self.key = key
+        self.backend = backend
+        self.load_ms = load_ms
+        self.lock = threading.Lock()
+        self.warm = False
+
+    def warm_up(self, input_size=(416, 416)):
+        """Run one forward pass on a blank image, so that the first real frame
+        does not pay for the layer allocation and initialization.
+        """
+        self.forward(np.zeros((1, 3, input_size[1], input_size[0]), dtype=np.float32))
+        self.warm = True
+
+    def forward(self, blob):
+        """Return the output layers of the network for an NCHW blob."""
+        with self.lock:
+            return self.backend.forward(blob)
+
+
+class ModelCache(object):
+    """
+    The process-wide cache of the loaded networks, keyed by (weights, cfg, BackendConfig).
+
+    A network is read once and then shared by every camera, so a camera
+    restarted for a returning viewer starts without reloading the weights.
+    Networks stay loaded until they are evicted explicitly.
+    """
+    def __init__(self, loader=load_backend):
+        self.loader = loader
+        self.models = {}
+        self.loading = {}  # key -> lock held while the network is read
+        self.lock = threading.Lock()
+
+    def get(self, weights, cfg, backend=None):
+        """Return the cached network, reading it on the first call."""
+        key = (weights, cfg, backend or BackendConfig())
+        with self.lock:
+            model = self.models.get(key)
+            if model is not None:
+                return model
+            loading = self.loading.setdefault(key, threading.Lock())
+        # Only one thread reads a given network, the others wait for it
+        with loading:
+            with self.lock:
+                model = self.models.get(key)
+            if model is None:
+                start = time.time()
+                model = CachedModel(key, self.loader(*key), (time.time() - start) * 1000)
+                with self.lock:
+                    self.models[key] = model
+                    self.loading.pop(key, None)
+        return model
+
+    def evict(self, weights=None, cfg=None, backend=None):
+        """Drop the cached networks that match the given fields, all of them by default.
+        Returns the evicted keys. The streams that hold a network keep using it.
+        """
+        with self.lock:
+            keys = [key for key in self.models
+                    if all(field is None or field == value for field, value in zip((weights, cfg, backend), key))]
+            for key in keys:
+                del self.models[key]
+        return keys
+
+    def keys(self):
+        with self.lock:
+            return list(self.models)
+
+
+# The networks of this process
+models = ModelCache()
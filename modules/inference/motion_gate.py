@@ -0,0 +1,113 @@
+import cv2
+
+# What to do with a frame
+SKIP, REGION, FULL = 'skip', 'region', 'full'
+
+
+class MotionGate(object):
+    """
+    Decides, from a cheap comparison of downscaled frames, whether the detector
+    has to run on a frame.
+
+    Each frame is downscaled, converted to gray, blurred and compared with the
+    reference, which is the frame the detector last ran on. The fraction of
+    pixels that changed by more than `pixel_threshold` decides:
+    - under `threshold`, the scene did not change and the last detections are reused (SKIP)
+    - when the changed pixels fit in a box of at most `region_limit` of the frame,
+      the detector only runs on that box (REGION)
+    - otherwise the detector runs on the whole frame (FULL)
+    The detector also runs on the whole frame every `refresh_interval` frames,
+    so that slow changes are picked up.
+
+    Attributes:
+    -----------
+    threshold: float
+        The fraction of changed pixels under which the detector is skipped.
+    scale: float
+        The downscaling factor of the compared frames.
+    pixel_threshold: int
+        The gray level difference above which a pixel has changed.
+    region_limit: float
+        The largest fraction of the frame that is detected as a region, 0 to always detect the whole frame.
+    padding: int
+        Pixels added around the changed region, in frame coordinates.
+    min_region: int
+        The smallest width and height of a region, in frame coordinates.
+    """
+    def __init__(self, threshold=0.002, scale=0.25, pixel_threshold=25, region_limit=0.3, refresh_interval=300,
+                 padding=32, min_region=128):
+        self.threshold = threshold
+        self.scale = scale
+        self.pixel_threshold = pixel_threshold
+        self.region_limit = region_limit
+        self.refresh_interval = refresh_interval
+        self.padding = padding
+        self.min_region = min_region
+        self.reference = None
+        self.since_full = 0
+        self.n_frames = 0
+        self.n_skipped = 0
+        self.n_regions = 0
+        self.n_full = 0
+
+    def downscale(self, frame):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def region(self, mask, height, width):
+        """Return the padded (x, y, w, h) box of the changed pixels in frame coordinates."""
+        x, y, w, h = cv2.boundingRect(mask)
+        x0 = int(x / self.scale) - self.padding
+        y0 = int(y / self.scale) - self.padding
+        x1 = int((x + w) / self.scale) + self.padding
+        y1 = int((y + h) / self.scale) + self.padding
+        # Grow small regions around their center
+        grow_w, grow_h = max(self.min_region - (x1 - x0), 0), max(self.min_region - (y1 - y0), 0)
+        x0, x1 = x0 - grow_w // 2, x1 + grow_w - grow_w // 2
+        y0, y1 = y0 - grow_h // 2, y1 + grow_h - grow_h // 2
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, width), min(y1, height)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def check(self, frame):
+        """Return how the frame is handled, SKIP, REGION or FULL, and the (x, y, w, h)
+        region to detect in (None unless REGION). The frame becomes the reference
+        unless it is skipped.
+        """
+        height, width = frame.shape[:2]
+        small = self.downscale(frame)
+        self.n_frames += 1
+        decision, region = FULL, None
+        if self.reference is not None and self.reference.shape == small.shape \
+                and self.since_full < self.refresh_interval:
+            diff = cv2.absdiff(small, self.reference)
+            _, mask = cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+            changed = cv2.countNonZero(mask) / float(mask.size)
+            if changed < self.threshold:
+                decision = SKIP
+            elif self.region_limit > 0:
+                region = self.region(mask, height, width)
+                if region[2] * region[3] <= self.region_limit * height * width:
+                    decision = REGION
+                else:
+                    region = None
+
+        if decision == SKIP:
+            self.n_skipped += 1
+            self.since_full += 1
+            return decision, region
+        self.reference = small
+        if decision == REGION:
+            self.n_regions += 1
+            self.since_full += 1
+        else:
+            self.n_full += 1
+            self.since_full = 0
+        return decision, region
+
+    def stats(self):
+        """Return the frame counters and the fraction of frames the detector did not run on."""
+        return {'frames': self.n_frames, 'skipped': self.n_skipped, 'regions': self.n_regions,
+                'full': self.n_full, 'skip_ratio': self.n_skipped / self.n_frames if self.n_frames else 0.0}
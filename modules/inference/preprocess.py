@@ -0,0 +1,131 @@
+import cv2
+import numpy as np
+
+# The (width, height) of the network input
+INPUT_SIZE = (416, 416)
+# The value of the letterbox borders, in the scaled [0, 1] range
+PAD_VALUE = 0.5
+
+_SCALE = np.float32(1 / 255.0)
+
+
+def letterbox_geometry(height, width, input_size=INPUT_SIZE):
+    """Return the (new_width, new_height, pad_x, pad_y) of a frame resized into the
+    input without changing its aspect ratio, centered between the borders.
+    """
+    scale = min(input_size[0] / float(width), input_size[1] / float(height))
+    new_width = max(int(round(width * scale)), 1)
+    new_height = max(int(round(height * scale)), 1)
+    return new_width, new_height, (input_size[0] - new_width) // 2, (input_size[1] - new_height) // 2
+
+
+def box_transform(height, width, input_size=INPUT_SIZE, letterbox=False):
+    """Return the (scale_x, scale_y, offset_x, offset_y) that map the normalized
+    network coordinates of a box back into the frame: x = x_norm * scale_x - offset_x.
+    """
+    if not letterbox:
+        return float(width), float(height), 0.0, 0.0
+    new_width, new_height, pad_x, pad_y = letterbox_geometry(height, width, input_size)
+    scale_x = input_size[0] * width / float(new_width)
+    scale_y = input_size[1] * height / float(new_height)
+    return scale_x, scale_y, pad_x * width / float(new_width), pad_y * height / float(new_height)
+
+
+class BlobBuffer(object):
+    """
+    Turns frames into the NCHW float32 blob of the network, in memory reused across frames.
+
+    Does what `cv2.dnn.blobFromImages(images, 1/255.0, input_size, swapRB=True)`
+    does, but each image is resized into a preallocated uint8 buffer and
+    converted into its slot of a preallocated blob, so that a frame allocates
+    no new arrays. With `letterbox`, the image keeps its aspect ratio and is
+    centered between `PAD_VALUE` borders, see `box_transform` for the boxes.
+    The slots grow to the largest number of images seen at once, unless the
+    buffer writes into a given `blob` (e.g. in shared memory), which it can't grow.
+
+    The returned blob is a view of the buffer: it is overwritten by the next
+    call to `prepare`, so it must be used (e.g. forwarded) before that.
+    """
+    def __init__(self, input_size=INPUT_SIZE, letterbox=False, capacity=1, blob=None):
+        self.input_size = input_size
+        self.letterbox = letterbox
+        self.fixed = blob is not None
+        if blob is None:
+            blob = np.empty((0, 3, input_size[1], input_size[0]), dtype=np.float32)
+        self.blob = blob
+        self.resized = {}  # (width, height) -> uint8 resize buffer
+        self.planes = {}  # (width, height) -> uint8 RGB planes
+        self.geometry = [None] * len(blob)  # letterbox geometry last written into each slot
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        """Make room for `capacity` images, keeping the slots already written."""
+        if capacity <= len(self.blob):
+            return
+        if self.fixed:
+            raise ValueError('The blob holds {} images, {} needed'.format(len(self.blob), capacity))
+        blob = np.empty((capacity,) + self.blob.shape[1:], dtype=np.float32)
+        blob[:len(self.blob)] = self.blob
+        self.blob = blob
+        self.geometry += [None] * (capacity - len(self.geometry))
+
+    def geometry_of(self, image):
+        height, width = image.shape[:2]
+        if self.letterbox:
+            return letterbox_geometry(height, width, self.input_size)
+        return self.input_size[0], self.input_size[1], 0, 0
+
+    def prepare(self, images):
+        """Return the blob of the images, of shape (len(images), 3, height, width)."""
+        self.reserve(len(images))
+        for slot, image in enumerate(images):
+            self.fill(slot, image)
+        return self.blob[:len(images)]
+
+    def fill(self, slot, image):
+        new_width, new_height, pad_x, pad_y = geometry = self.geometry_of(image)
+        if self.geometry[slot] != geometry:
+            # The borders only change with the frame size
+            self.blob[slot].fill(PAD_VALUE)
+            self.geometry[slot] = geometry
+        size = (new_width, new_height)
+        resized = self.resized.get(size)
+        if resized is None:
+            resized = self.resized[size] = np.empty((new_height, new_width, 3), dtype=np.uint8)
+            self.planes[size] = np.empty((3, new_height, new_width), dtype=np.uint8)
+        cv2.resize(image, size, dst=resized, interpolation=cv2.INTER_LINEAR)
+        planes = self.planes[size]
+        for channel in range(3):
+            # BGR to RGB
+            cv2.extractChannel(resized, 2 - channel, dst=planes[channel])
+        np.multiply(planes, _SCALE, out=self.blob[slot, :, pad_y:pad_y + new_height, pad_x:pad_x + new_width])
+
+
+class FrameRing(object):
+    """
+    Reads the frames of a video into a ring of reused buffers.
+
+    `cv2.VideoCapture.read` writes into the array it is given when the frame
+    has the same size, so after the first lap no frame is allocated. A frame
+    is overwritten `size` reads later: `size` must be larger than the number
+    of frames still in use downstream (e.g. in the queues of a pipeline).
+    """
+    def __init__(self, size=1):
+        self.buffers = [None] * size
+        self.index = 0
+
+    def read(self, video):
+        """Return (success, frame) like `video.read()`."""
+        return self._into(video.read)
+
+    def retrieve(self, video):
+        """Return (success, frame) like `video.retrieve()`, the decoded frame of the last `grab`."""
+        return self._into(video.retrieve)
+
+    def _into(self, method):
+        buffer = self.buffers[self.index]
+        success, frame = method() if buffer is None else method(buffer)
+        if success:
+            self.buffers[self.index] = frame
+            self.index = (self.index + 1) % len(self.buffers)
+        return success, frame
@@ -0,0 +1,64 @@
+import math
+
+
+class KeyframeScheduler(object):
+    """
+    Decides on which frames the detector runs. The frames in between are
+    handled by propagating the tracks.
+
+    The detector runs on every `interval`-th frame. When a `budget_ms` per frame
+    is given, the interval is raised until the mean time per frame over one
+    interval, (detect + (k - 1) * propagate) / k, fits in the budget.
+
+    Attributes:
+    -----------
+    interval: int
+        The minimum number of frames between two detector runs, 1 runs it on every frame.
+    budget_ms: float
+        The target mean processing time per frame, None to only use `interval`.
+    max_interval: int
+        The maximum number of frames between two detector runs in budget mode.
+    """
+    def __init__(self, interval=1, budget_ms=None, max_interval=30, smoothing=0.1):
+        self.interval = max(int(interval), 1)
+        self.budget_ms = budget_ms
+        self.max_interval = max(max_interval, self.interval)
+        self.smoothing = smoothing
+        self.detect_ms = None
+        self.propagate_ms = 0.0
+        self.since_keyframe = None
+        self.n_frames = 0
+        self.n_detected = 0
+
+    def is_enabled(self):
+        return self.interval > 1 or self.budget_ms is not None
+
+    def current_interval(self):
+        if self.budget_ms is None or self.detect_ms is None:
+            return self.interval
+        spare = self.budget_ms - self.propagate_ms
+        if spare <= 0:
+            return self.max_interval
+        needed = math.ceil((self.detect_ms - self.propagate_ms) / spare)
+        return min(max(self.interval, needed), self.max_interval)
+
+    def should_detect(self):
+        return self.since_keyframe is None or self.since_keyframe + 1 >= self.current_interval()
+
+    def record(self, detected, elapsed_ms):
+        """Record how a frame was handled and how long it took."""
+        self.n_frames += 1
+        if detected:
+            self.n_detected += 1
+            self.since_keyframe = 0
+            if self.detect_ms is None:
+                self.detect_ms = elapsed_ms
+            else:
+                self.detect_ms += self.smoothing * (elapsed_ms - self.detect_ms)
+        else:
+            self.since_keyframe += 1
+            self.propagate_ms += self.smoothing * (elapsed_ms - self.propagate_ms)
+
+    def duty_cycle(self):
+        """Return the fraction of frames on which the detector ran."""
+        return self.n_detected / self.n_frames if self.n_frames else 0.0
@@ -0,0 +1,183 @@
+import math
+
+import numpy as np
+
+from modules.inference.decode import decode_outputs
+from modules.inference.preprocess import box_transform
+
+
+def tile_grid(x, y, width, height, tile_size, overlap):
+    """Return overlapping (x, y, w, h) tiles of at most `tile_size` pixels that cover
+    the area. Consecutive tiles overlap by at least `overlap` of the tile size and
+    the last tiles end on the border of the area.
+    """
+    step = max(int(tile_size * (1 - overlap)), 1)
+
+    def starts(offset, length):
+        if length <= tile_size:
+            return [offset]
+        n = math.ceil((length - tile_size) / step) + 1
+        return [offset + int(round(i * (length - tile_size) / (n - 1))) for i in range(n)]
+
+    return [(tx, ty, min(tile_size, width), min(tile_size, height))
+            for ty in starts(y, height) for tx in starts(x, width)]
+
+
+def intersects(regions, boxes):
+    """Return whether each (x, y, w, h) region intersects any of the (x, y, w, h) boxes."""
+    regions = np.asarray(regions, dtype=float).reshape(-1, 4)
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(len(regions), dtype=bool)
+    overlap_x = (np.minimum(regions[:, None, 0] + regions[:, None, 2], boxes[None, :, 0] + boxes[None, :, 2]) >
+                 np.maximum(regions[:, None, 0], boxes[None, :, 0]))
+    overlap_y = (np.minimum(regions[:, None, 1] + regions[:, None, 3], boxes[None, :, 1] + boxes[None, :, 3]) >
+                 np.maximum(regions[:, None, 1], boxes[None, :, 1]))
+    return (overlap_x & overlap_y).any(axis=1)
+
+
+def decode_regions(outs, regions, height, width, confidence_threshold, label_ids=None, letterbox=False):
+    """Decode the output layers of each region crop and map the boxes back into the frame.
+
+    Parameters
+    ----------
+    outs: List[List[ndarray]]
+        The output layers of each region, in the order of `regions`.
+    regions: List[(x, y, w, h)]
+        The crops of the frame that the network ran on.
+    height, width: int
+        The frame size, the areas are normalized by the frame area.
+    letterbox: bool
+        Whether the crops were letterboxed into the network input.
+
+    Returns
+    -------
+    The boxes, areas, confidences and class ids of `decode_outputs`, in frame coordinates.
+    """
+    decoded = [(np.empty((0, 4), dtype=np.int32), np.empty(0), np.empty(0), np.empty(0, dtype=np.int64))]
+    for region_outs, (x, y, w, h) in zip(outs, regions):
+        transform = box_transform(h, w, letterbox=True) if letterbox else None
+        boxes, areas, confidences, class_ids = decode_outputs(region_outs, h, w, confidence_threshold, label_ids,
+                                                              transform)
+        boxes[:, 0] += x
+        boxes[:, 1] += y
+        decoded.append((boxes, areas * (w * h) / float(width * height), confidences, class_ids))
+    return tuple(np.concatenate(column) for column in zip(*decoded))
+
+
+def merge_seams(boxes, areas, confidences, class_ids, height, width, threshold=0.5):
+    """Merge the detections of one object cut by the seams between tiles.
+
+    An object on a seam is found whole in one tile and cut in the next one, or
+    cut in both. Its boxes barely overlap by IoU, but most of the smaller box is
+    inside the other one. From the most confident box down, a box absorbs the
+    boxes of the same class whose intersection covers at least `threshold` of
+    the smaller of the two, and grows to their union.
+
+    Returns
+    -------
+    The merged boxes, areas, confidences and class ids, most confident first.
+    """
+    order = np.argsort(-confidences, kind='stable')
+    boxes, areas = boxes[order].astype(np.int64), areas[order].astype(float)
+    confidences, class_ids = confidences[order], class_ids[order]
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+    inter = (np.clip(np.minimum(x1[:, None], x1[None, :]) - np.maximum(x0[:, None], x0[None, :]), 0, None) *
+             np.clip(np.minimum(y1[:, None], y1[None, :]) - np.maximum(y0[:, None], y0[None, :]), 0, None))
+    box_areas = boxes[:, 2] * boxes[:, 3]
+    smaller = np.maximum(np.minimum(box_areas[:, None], box_areas[None, :]), 1)
+    same = (inter / smaller >= threshold) & (class_ids[:, None] == class_ids[None, :])
+
+    absorbed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for i in range(len(boxes)):
+        if absorbed[i]:
+            continue
+        group = np.flatnonzero(same[i] & ~absorbed)
+        absorbed[group] = True
+        keep.append(i)
+        if len(group) > 1:
+            gx0, gy0 = x0[group].min(), y0[group].min()
+            gx1, gy1 = x1[group].max(), y1[group].max()
+            boxes[i] = (gx0, gy0, gx1 - gx0, gy1 - gy0)
+            areas[i] = (gx1 - gx0) * (gy1 - gy0) / float(width * height)
+    return boxes[keep], areas[keep], confidences[keep], class_ids[keep]
+
+
+class TiledInference(object):
+    """
+    Chooses the crops of a high resolution frame that the detector runs on.
+
+    Squashing a 4K frame into one network input makes distant objects a few
+    pixels large. Instead, the frame (or each ROI) is covered by overlapping
+    tiles of `tile_size` pixels, each of which is resized to the network
+    input, and the whole frame is added as one more crop so that large objects
+    are still seen whole. All the crops go through the network in one batch.
+
+    Attributes:
+    -----------
+    tile_size: int
+        The size of the tiles in frame pixels.
+    overlap: float
+        The fraction of a tile that overlaps its neighbours, it should hold the
+        objects cut by a seam.
+    rois: List[(x, y, w, h)]
+        The areas to tile, None for the whole frame.
+    include_full: bool
+        Whether the whole frame is detected too. Defaults to True without ROIs.
+    active_only: bool
+        Only run on the tiles that hold a known object or the changed region,
+        and on all the tiles every `refresh_interval` frames.
+    """
+    def __init__(self, tile_size=832, overlap=0.2, rois=None, include_full=None, active_only=False,
+                 refresh_interval=10):
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.rois = [tuple(roi) for roi in rois] if rois else None
+        self.include_full = include_full if include_full is not None else not self.rois
+        self.active_only = active_only
+        self.refresh_interval = refresh_interval
+        self.since_refresh = None
+        self.n_frames = 0
+        self.n_tiles = 0
+
+    def clamp(self, area, height, width):
+        x, y, w, h = area
+        x0, y0 = min(max(int(x), 0), width), min(max(int(y), 0), height)
+        x1, y1 = min(int(x + w), width), min(int(y + h), height)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+    def regions(self, height, width, area=None, active_boxes=None):
+        """Return the (x, y, w, h) crops to detect in.
+
+        Parameters
+        ----------
+        area: (x, y, w, h)
+            Only tile this area, e.g. the changed region of the frame.
+        active_boxes: ndarray (N, 4)
+            The boxes of the known objects, used with `active_only`.
+        """
+        areas = [area] if area is not None else (self.rois or [(0, 0, width, height)])
+        tiles = []
+        for x, y, w, h in (self.clamp(a, height, width) for a in areas):
+            if w > 0 and h > 0:
+                tiles.extend(tile_grid(x, y, w, h, self.tile_size, self.overlap))
+        if self.active_only and area is None:
+            if self.since_refresh is not None and self.since_refresh + 1 < self.refresh_interval:
+                self.since_refresh += 1
+                if active_boxes is None:
+                    active_boxes = np.empty((0, 4))
+                tiles = [tile for tile, active in zip(tiles, intersects(tiles, active_boxes)) if active]
+            else:
+                self.since_refresh = 0
+        full = (0, 0, width, height)
+        if self.include_full and area is None:
+            tiles = [full] + [tile for tile in tiles if tile != full]
+        self.n_frames += 1
+        self.n_tiles += len(tiles)
+        return tiles
+
+    def mean_tiles(self):
+        """Return the mean number of crops detected per frame."""
+        return self.n_tiles / self.n_frames if self.n_frames else 0.0
@@ -0,0 +1,408 @@
+import atexit
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from modules.inference.backends import BackendConfig
+from modules.inference.batching import split_batch_outputs
+from modules.inference.preprocess import BlobBuffer, INPUT_SIZE
+
+
+def _worker_main(index, conn, heartbeats, names, n_slots, input_size, columns, max_rows, weights, cfg, backend,
+                 score_threshold):
+    """The loop of a worker process: forward the blobs of the input slots it is sent
+    and write the output rows into the same output slots.
+    """
+    # Ctrl+C is for the server, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from modules.inference.model_cache import models
+
+    input_memory = shared_memory.SharedMemory(name=names[0])
+    output_memory = shared_memory.SharedMemory(name=names[1])
+    inputs = np.ndarray((n_slots, 3, input_size[1], input_size[0]), dtype=np.float32, buffer=input_memory.buf)
+    rows = np.ndarray((n_slots, max_rows, columns), dtype=np.float32, buffer=output_memory.buf)
+    try:
+        model = models.get(weights, cfg, backend)
+        model.warm_up(input_size)
+    except Exception as e:
+        conn.send(('failed', '{}: {}'.format(type(e).__name__, e)))
+        return
+    conn.send(('ready', os.getpid()))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        job_id, slots = message
+        heartbeats[index] = time.time()
+        try:
+            blob = inputs[slots[0]:slots[0] + 1] if len(slots) == 1 else inputs[list(slots)]
+            counts, overflow = [], {}
+            for i, (slot, outs) in enumerate(zip(slots, split_batch_outputs(model.forward(blob), len(slots)))):
+                preds = outs[0] if len(outs) == 1 else np.concatenate(outs, axis=0)
+                if score_threshold is not None:
+                    # Same test as `decode_outputs`, the rows keep their order
+                    preds = preds[preds[:, 5:].max(axis=1) > score_threshold]
+                if preds.shape[1] == columns and len(preds) <= max_rows:
+                    rows[slot, :len(preds)] = preds
+                else:
+                    overflow[i] = preds
+                counts.append(len(preds))
+            conn.send(('done', job_id, counts, overflow))
+        except Exception as e:
+            conn.send(('error', job_id, '{}: {}'.format(type(e).__name__, e)))
+
+
+class _Job(object):
+    """The images of one stream in a set of slots, and their output layers once done."""
+
+    def __init__(self, job_id, slots):
+        self.id = job_id
+        self.slots = slots
+        self.worker = None
+        self.dispatched = 0.0
+        self.attempts = 0
+        self.outs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Worker(object):
+    """The server side of a worker process: its pipe and the jobs sent to it."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.started = 0.0
+        self.jobs = {}  # job id -> _Job
+
+
+class ProcessInferenceService(object):
+    """
+    A shared detector which runs the network in separate worker processes.
+
+    Each worker process loads its own instance of the network, so the forward
+    passes of the streams run in parallel on all the cores and their Python
+    work (e.g. the thresholding of the output rows) does not hold the GIL of
+    the server. The images are never pickled: `infer` makes the blob of the
+    frame in an input slot of a shared memory ring, the worker forwards it in
+    place and writes the output rows into the matching output slot. Only the
+    slot numbers and the row counts go through the pipes.
+
+    A supervisor thread reads the results and checks the health of the
+    workers: a worker that exits, or that has spent `hang_timeout` seconds on
+    one forward pass, is killed and restarted, and its pending images are sent
+    to the other workers. An image that crashes `max_attempts` workers fails.
+
+    It has the `infer` / `infer_many` interface of `BatchInferenceService`, the
+    output layers of an image are a single array of its rows.
+
+    Attributes:
+    -----------
+    n_workers: int
+        The number of worker processes.
+    max_batch: int
+        The maximum number of images of one `infer_many` call forwarded at once by a worker.
+    score_threshold: float or None
+        The workers only return the rows whose best class score is above it,
+        which leaves the detections of `decode_outputs` at that threshold unchanged.
+    max_rows: int
+        The rows of an output slot. The rows of an image that do not fit are
+        pickled through the pipe instead.
+    """
+    max_attempts = 2
+    health_interval = 1.0
+
+    def __init__(self, weights, cfg, backend=None, workers=2, input_size=INPUT_SIZE, letterbox=False,
+                 score_threshold=None, max_batch=4, slots=None, columns=85, max_rows=1024, hang_timeout=30.0):
+        backend = backend or BackendConfig()
+        if not backend.threads:
+            # The workers share the cores instead of each starting a thread per core
+            backend = backend._replace(threads=max((os.cpu_count() or 1) // workers, 1))
+        self.weights = weights
+        self.cfg = cfg
+        self.backend = backend
+        self.n_workers = workers
+        self.input_size = input_size
+        self.score_threshold = score_threshold
+        # Two batches per worker, one forwarded and one waiting
+        self.n_slots = slots or 2 * workers * max_batch
+        self.max_batch = min(max_batch, self.n_slots)
+        self.columns = columns
+        self.max_rows = max_rows
+        self.hang_timeout = hang_timeout
+
+        self.context = multiprocessing.get_context('spawn')
+        input_shape = (self.n_slots, 3, input_size[1], input_size[0])
+        output_shape = (self.n_slots, max_rows, columns)
+        self.input_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(input_shape)) * 4)
+        self.output_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(output_shape)) * 4)
+        self.blobs = BlobBuffer(input_size, letterbox,
+                                blob=np.ndarray(input_shape, dtype=np.float32, buffer=self.input_memory.buf))
+        self.rows = np.ndarray(output_shape, dtype=np.float32, buffer=self.output_memory.buf)
+        self.fill_lock = threading.Lock()  # the blob buffer is not thread-safe
+        self.heartbeats = self.context.RawArray('d', workers)
+
+        self.condition = threading.Condition()
+        self.free_slots = list(range(self.n_slots))
+        self.waiting = []  # jobs without a live worker
+        self.next_job = 0
+        self.running = True
+        self.error = None
+        self.n_jobs = 0
+        self.n_frames = 0
+        self.restarts = 0
+        self.workers = [_Worker(i) for i in range(workers)]
+        for worker in self.workers:
+            self._start(worker)
+        self.thread = threading.Thread(target=self._thread, name='inference-workers', daemon=True)
+        self.thread.start()
+        # Before multiprocessing terminates the workers, which would look like crashes
+        atexit.register(self.stop)
+
+    def infer(self, frame, stream_id):
+        """Submit a frame and wait for the raw output layers of the network for it."""
+        return self.infer_many([frame], stream_id)[0]
+
+    def infer_many(self, frames, stream_id):
+        """Submit several images of one stream (e.g. the tiles of a frame) and wait
+        for the output layers of each of them. They are split into batches of
+        `max_batch` images, which run on several workers at once.
+        """
+        if not frames:
+            return []
+        jobs = []
+        for start in range(0, len(frames), self.max_batch):
+            batch = frames[start:start + self.max_batch]
+            slots = self._take_slots(len(batch))
+            with self.fill_lock:
+                for slot, frame in zip(slots, batch):
+                    self.blobs.fill(slot, frame)
+            jobs.append(self._submit(slots))
+        outs = []
+        for job in jobs:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            outs.extend(job.outs)
+        return outs
+
+    def wait_ready(self, timeout=None):
+        """Wait until every worker has loaded the network, raises if it could not be loaded."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.error is not None or all(w.ready for w in self.workers), timeout)
+            if self.error is not None:
+                raise self.error
+
+    def stop(self):
+        atexit.unregister(self.stop)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        """Return the number of ready workers, restarts, jobs, frames and images in flight."""
+        with self.condition:
+            return {
+                'workers': self.n_workers,
+                'ready': sum(worker.ready for worker in self.workers),
+                'restarts': self.restarts,
+                'jobs': self.n_jobs,
+                'frames': self.n_frames,
+                'in_flight': self.n_slots - len(self.free_slots),
+            }
+
+    def _take_slots(self, n):
+        """Wait for `n` free slots and take them at once, so that two streams never hold part of what they need."""
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.free_slots) >= n or not self.running or self.error)
+            if self.error is not None:
+                raise self.error
+            if not self.running:
+                raise RuntimeError('The inference service has been stopped')
+            slots = self.free_slots[:n]
+            del self.free_slots[:n]
+            return slots
+
+    def _submit(self, slots):
+        with self.condition:
+            job = _Job(self.next_job, slots)
+            self.next_job += 1
+            self._dispatch(job)
+            return job
+
+    def _dispatch(self, job):
+        """Send a job to the least busy worker, preferably a ready one. Called with the condition held."""
+        alive = [worker for worker in self.workers if worker.conn is not None]
+        candidates = [worker for worker in alive if worker.ready] or alive
+        if not candidates:
+            self.waiting.append(job)
+            return
+        worker = min(candidates, key=lambda w: len(w.jobs))
+        job.worker = worker
+        job.dispatched = time.time()
+        worker.jobs[job.id] = job
+        try:
+            worker.conn.send((job.id, job.slots))
+        except (OSError, ValueError):
+            # The supervisor restarts the worker and sends its jobs again
+            pass
+
+    def _finish(self, job, outs=None, error=None):
+        """Release the slots of a job and wake its stream up. Called with the condition held."""
+        job.outs = outs
+        job.error = error
+        self.free_slots.extend(job.slots)
+        if error is None:
+            self.n_jobs += 1
+            self.n_frames += len(job.slots)
+        self.condition.notify_all()
+        job.done.set()
+
+    def _start(self, worker):
+        conn, child_conn = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=_worker_main, name='inference-worker-{}'.format(worker.index), daemon=True,
+            args=(worker.index, child_conn, self.heartbeats, (self.input_memory.name, self.output_memory.name),
+                  self.n_slots, self.input_size, self.columns, self.max_rows, self.weights, self.cfg, self.backend,
+                  self.score_threshold))
+        worker.process.start()
+        child_conn.close()
+        worker.conn = conn
+        worker.ready = False
+        worker.started = time.time()
+
+    def _lost(self, worker, reason=None):
+        """Kill a dead or hung worker, start a new one and send its jobs again. Called with the condition held."""
+        worker.conn.close()
+        worker.conn = None
+        worker.ready = False
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        print('Inference worker {} {}, restarting it'.format(
+            worker.index, reason or 'exited with code {}'.format(worker.process.exitcode)))
+        jobs, worker.jobs = list(worker.jobs.values()), {}
+        self.restarts += 1
+        self._start(worker)
+        for job in jobs:
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                self._finish(job, error=RuntimeError('The inference workers crashed {} times on this image'.format(
+                    job.attempts)))
+            else:
+                self._dispatch(job)
+
+    def _receive(self, worker, message):
+        """Handle a message of a worker. Called with the condition held."""
+        kind = message[0]
+        if kind == 'ready':
+            worker.ready = True
+            waiting, self.waiting = self.waiting, []
+            for job in waiting:
+                self._dispatch(job)
+            self.condition.notify_all()
+        elif kind == 'failed':
+            self.error = RuntimeError('The inference workers could not load the network: {}'.format(message[1]))
+            self.condition.notify_all()
+        else:
+            job = worker.jobs.pop(message[1], None)
+            if job is None:
+                return
+            if kind == 'error':
+                self._finish(job, error=RuntimeError(message[2]))
+                return
+            _, _, counts, overflow = message
+            # Copied out so that the slots are free as soon as the worker is done
+            outs = [[overflow[i] if i in overflow else self.rows[slot, :count].copy()]
+                    for i, (slot, count) in enumerate(zip(job.slots, counts))]
+            self._finish(job, outs)
+            if self.n_jobs % 120 == 0:
+                print('Inference workers: {}/{} ready, {} frames, {} restarts'.format(
+                    sum(w.ready for w in self.workers), self.n_workers, self.n_frames, self.restarts))
+
+    def _check_health(self, now):
+        """Restart the workers that exited or hang. Called with the condition held."""
+        for worker in self.workers:
+            if worker.conn is None:
+                continue
+            if not worker.process.is_alive():
+                self._lost(worker)
+            elif worker.ready and worker.jobs:
+                # The worker stamps each job it starts, a job sent meanwhile has not started yet
+                busy_since = max(self.heartbeats[worker.index], min(job.dispatched for job in worker.jobs.values()))
+                if now - busy_since > self.hang_timeout:
+                    self._lost(worker, 'hangs since {:.0f} s'.format(now - busy_since))
+
+    def _thread(self):
+        """Supervisor background thread: reads the results and restarts the lost workers."""
+        last_check = time.time()
+        while self.running:
+            with self.condition:
+                conns = {worker.conn: worker for worker in self.workers if worker.conn is not None}
+            for conn in wait(list(conns), timeout=0.2):
+                worker = conns[conn]
+                with self.condition:
+                    try:
+                        message = conn.recv()
+                    except (EOFError, OSError):
+                        if self.error is None and self.running:
+                            self._lost(worker)
+                        else:
+                            worker.conn = None
+                        continue
+                    self._receive(worker, message)
+            now = time.time()
+            if now - last_check >= self.health_interval and self.error is None:
+                last_check = now
+                with self.condition:
+                    self._check_health(now)
+            if self.error is not None:
+                with self.condition:
+                    self._fail_all(self.error)
+        self._shutdown()
+
+    def _fail_all(self, error):
+        """Fail the jobs still pending. Called with the condition held."""
+        jobs = self.waiting
+        self.waiting = []
+        for worker in self.workers:
+            jobs.extend(worker.jobs.values())
+            worker.jobs = {}
+        for job in jobs:
+            self._finish(job, error=error)
+
+    def _shutdown(self):
+        with self.condition:
+            for worker in self.workers:
+                if worker.conn is not None:
+                    try:
+                        worker.conn.send(None)
+                    except (OSError, ValueError):
+                        pass
+        for worker in self.workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            if worker.conn is not None:
+                worker.conn.close()
+                worker.conn = None
+        with self.condition:
+            self._fail_all(RuntimeError('The inference service has been stopped'))
+        # The views must go before the memory is released
+        self.blobs = self.rows = None
+        for memory in (self.input_memory, self.output_memory):
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,148 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.spatial import cKDTree
+
+
+def centroids(boxes):
+    """Return the (cX, cY) centroids of an (N, 4) array of (x, y, w, h) boxes."""
+    return boxes[:, :2] + boxes[:, 2:] / 2.0
+
+
+def pairwise_iou(boxes_a, boxes_b):
+    """Return the IoU of each pair (boxes_a[i], boxes_b[i]) of (x, y, w, h) boxes."""
+    x0 = np.maximum(boxes_a[:, 0], boxes_b[:, 0])
+    y0 = np.maximum(boxes_a[:, 1], boxes_b[:, 1])
+    x1 = np.minimum(boxes_a[:, 0] + boxes_a[:, 2], boxes_b[:, 0] + boxes_b[:, 2])
+    y1 = np.minimum(boxes_a[:, 1] + boxes_a[:, 3], boxes_b[:, 1] + boxes_b[:, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    union = boxes_a[:, 2] * boxes_a[:, 3] + boxes_b[:, 2] * boxes_b[:, 3] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def gate_radii(track_boxes, gate_scale, min_gate, track_steps=None):
+    """Return the gating distance of each track.
+
+    The gate grows with the number of frames since the track was last
+    measured, since its object may have kept moving while it was missed.
+    """
+    radii = np.maximum(gate_scale * track_boxes[:, 2:].max(axis=1), min_gate)
+    if track_steps is not None:
+        radii = radii * np.maximum(track_steps, 1)
+    return radii
+
+
+def gated_pairs(track_boxes, detection_boxes, gate_scale=1.0, min_gate=20.0, min_iou=0.0,
+                track_classes=None, detection_classes=None, track_steps=None):
+    """Find the (track, detection) pairs that are allowed to be matched.
+
+    A detection is a candidate for a track when its centroid is within
+    `gate_scale * max(w, h)` of the track box (at least `min_gate` pixels, and
+    times `track_steps`, the frames since the track was measured), when their
+    IoU is at least `min_iou`, and, if classes are given, when both have the
+    same class. Only the detections near each track are looked at, through a
+    KD-tree on the detection centroids.
+
+    Returns
+    -------
+    rows, cols: ndarray
+        The track and detection indices of the candidate pairs.
+    costs: ndarray
+        The centroid distance of each pair.
+    """
+    track_centroids = centroids(track_boxes)
+    detection_centroids = centroids(detection_boxes)
+    radii = gate_radii(track_boxes, gate_scale, min_gate, track_steps)
+    neighbours = cKDTree(detection_centroids).query_ball_point(track_centroids, radii)
+
+    counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+    rows = np.repeat(np.arange(len(track_boxes)), counts)
+    cols = np.fromiter((c for n in neighbours for c in n), dtype=np.int64, count=counts.sum())
+
+    keep = np.ones(len(rows), dtype=bool)
+    if min_iou > 0:
+        keep &= pairwise_iou(track_boxes[rows], detection_boxes[cols]) >= min_iou
+    if track_classes is not None and detection_classes is not None:
+        keep &= track_classes[rows] == detection_classes[cols]
+    rows, cols = rows[keep], cols[keep]
+    costs = np.linalg.norm(track_centroids[rows] - detection_centroids[cols], axis=1)
+    return rows, cols, costs
+
+
+def solve_assignment(rows, cols, costs, n_tracks, n_detections):
+    """Optimally match tracks to detections over the candidate pairs only.
+
+    The candidate pairs form a sparse bipartite graph. Every track also gets a
+    private "unmatched" node which costs more than all the candidate pairs
+    together, so that a full matching always exists and the solver first
+    matches as many pairs as possible, then minimizes the total distance.
+
+    Returns
+    -------
+    matches: List[(int, int)]
+        The matched (track index, detection index).
+    """
+    if len(rows) == 0:
+        return []
+    unmatched_cost = costs.sum() + 1.0
+    graph = csr_matrix((np.concatenate([costs + 1e-9, np.full(n_tracks, unmatched_cost)]),
+                        (np.concatenate([rows, np.arange(n_tracks)]),
+                         np.concatenate([cols, n_detections + np.arange(n_tracks)]))),
+                       shape=(n_tracks, n_detections + n_tracks))
+    _, assigned = min_weight_full_bipartite_matching(graph)
+    return [(int(i), int(j)) for i, j in enumerate(assigned) if j < n_detections]
+
+
+def solve_dense(track_boxes, detection_boxes, gate_scale=1.0, min_gate=20.0, min_iou=0.0,
+                track_classes=None, detection_classes=None, track_steps=None):
+    """Same gating and matching as `gated_pairs` + `solve_assignment` on a dense
+    cost matrix, which is faster when there are only a few objects.
+    """
+    track_centroids = centroids(track_boxes)
+    detection_centroids = centroids(detection_boxes)
+    distances = np.linalg.norm(track_centroids[:, None, :] - detection_centroids[None, :, :], axis=2)
+    allowed = distances <= gate_radii(track_boxes, gate_scale, min_gate, track_steps)[:, None]
+    if min_iou > 0:
+        rows, cols = np.indices(distances.shape)
+        allowed &= (pairwise_iou(track_boxes[rows.ravel()], detection_boxes[cols.ravel()]) >= min_iou
+                    ).reshape(distances.shape)
+    if track_classes is not None and detection_classes is not None:
+        allowed &= track_classes[:, None] == detection_classes[None, :]
+    if not allowed.any():
+        return []
+    forbidden = distances[allowed].sum() + 1.0
+    cost = np.where(allowed, distances, forbidden)
+    return [(int(i), int(j)) for i, j in zip(*linear_sum_assignment(cost)) if allowed[i, j]]
+
+
+def associate(track_boxes, detection_boxes, gate_scale=1.0, min_gate=20.0, min_iou=0.0,
+              track_classes=None, detection_classes=None, track_steps=None, dense_limit=4096):
+    """Match tracks to detections, see `gated_pairs` for the gating.
+
+    Small problems (up to `dense_limit` track/detection pairs) are solved on a
+    dense cost matrix, larger ones on the sparse graph of gated pairs.
+
+    Returns
+    -------
+    matches: List[(int, int)]
+        The matched (track index, detection index).
+    unmatched_tracks: List[int]
+        The tracks without a detection.
+    unmatched_detections: List[int]
+        The detections without a track.
+    """
+    n_tracks, n_detections = len(track_boxes), len(detection_boxes)
+    matches = []
+    if n_tracks and n_detections and n_tracks * n_detections <= dense_limit:
+        matches = solve_dense(track_boxes, detection_boxes, gate_scale, min_gate, min_iou,
+                              track_classes, detection_classes, track_steps)
+    elif n_tracks and n_detections:
+        rows, cols, costs = gated_pairs(track_boxes, detection_boxes, gate_scale, min_gate, min_iou,
+                                        track_classes, detection_classes, track_steps)
+        matches = solve_assignment(rows, cols, costs, n_tracks, n_detections)
+    matched_tracks = set(i for i, _ in matches)
+    matched_detections = set(j for _, j in matches)
+    unmatched_tracks = [i for i in range(n_tracks) if i not in matched_tracks]
+    unmatched_detections = [j for j in range(n_detections) if j not in matched_detections]
+    return matches, unmatched_tracks, unmatched_detections
@@ -1,3 +1,5 @@
+import numpy as np
+
 class Detection(object):
     """
     This class represents a bounding box detection in a single image.
@@ -32,3 +34,35 @@ class Detection(object):
     
     def get_confidence(self):
         return self.confidence
+
+
+# Columns of a detection array: one detection per row, the class as an integer id
+X, Y, W, H, AREA, CONFIDENCE, CLASS_ID = range(7)
+N_COLUMNS = 7
+
+def detections_to_array(detections, class_id):
+    """Stack a list of `Detection` into an (N, 7) detection array.
+
+    Parameters
+    ----------
+    detections: List[Detection]
+        The detections to stack
+    class_id: Callable[[str], int]
+        Returns the integer id of a class name
+    """
+    array = np.empty((len(detections), N_COLUMNS), dtype=float)
+    for row, detection in zip(array, detections):
+        row[X:H + 1] = detection.get_bbox()
+        row[AREA] = detection.get_area()
+        row[CONFIDENCE] = detection.get_confidence()
+        row[CLASS_ID] = class_id(detection.get_class())
+    return array
+
+def stack_detections(boxes, areas, confidences, class_ids):
+    """Stack the columns of decoded detections into an (N, 7) detection array."""
+    array = np.empty((len(boxes), N_COLUMNS), dtype=float)
+    array[:, X:H + 1] = boxes
+    array[:, AREA] = areas
+    array[:, CONFIDENCE] = confidences
+    array[:, CLASS_ID] = class_ids
+    return array
@@ -1,4 +1,5 @@
-from scipy.signal import savgol_filter
+import numpy as np
+from modules.tracking_algorithm.smoothing import SavgolWindow
 
 class TrackState:
     """
@@ -27,6 +28,56 @@ class TrackColor:
     Green = (0, 128, 0)
     Red = (0, 0, 255)
 
+# Color codes used by the array-backed track table, indexing TRACK_COLORS
+YELLOW, GREEN, RED = 0, 1, 2
+TRACK_COLORS = (TrackColor.Yellow, TrackColor.Green, TrackColor.Red)
+COLOR_NAMES = ('yellow', 'green', 'red')
+
+def lag_position(winLength):
+    """Position in the area window that the current area is compared with."""
+    if winLength == 21:
+        return winLength//2 - 8
+    return winLength//2 - 4
+
+# (largest area, green ratio, red ratio) of each area band
+"""The color is based on the ratio of the current frame compared to the last frame's area.
+The thresholds are tested based on multiple tests only with Person class.
+"""
+COLOR_THRESHOLDS = ((0.08, 0.992, 1.05), (0.2, 0.985, 1.1), (float('inf'), 0.87, 1.19))
+
+def classify_color(current_area, last_state_area):
+    """Return the color code (YELLOW, GREEN or RED) of a track from its smoothed
+    current and lagged areas.
+    """
+    ratio = current_area / last_state_area
+    for max_area, green, red in COLOR_THRESHOLDS:
+        if current_area <= max_area:
+            break
+    if ratio <= green:
+        return GREEN
+    if ratio >= red:
+        return RED
+    return YELLOW
+
+def classify_colors(current_areas, last_state_areas):
+    """Vectorized `classify_color` over arrays of tracks."""
+    ratios = current_areas / last_state_areas
+    greens = np.select([current_areas <= max_area for max_area, _, _ in COLOR_THRESHOLDS[:-1]],
+                       [green for _, green, _ in COLOR_THRESHOLDS[:-1]], COLOR_THRESHOLDS[-1][1])
+    reds = np.select([current_areas <= max_area for max_area, _, _ in COLOR_THRESHOLDS[:-1]],
+                     [red for _, _, red in COLOR_THRESHOLDS[:-1]], COLOR_THRESHOLDS[-1][2])
+    return np.where(ratios <= greens, GREEN, np.where(ratios >= reds, RED, YELLOW))
+
+def bbox_to_state(bbox):
+    """Convert (x, y, w, h) into (cX, cY, w, h)."""
+    (x, y, w, h) = bbox
+    return [x + w/2.0, y + h/2.0, float(w), float(h)]
+
+def state_to_bbox(state):
+    """Convert (cX, cY, w, h) into an integer (x, y, w, h)."""
+    (cX, cY, w, h) = state
+    return [int(round(cX - w/2.0)), int(round(cY - h/2.0)), int(round(w)), int(round(h))]
+
 class Track:
     """
     A single target track with centroid update.
@@ -45,8 +96,8 @@ class Track:
         Unique track id
     bbox: Tuple(x, y, w, h)
         The coordinates of the track at current frame
-    area: float
-        The area of the track according to the bbox and the frame
+    area: SavgolWindow
+        The last `winLength` areas of the track according to the bbox and the frame
         The formula is: (w*h) / (fheight*fwidth)
     class_name: str
         The class name of the track
@@ -54,6 +105,9 @@ class Track:
         The current state of the track
     color: TrackColor(object)
         The current color of the track
+    velocity: List[float]
+        The per-frame change of (cX, cY, w, h) between the last two measurements,
+        used to propagate the track on frames where the detector does not run
     """
     def __init__(self, track_id, n_init, max_disappeared, bbox, area, winLength, class_name=None):
         self.track_id = track_id
@@ -61,13 +115,20 @@ class Track:
         self.max_disappeared = max_disappeared
         self.bbox = bbox
         self.winLength = winLength
-        self.area = [area] * self.winLength
+        self.area = SavgolWindow(self.winLength, area)
         self.class_name = class_name
 
         self.hits = 1
         self.time_since_update = 0
         self.state = TrackState.Tentative
         self.color = TrackColor.Yellow
+
+        self.measurement = bbox_to_state(bbox)
+        self.position = self.measurement
+        self.velocity = [0.0, 0.0, 0.0, 0.0]
+        self.steps_since_measurement = 0
+        # Converts the bbox pixel area into the normalized area
+        self.area_scale = area / max(bbox[2] * bbox[3], 1)
     
     def get_class(self):
         return self.class_name
@@ -91,56 +152,55 @@ class Track:
         self.bbox = detection.get_bbox()
         self.class_name = detection.get_class()
 
-        if len(self.area) == self.winLength:
-            del self.area[0]
-            self.area.append(new_area)
-        else:
-            self.area = [new_area] * self.winLength
+        # Constant velocity over the frames elapsed since the last measurement
+        measurement = bbox_to_state(self.bbox)
+        steps = self.steps_since_measurement + 1
+        self.velocity = [(new - old) / steps for new, old in zip(measurement, self.measurement)]
+        self.measurement = measurement
+        self.position = measurement
+        self.steps_since_measurement = 0
+        self.area_scale = new_area / max(self.bbox[2] * self.bbox[3], 1)
+
+        self.push_area(new_area)
+
+    def predict(self, offset=None):
+        """Propagate the track by one frame without a detection.
+
+        The box moves with the constant velocity model, or by `offset` (dx, dy)
+        when the centroid motion has been measured by optical flow. Tracks that
+        missed their last detection stay where they are.
+        """
+        self.steps_since_measurement += 1
+        if self.time_since_update > 0:
+            return
+        cX, cY, w, h = self.position
+        vX, vY, vW, vH = self.velocity
+        if offset is not None:
+            vX, vY = offset
+        w, h = max(w + vW, 1.0), max(h + vH, 1.0)
+        self.position = [cX + vX, cY + vY, w, h]
+        self.bbox = state_to_bbox(self.position)
+        self.push_area(w * h * self.area_scale)
+
+    def push_area(self, new_area):
+        """Append an area to the window and update the color"""
+        self.area.push(new_area)
         # Update the color in each track
         self.update_color()
     
     def update_color(self):
         """Perform update the track color to change the status of the bounding box
         """
-        filtered_data = savgol_filter(self.area, self.winLength, 1)
-        if self.winLength == 21:
-            last_state_area = filtered_data[self.winLength//2 - 8]
-        else:
-            last_state_area = filtered_data[self.winLength//2 - 4]
-
-        # Conditional for color update
-        """This conditional update is based on the ratio of the current frame compared to
-        the last frame's area.
-        The conditional is tested based on multiple tests only with Person class.
-        """
-        if filtered_data[-1] <= 0.08:
-            if filtered_data[-1] / last_state_area <= 0.992:
-                self.color = TrackColor.Green
-            elif filtered_data[-1] / last_state_area >= 1.05:
-                self.color = TrackColor.Red
-            else:
-                self.color = TrackColor.Yellow
-        elif 0.08 < filtered_data[-1] <= 0.2:
-            if filtered_data[-1] / last_state_area <= 0.985:
-                self.color = TrackColor.Green
-            elif filtered_data[-1] / last_state_area >= 1.1:
-                self.color = TrackColor.Red
-            else:
-                self.color = TrackColor.Yellow
-        else:
-            if filtered_data[-1] / last_state_area <= 0.87:
-                self.color = TrackColor.Green
-            elif filtered_data[-1] / last_state_area >= 1.19:
-                self.color = TrackColor.Red
-            else:
-                self.color = TrackColor.Yellow
-        # Reassign to the track's area list again
-        self.area = filtered_data.tolist()
+        # Savitzky-Golay (order 1) smoothed area at the newest and at the lagged sample
+        current_area = self.area.smoothed(self.winLength - 1)
+        last_state_area = self.area.smoothed(lag_position(self.winLength))
+        self.color = TRACK_COLORS[classify_color(current_area, last_state_area)]
     
     def mark_missed(self):
         """Mark this track as missed (no association at the current time step).
         """
         self.time_since_update += 1
+        self.steps_since_measurement += 1
         # if self.state == TrackState.Tentative:
         #     self.state = TrackState.Deleted
         if self.time_since_update > self.max_disappeared:
@@ -1,7 +1,10 @@
 from collections import OrderedDict
 import numpy as np
-from scipy.spatial import distance as dist
-from modules.tracking_algorithm.centroid_track import Track
+from modules.tracking_algorithm.association import associate
+from modules.tracking_algorithm.centroid_detection import (X, H, AREA, CLASS_ID, N_COLUMNS,
+                                                           detections_to_array)
+from modules.tracking_algorithm.centroid_track import TrackState
+from modules.tracking_algorithm.track_table import TrackTable
 
 class Tracker:
     """
@@ -18,98 +21,147 @@ class Tracker:
         The number of frames that turns a `Tentative` state track
         into `Confirm` state. Moreover, if a track disappears
         within this n_init frames, it will turn into `Deleted`.
+    gate_scale: float
+        A detection can only match a track if their centroids are within
+        gate_scale * max(w, h) of the track box (and at least min_gate pixels).
+    min_iou: float
+        A detection can only match a track if their IoU is at least this value.
+    class_aware: bool
+        A detection can only match a track of the same class.
+    class_names: List[str]
+        The class names of the class ids in detection arrays. Class names of
+        `Detection` objects that are not in the list are appended to it.
+    table: TrackTable
+        The tracks, as arrays
     """
-    def __init__(self, max_disappeared=30, n_init=3):
+    def __init__(self, max_disappeared=30, n_init=3, gate_scale=1.0, min_gate=20.0, min_iou=0.0,
+                 class_aware=False, class_names=None):
         self.max_disappeared = max_disappeared
         self.n_init = n_init
-        self.tracks = OrderedDict()
+        self.gate_scale = gate_scale
+        self.min_gate = min_gate
+        self.min_iou = min_iou
+        self.class_aware = class_aware
+        self.class_names = list(class_names) if class_names is not None else []
+        self.class_index = {name: i for i, name in enumerate(self.class_names)}
+        self.table = None
         self.next_id = 0
 
-    def register(self, detection, winLength):
-        bbox = detection.get_bbox()
-        class_name = detection.get_class()
-        area = detection.get_area()
-        self.tracks[self.next_id] = Track(self.next_id, self.n_init, self.max_disappeared,
-                                            bbox, area, winLength, class_name)
-        self.next_id += 1
-    
+    @property
+    def tracks(self):
+        """The live tracks as an ordered dict of track id -> TrackView."""
+        if self.table is None:
+            return OrderedDict()
+        return OrderedDict((view.track_id, view) for view in self.table.views(self.class_names))
+
+    def boxes(self):
+        """Return the (x, y, w, h) boxes of the live tracks as an (N, 4) array."""
+        if self.table is None:
+            return np.empty((0, 4), dtype=np.int64)
+        return self.table.bboxes[:len(self.table)].copy()
+
+    def visible(self, max_time_since_update=1):
+        """Return the ids, (x, y, w, h) boxes, color codes and class ids of the confirmed
+        tracks updated within `max_time_since_update` frames, the ones that are drawn.
+        """
+        if self.table is None:
+            return (np.empty(0, dtype=np.int64), np.empty((0, 4), dtype=np.int64),
+                    np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int64))
+        table, n = self.table, len(self.table)
+        rows = np.flatnonzero((table.state[:n] == TrackState.Confirmed) &
+                              (table.time_since_update[:n] <= max_time_since_update))
+        return table.ids[rows], table.bboxes[rows], table.colors[rows], table.class_ids[rows]
+
+    def class_id(self, class_name):
+        if class_name not in self.class_index:
+            self.class_index[class_name] = len(self.class_names)
+            self.class_names.append(class_name)
+        return self.class_index[class_name]
+
+    def as_array(self, detections):
+        """Return the detections as an (N, 7) detection array."""
+        if isinstance(detections, np.ndarray):
+            return detections.reshape(-1, N_COLUMNS)
+        return detections_to_array(detections, self.class_id)
+
+    def get_table(self, winLength):
+        if self.table is None or (len(self.table) == 0 and self.table.winLength != winLength):
+            self.table = TrackTable(winLength, self.n_init, self.max_disappeared)
+        elif self.table.winLength != winLength:
+            raise ValueError('winLength changed from {} to {} with live tracks'.format(
+                self.table.winLength, winLength))
+        return self.table
+
+    def register(self, detections, winLength):
+        """Register new tracks from an (N, 7) detection array."""
+        if len(detections) == 0:
+            return
+        self.get_table(winLength).register(detections[:, X:H + 1].astype(np.int64), detections[:, AREA],
+                                           detections[:, CLASS_ID].astype(np.int64), self.next_id)
+        self.next_id += len(detections)
+
     def deregister(self):
-        for track_id in list(self.tracks.keys()):
-            if self.tracks[track_id].is_deleted():
-                del self.tracks[track_id]
-    
-    def update(self, detections, winLength):
+        self.table.compact()
+
+    def predict(self, offsets=None):
+        """Propagate every track by one frame on frames where the detector does not run.
+        Parameters:
+        ----------
+        offsets: Dict[int, (dx, dy)]
+            Optional measured centroid motion of the tracks, by track id
+        """
+        if self.table is not None:
+            self.table.predict(offsets)
+
+    def update(self, detections, winLength, age=True):
         """Perform measurement updates and track management.
         Parameters:
         ----------
-        detections: List[Detection]
-            A list of detections at the current time step
+        detections: List[Detection] or ndarray
+            The detections at the current time step, as `Detection` objects
+            or as an (N, 7) array with the columns of `centroid_detection`
+        age: bool
+            Whether the tracks without a detection are marked as missed. The
+            detections reused on frames where the detector was skipped do not
+            age the tracks.
         """
+        detections = self.as_array(detections)
+        table = self.get_table(winLength)
+        n_tracks = len(table)
         # If there's no detection found in this frame
         if len(detections) == 0:
-            for track_id in list(self.tracks.keys()):
-                self.tracks[track_id].mark_missed()
+            if age:
+                table.mark_missed(np.arange(n_tracks))
         else:
             """If we are currently not tracking any object, take
             the input centroid and register each of them.
             Usually in the inital phase.
             """
-            if len(self.tracks) == 0:
-                for detection in detections:
-                    self.register(detection, winLength)
+            if n_tracks == 0:
+                self.register(detections, winLength)
             else:
                 """Otherwise, we are currently tracking objects so we need
-                to try to match m-detections into n-trackers by centroid
-                distancing approach.
+                to match m-detections into n-trackers. Only the gated pairs
+                are considered, and the matching minimizes the total centroid
+                distance.
                 """
-                # Init an array of input centroid for the current frame
-                inputcentroids = np.zeros((len(detections), 2), dtype='int')
-                # Loop over the bounding box rectangles
-                for (i, detection) in enumerate(detections):
-                    (x, y, w, h) = detection.get_bbox()
-                    cX = int(x + w/2.0)
-                    cY = int(y + h/2.0)
-                    inputcentroids[i] = (cX, cY)
-                # Grab the set of track IDs and corresponding centroids
-                track_ids = list(self.tracks.keys())
-                trackcentroids = []
-                for track in list(self.tracks.values()):
-                    # Get the centroids of tracks
-                    (x, y, w, h) = track.bbox
-                    cX = int(x + w/2.0)
-                    cY = int(y + h/2.0)
-                    trackcentroids.append((cX, cY))
-                D = dist.cdist(np.array(trackcentroids), inputcentroids)
-                rows = D.min(axis=1).argsort()
-                cols = D.argmin(axis=1)[rows]
-
-                usedRows = set()
-                usedCols = set()
-                # Loop over the combination of the (row, col) index tuples
-                for (row, col) in zip(rows, cols):
-                    # If we have already examined either the row/col value
-                    # Ignore its val
-                    if row in usedRows or col in usedCols:
-                        continue
-                    # Otherwise, grab the track ID and update accordingly
-                    track_id = track_ids[row]
-                    self.tracks[track_id].update(detections[col])
+                detection_boxes = detections[:, X:H + 1]
+                track_classes, detection_classes = None, None
+                if self.class_aware:
+                    track_classes = table.class_ids[:n_tracks]
+                    detection_classes = detections[:, CLASS_ID].astype(np.int64)
+                matches, unmatched_tracks, unmatched_detections = associate(
+                    table.bboxes[:n_tracks].astype(float), detection_boxes, self.gate_scale, self.min_gate,
+                    self.min_iou, track_classes, detection_classes, table.steps[:n_tracks] + 1)
 
-                    usedRows.add(row)
-                    usedCols.add(col)
-                
-                # Compute both row and column indices we have NOT examined
-                unusedRows = set(range(0, D.shape[0])).difference(usedRows)
-                unusedCols = set(range(0, D.shape[1])).difference(usedCols)
-                # if the #obj.centroid >= #input.centroid, check and see
-                # if some of these objects have potentially disappeard
-                if D.shape[0] >= D.shape[1]:
-                    for row in unusedRows:
-                        # Get track ID
-                        track_id = track_ids[row]
-                        self.tracks[track_id].mark_missed()
-                else:
-                    for col in unusedCols:
-                        self.register(detections[col], winLength)
+                if matches:
+                    rows, cols = np.array(matches, dtype=np.int64).T
+                    matched = detections[cols]
+                    table.update(rows, matched[:, X:H + 1].astype(np.int64), matched[:, AREA],
+                                 matched[:, CLASS_ID].astype(np.int64))
+                # Tracks that lost their object and new objects are handled independently
+                if age:
+                    table.mark_missed(np.array(unmatched_tracks, dtype=np.int64))
+                self.register(detections[unmatched_detections], winLength)
         # Deregister tracks
         self.deregister()
@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+
+class OpticalFlowRefiner(object):
+    """
+    Measures the motion of the tracks between two frames with sparse
+    Lucas-Kanade optical flow on corners inside each track's box.
+
+    The flow runs on a downscaled grayscale copy of the frame to keep it cheap.
+
+    Attributes:
+    -----------
+    scale: float
+        The downscale factor applied to the frames before computing the flow.
+    max_corners: int
+        The maximum number of corners followed inside one box.
+    """
+    def __init__(self, scale=0.5, max_corners=20):
+        self.scale = scale
+        self.max_corners = max_corners
+        self.prev_gray = None
+        self.lk_params = dict(winSize=(15, 15), maxLevel=2,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+    def _gray(self, frame):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def observe(self, frame):
+        """Remember the frame as the reference for the next call to `track`."""
+        self.prev_gray = self._gray(frame)
+
+    def track(self, frame, tracks):
+        """Return the (dx, dy) centroid motion of each track from the previous frame to this one.
+
+        Parameters
+        ----------
+        frame: ndarray
+            The current frame.
+        tracks: Dict[int, Track]
+            The tracks, with their boxes still in the previous frame's position.
+        """
+        gray = self._gray(frame)
+        offsets = {}
+        if self.prev_gray is not None:
+            height, width = gray.shape
+            for track_id, track in tracks.items():
+                if track.time_since_update > 0:
+                    continue
+                (x, y, w, h) = [int(v * self.scale) for v in track.bbox]
+                x0, y0 = max(x, 0), max(y, 0)
+                x1, y1 = min(x + w, width), min(y + h, height)
+                if x1 - x0 < 4 or y1 - y0 < 4:
+                    continue
+                corners = cv2.goodFeaturesToTrack(self.prev_gray[y0:y1, x0:x1], self.max_corners, 0.01, 3)
+                if corners is None:
+                    continue
+                corners = corners + np.array([x0, y0], dtype=np.float32)
+                moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, corners, None, **self.lk_params)
+                found = status.reshape(-1) == 1
+                if not found.any():
+                    continue
+                dx, dy = np.median((moved - corners).reshape(-1, 2)[found], axis=0) / self.scale
+                offsets[track_id] = (float(dx), float(dy))
+        self.prev_gray = gray
+        return offsets
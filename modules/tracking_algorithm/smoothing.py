@@ -0,0 +1,63 @@
+import numpy as np
+
+
+def savgol_coefficients(length, polyorder, position):
+    """Return the weights that evaluate the least squares polynomial fit of a
+    window at `position`, as `scipy.signal.savgol_filter` does for a window the
+    size of the data.
+    """
+    t = np.arange(length, dtype=float)
+    vander = np.vander(t, polyorder + 1)
+    return vander[position] @ np.linalg.pinv(vander)
+
+
+_weights = {}  # (length, polyorder, position) -> weights for each head position
+
+def savgol_weights(length, polyorder, position):
+    """Return the (length, length) weights of `savgol_coefficients` rotated for
+    each head position of a ring buffer: row `head` applies to a buffer whose
+    oldest sample is at index `head`.
+    """
+    key = (length, polyorder, position % length)
+    weights = _weights.get(key)
+    if weights is None:
+        coefficients = savgol_coefficients(length, polyorder, key[2])
+        weights = np.stack([np.roll(coefficients, head) for head in range(length)])
+        _weights[key] = weights
+    return weights
+
+
+class SavgolWindow(object):
+    """
+    A sliding window of raw samples with Savitzky-Golay smoothed values.
+
+    The samples are kept in a fixed-size ring buffer, and a smoothed value is
+    one dot product with precomputed weights. The weights are rotated with the
+    ring buffer head, so the buffer never has to be reordered.
+
+    Attributes:
+    -----------
+    length: int
+        The number of samples in the window.
+    polyorder: int
+        The order of the fitted polynomial.
+    """
+    def __init__(self, length, initial, polyorder=1):
+        self.length = length
+        self.polyorder = polyorder
+        self.values = np.full(length, initial, dtype=float)
+        self.head = 0  # index of the oldest sample
+
+    def push(self, value):
+        """Replace the oldest sample with a new one."""
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.length
+
+    def smoothed(self, position):
+        """Return the smoothed value at `position` in the window, 0 being the oldest sample."""
+        weights = savgol_weights(self.length, self.polyorder, position)
+        return float(weights[self.head] @ self.values)
+
+    def raw(self):
+        """Return the samples from the oldest to the newest."""
+        return np.roll(self.values, -self.head)
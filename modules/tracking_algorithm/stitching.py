@@ -0,0 +1,124 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from modules.tracking_algorithm.association import pairwise_iou
+
+# The columns of a track row array, one row per drawn track per frame
+FRAME, TRACK_ID, X, Y, W, H, COLOR, CLASS_ID = range(8)
+N_COLUMNS = 8
+
+
+def track_rows(n_frame, tracker):
+    """Return the drawn tracks of the tracker at frame `n_frame` as (N, 8) track rows."""
+    track_ids, boxes, colors, class_ids = tracker.visible()
+    return np.column_stack([np.full(len(track_ids), n_frame), track_ids, boxes, colors, class_ids]).astype(np.int64)
+
+
+def warmup_frames(winLength, max_disappeared=30, n_init=3):
+    """Return the number of frames a tracker started in the middle of a video needs
+    before its tracks are the ones of a tracker that saw the whole video.
+
+    The color of a track comes from its last `winLength` areas, and a track is
+    confirmed after `n_init` hits. These are measurements, not frames: a track
+    only has to be measured once every `max_disappeared` frames to stay alive.
+    The default covers `winLength + n_init` measurements of such a track, a
+    track measured on most frames needs about `max_disappeared + winLength`.
+    """
+    return (max_disappeared + 1) * (winLength + n_init)
+
+
+def segment_bounds(n_frames, n_segments, overlap):
+    """Split `n_frames` frames into `n_segments` segments.
+
+    Returns
+    -------
+    List[(warmup_start, start, end)]
+        Each segment is processed from `warmup_start`, `overlap` frames before
+        its `start`, and its results are kept in [start, end). The end of the
+        last segment is None, it runs to the end of the video.
+    """
+    n_segments = max(min(n_segments, n_frames), 1)
+    starts = [int(round(i * n_frames / float(n_segments))) for i in range(n_segments)]
+    ends = starts[1:] + [None]
+    return [(max(start - overlap, 0), start, end) for start, end in zip(starts, ends)]
+
+
+def match_tracks(reference, tracks, min_iou=0.5):
+    """Match the track ids of two runs over the same frames.
+
+    Parameters
+    ----------
+    reference, tracks: ndarray (N, 8)
+        Track rows of the two runs, e.g. the end of a segment and the warm-up of the next one.
+    min_iou: float
+        Two tracks agree on a frame when their boxes overlap by this IoU and have the same class.
+
+    Returns
+    -------
+    Dict[int, int]
+        The reference id of each matched id of `tracks`. Ids are matched one to
+        one, maximizing the number of frames on which they agree.
+    """
+    if len(reference) == 0 or len(tracks) == 0:
+        return {}
+    reference_ids, reference_index = np.unique(reference[:, TRACK_ID], return_inverse=True)
+    track_ids, track_index = np.unique(tracks[:, TRACK_ID], return_inverse=True)
+    votes = np.zeros((len(track_ids), len(reference_ids)), dtype=np.int64)
+    for n_frame in np.intersect1d(reference[:, FRAME], tracks[:, FRAME]):
+        a = np.flatnonzero(reference[:, FRAME] == n_frame)
+        b = np.flatnonzero(tracks[:, FRAME] == n_frame)
+        ia, ib = np.repeat(a, len(b)), np.tile(b, len(a))
+        iou = pairwise_iou(reference[ia, X:H + 1].astype(float), tracks[ib, X:H + 1].astype(float))
+        agree = (iou >= min_iou) & (reference[ia, CLASS_ID] == tracks[ib, CLASS_ID])
+        np.add.at(votes, (track_index[ib[agree]], reference_index[ia[agree]]), 1)
+    rows, cols = linear_sum_assignment(votes, maximize=True)
+    return {int(track_ids[r]): int(reference_ids[c]) for r, c in zip(rows, cols) if votes[r, c] > 0}
+
+
+def stitch_segments(segments, min_iou=0.5):
+    """Join the tracks of a video processed as overlapping segments into one run.
+
+    The ids of each segment are mapped to the ids of the segments before it by
+    matching the tracks of both on the overlap frames. The first segment keeps
+    its ids, and the tracks first seen in a later segment get new ids in the
+    order the segment registered them.
+
+    Parameters
+    ----------
+    segments: List[(start, end, tracks)]
+        In frame order. The track rows of each segment start at its warm-up
+        frame, only the rows in [start, end) are kept. `end` may be None.
+
+    Returns
+    -------
+    ndarray (N, 8)
+        The track rows of the whole video.
+    """
+    stitched = []
+    next_id = 0
+    for start, end, tracks in segments:
+        tracks = np.asarray(tracks, dtype=np.int64).reshape(-1, N_COLUMNS)
+        frames = tracks[:, FRAME]
+        own = tracks[(frames >= start) & ((frames < end) if end is not None else True)].copy()
+        local_ids = np.unique(own[:, TRACK_ID])
+        if not stitched:
+            global_ids = local_ids
+        else:
+            warmup = tracks[frames < start]
+            done = np.concatenate(stitched)
+            first = warmup[:, FRAME].min() if len(warmup) else start
+            mapping = match_tracks(done[done[:, FRAME] >= first], warmup, min_iou)
+            global_ids = np.empty_like(local_ids)
+            for i, local_id in enumerate(local_ids.tolist()):
+                if local_id in mapping:
+                    global_ids[i] = mapping[local_id]
+                else:
+                    global_ids[i] = next_id
+                    next_id += 1
+        own[:, TRACK_ID] = global_ids[np.searchsorted(local_ids, own[:, TRACK_ID])]
+        stitched.append(own)
+        if len(global_ids):
+            next_id = max(next_id, int(global_ids.max()) + 1)
+    if not stitched:
+        return np.empty((0, N_COLUMNS), dtype=np.int64)
+    return np.concatenate(stitched)
@@ -0,0 +1,222 @@
+import numpy as np
+from modules.tracking_algorithm.centroid_track import (TrackState, TRACK_COLORS, YELLOW,
+                                                       classify_colors, lag_position)
+from modules.tracking_algorithm.smoothing import savgol_weights
+
+def boxes_to_states(boxes):
+    """Convert an (N, 4) array of (x, y, w, h) into (cX, cY, w, h)."""
+    states = np.array(boxes, dtype=float)
+    states[:, :2] += states[:, 2:] / 2.0
+    return states
+
+def states_to_boxes(states):
+    """Convert an (N, 4) array of (cX, cY, w, h) into integer (x, y, w, h)."""
+    boxes = np.array(states, dtype=float)
+    boxes[:, :2] -= boxes[:, 2:] / 2.0
+    return np.round(boxes).astype(np.int64)
+
+class TrackView(object):
+    """
+    A read-only snapshot of one row of a `TrackTable`, with the attributes
+    and getters of a `Track` that the callers draw and measure with.
+    """
+    __slots__ = ('track_id', 'bbox', 'color', 'hits', 'time_since_update', 'state', 'class_name')
+
+    def __init__(self, track_id, bbox, color, hits, time_since_update, state, class_name):
+        self.track_id = track_id
+        self.bbox = bbox
+        self.color = color
+        self.hits = hits
+        self.time_since_update = time_since_update
+        self.state = state
+        self.class_name = class_name
+
+    def get_class(self):
+        return self.class_name
+
+    def is_tentative(self):
+        return self.state == TrackState.Tentative
+
+    def is_confirmed(self):
+        return self.state == TrackState.Confirmed
+
+    def is_deleted(self):
+        return self.state == TrackState.Deleted
+
+class TrackTable(object):
+    """
+    The tracks of a `Tracker` as a structure of arrays.
+
+    Row i of every array is one track and the rows [0, len(table)) are the live
+    tracks, in registration order, so the ids are increasing. The arrays grow
+    by doubling and deleted tracks are removed by compacting the rows. The
+    lifecycle follows `Track`, applied to many rows at once.
+
+    Attributes:
+    -----------
+    winLength: int
+        The number of areas in the ring buffer of each track
+    ids: ndarray (N,)
+        Unique track ids
+    bboxes: ndarray (N, 4)
+        The integer (x, y, w, h) of the tracks at the current frame
+    measurement, position, velocity: ndarray (N, 4)
+        The last measured, the propagated and the per-frame change of (cX, cY, w, h)
+    steps: ndarray (N,)
+        Frames since the last measurement
+    areas: ndarray (N, winLength)
+        Ring buffers of the normalized areas, `heads` being the oldest sample of each
+    area_scale: ndarray (N,)
+        Converts the bbox pixel area into the normalized area
+    hits, time_since_update, state: ndarray (N,)
+        As in `Track`
+    colors: ndarray (N,)
+        Color codes, indexing `TRACK_COLORS`
+    class_ids: ndarray (N,)
+        Class ids of the tracks
+    """
+    def __init__(self, winLength, n_init, max_disappeared, capacity=64, polyorder=1):
+        self.winLength = winLength
+        self.n_init = n_init
+        self.max_disappeared = max_disappeared
+        self.n = 0
+        self.fields = {
+            'ids': ((), np.int64),
+            'bboxes': ((4,), np.int64),
+            'measurement': ((4,), float),
+            'position': ((4,), float),
+            'velocity': ((4,), float),
+            'steps': ((), np.int64),
+            'areas': ((winLength,), float),
+            'heads': ((), np.int64),
+            'area_scale': ((), float),
+            'hits': ((), np.int64),
+            'time_since_update': ((), np.int64),
+            'state': ((), np.int8),
+            'colors': ((), np.int8),
+            'class_ids': ((), np.int64),
+        }
+        for name, (shape, dtype) in self.fields.items():
+            setattr(self, name, np.zeros((capacity,) + shape, dtype=dtype))
+        # Savitzky-Golay weights of the newest and of the lagged area, by head position
+        self.current_weights = savgol_weights(winLength, polyorder, winLength - 1)
+        self.lag_weights = savgol_weights(winLength, polyorder, lag_position(winLength))
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, capacity):
+        """Grow the arrays, doubling their size, to hold at least `capacity` tracks."""
+        if capacity <= len(self.ids):
+            return
+        capacity = max(capacity, 2 * len(self.ids))
+        for name, (shape, dtype) in self.fields.items():
+            array = np.zeros((capacity,) + shape, dtype=dtype)
+            array[:self.n] = getattr(self, name)[:self.n]
+            setattr(self, name, array)
+
+    def rows_of(self, track_ids):
+        """Return the rows of live track ids."""
+        return np.searchsorted(self.ids[:self.n], track_ids)
+
+    def register(self, boxes, areas, class_ids, first_id):
+        """Append new tentative tracks with the ids first_id, first_id + 1, ..."""
+        k = len(boxes)
+        self.reserve(self.n + k)
+        rows = slice(self.n, self.n + k)
+        boxes = np.asarray(boxes)
+        states = boxes_to_states(boxes)
+        self.ids[rows] = first_id + np.arange(k)
+        self.bboxes[rows] = boxes
+        self.measurement[rows] = states
+        self.position[rows] = states
+        self.velocity[rows] = 0.0
+        self.steps[rows] = 0
+        self.areas[rows] = np.asarray(areas, dtype=float)[:, None]
+        self.heads[rows] = 0
+        self.area_scale[rows] = areas / np.maximum(boxes[:, 2] * boxes[:, 3], 1)
+        self.hits[rows] = 1
+        self.time_since_update[rows] = 0
+        self.state[rows] = TrackState.Tentative
+        self.colors[rows] = YELLOW
+        self.class_ids[rows] = class_ids
+        self.n += k
+
+    def update(self, rows, boxes, areas, class_ids):
+        """Update the tracks at `rows` with their associated detections, see `Track.update`."""
+        self.hits[rows] += 1
+        self.time_since_update[rows] = 0
+        confirm = (self.state[rows] == TrackState.Tentative) & (self.hits[rows] >= self.n_init)
+        self.state[rows[confirm]] = TrackState.Confirmed
+
+        boxes = np.asarray(boxes)
+        self.bboxes[rows] = boxes
+        self.class_ids[rows] = class_ids
+        # Constant velocity over the frames elapsed since the last measurement
+        measurement = boxes_to_states(boxes)
+        self.velocity[rows] = (measurement - self.measurement[rows]) / (self.steps[rows] + 1)[:, None]
+        self.measurement[rows] = measurement
+        self.position[rows] = measurement
+        self.steps[rows] = 0
+        self.area_scale[rows] = areas / np.maximum(boxes[:, 2] * boxes[:, 3], 1)
+        self.push_areas(rows, areas)
+
+    def predict(self, offsets=None):
+        """Propagate every track by one frame without a detection, see `Track.predict`.
+
+        Parameters:
+        ----------
+        offsets: Dict[int, (dx, dy)]
+            Optional measured centroid motion of the tracks, by track id
+        """
+        n = self.n
+        self.steps[:n] += 1
+        velocity = self.velocity[:n].copy()
+        if offsets:
+            rows = self.rows_of(np.fromiter(offsets.keys(), dtype=np.int64, count=len(offsets)))
+            velocity[rows, :2] = list(offsets.values())
+        # Tracks that missed their last detection stay where they are
+        rows = np.flatnonzero(self.time_since_update[:n] == 0)
+        position = self.position[rows] + velocity[rows]
+        position[:, 2:] = np.maximum(position[:, 2:], 1.0)
+        self.position[rows] = position
+        self.bboxes[rows] = states_to_boxes(position)
+        self.push_areas(rows, position[:, 2] * position[:, 3] * self.area_scale[rows])
+
+    def push_areas(self, rows, values):
+        """Append an area to the ring buffer of each track at `rows` and update their colors."""
+        heads = self.heads[rows]
+        self.areas[rows, heads] = values
+        heads = (heads + 1) % self.winLength
+        self.heads[rows] = heads
+        areas = self.areas[rows]
+        current_areas = np.einsum('ij,ij->i', self.current_weights[heads], areas)
+        last_state_areas = np.einsum('ij,ij->i', self.lag_weights[heads], areas)
+        self.colors[rows] = classify_colors(current_areas, last_state_areas)
+
+    def mark_missed(self, rows):
+        """Mark the tracks at `rows` as missed, see `Track.mark_missed`."""
+        self.time_since_update[rows] += 1
+        self.steps[rows] += 1
+        self.state[rows[self.time_since_update[rows] > self.max_disappeared]] = TrackState.Deleted
+
+    def compact(self):
+        """Remove the deleted tracks, keeping the others in order."""
+        keep = self.state[:self.n] != TrackState.Deleted
+        if keep.all():
+            return
+        k = int(keep.sum())
+        for name in self.fields:
+            array = getattr(self, name)
+            array[:k] = array[:self.n][keep]
+        self.n = k
+
+    def views(self, class_names):
+        """Return a `TrackView` of each live track, `class_names` naming the class ids."""
+        n = self.n
+        return [TrackView(track_id, bbox, TRACK_COLORS[color], hits, time_since_update, state,
+                          class_names[class_id])
+                for track_id, bbox, color, hits, time_since_update, state, class_id in zip(
+                    self.ids[:n].tolist(), self.bboxes[:n].tolist(), self.colors[:n].tolist(),
+                    self.hits[:n].tolist(), self.time_since_update[:n].tolist(),
+                    self.state[:n].tolist(), self.class_ids[:n].tolist())]
@@ -1,9 +1,44 @@
+import time
 import cv2
 import numpy as np
 
 from modules.dummy_AI import SmartAssistModule as BaseModule
 from modules.tracking_algorithm.centroid_tracker import Tracker
-from modules.tracking_algorithm.centroid_detection import Detection
+from modules.tracking_algorithm.centroid_track import TRACK_COLORS, COLOR_NAMES
+from modules.tracking_algorithm.centroid_detection import X, H, AREA, CONFIDENCE, CLASS_ID, stack_detections
+from modules.tracking_algorithm.motion import OpticalFlowRefiner
+from modules.inference.decode import decode_outputs, nms_boxes
+from modules.inference.scheduler import KeyframeScheduler
+from modules.inference.motion_gate import MotionGate, SKIP, REGION, FULL
+from modules.inference.batching import split_batch_outputs
+from modules.inference.tiling import TiledInference, decode_regions, merge_seams
+from modules.inference.model_cache import models, read_class_names
+from modules.inference.backends import BackendConfig
+from modules.inference.metrics import NULL_METRICS
+from modules.inference.preprocess import BlobBuffer, box_transform, INPUT_SIZE
+from modules.inference.detection_cache import DetectionCache
+
+# A candidate box is kept when its best class score is above it
+CONFIDENCE_THRESHOLD = 0.5
+
+def yolo_files(isTiny):
+    """Return the weights and config paths of yolov3 or yolov3-tiny."""
+    if isTiny:
+        return "./yolo-coco/yolov3-tiny.weights", "./yolo-coco/yolov3-tiny.cfg"
+    return "./yolo-coco/yolov3.weights", "./yolo-coco/yolov3.cfg"
+
+def model_files(isTiny, backend=None):
+    """Return the (weights, cfg) paths of the network run by the backend.
+    With the 'onnx' backend, the network is the ONNX export given in the `BackendConfig`.
+    """
+    backend = backend or BackendConfig()
+    if backend.name == 'onnx':
+        return backend.onnx_model, None
+    return yolo_files(isTiny)
+
+def load_model(isTiny, backend=None):
+    """Return the process-wide cached yolo network, see `ModelCache`."""
+    return models.get(*model_files(isTiny, backend), backend or BackendConfig())
 
 class SmartAssistModule(BaseModule):
     """
@@ -14,102 +49,283 @@ class SmartAssistModule(BaseModule):
     `Green` bounding box indicates that the object is moving away from the camera view.
     `Red` bounding box indicates that the object is moving closer/forward to the camera view.
     `Yellow` bounding box indicates that the object is staying as respected to the camera view.
+    When an `inference` service is given, the network is shared with the other streams
+    and the frames are batched into a single forward pass.
+    With a `keyframe_interval` above 1 or a `latency_budget` (ms per frame), the detector
+    only runs on keyframes and the tracks are propagated by their constant velocity
+    (or by optical flow with `optical_flow`) on the frames in between.
+    With a `motion_threshold` (fraction of changed pixels), the detector is skipped on
+    frames where the scene did not change, or only runs on the changed region.
+    With a `tile_size` (frame pixels), the detector runs on overlapping tiles of the
+    frame (or of the `rois`) and the whole frame in one batch, see `TiledInference`.
+    The network runs on the `backend` (a `BackendConfig`), OpenCV DNN on the CPU by default.
+    With `letterbox`, the frames keep their aspect ratio in the network input instead of
+    being stretched, and the boxes are mapped back accordingly.
+    With a `cache_dir`, the detections of the frames of a video file (see `set_source`) are
+    cached on disk, at most `cache_mb` MB, and replaying the file skips the network.
+    The time spent in each stage is recorded into `metrics` (a `StreamMetrics`), if given.
     """
-    def __init__(self, labels, isTiny):
+    def __init__(self, labels, isTiny, inference=None, keyframe_interval=1, latency_budget=None,
+                 optical_flow=False, motion_threshold=None, tile_size=None, tile_overlap=0.2, rois=None,
+                 active_tiles=False, backend=None, metrics=None, letterbox=False, cache_dir=None, cache_mb=1024):
         super().__init__()
+        self.metrics = metrics or NULL_METRICS
         self.labels = labels
-        if isTiny:
-            yolo_weight = "./yolo-coco/yolov3-tiny.weights"
-            yolo_cfg = "./yolo-coco/yolov3-tiny.cfg"
-        else:
-            yolo_weight = "./yolo-coco/yolov3.weights"
-            yolo_cfg = "./yolo-coco/yolov3.cfg"
-        self.net = cv2.dnn.readNet(yolo_weight, yolo_cfg)
-        self.classes = []
-        with open("./yolo-coco/coco.names", "r") as f:
-            self.classes = [line.strip() for line in f.readlines()]
-            layer_names = self.net.getLayerNames()
+        self.inference = inference
+        self.isTiny = isTiny
+        self.backend = backend or BackendConfig()
+        self.letterbox = letterbox
+        # Reused for every frame, the blob is only read by the forward pass
+        self.blobs = BlobBuffer(letterbox=letterbox)
+        if inference is None:
+            # Shared with the other cameras, the forward passes hold the model lock
+            self.model = load_model(isTiny, backend)
+        self.classes = list(read_class_names("./yolo-coco/coco.names"))
         if not self.labels:
             self.labels = self.classes
-        self.output_layers = [layer_names[i - 1] for i in self.net.getUnconnectedOutLayers()]
+            self.label_ids = None
+        else:
+            # Filter by class index before NMS instead of by name after it
+            self.label_ids = np.array([i for i, name in enumerate(self.classes) if name in self.labels])
         self.colors = np.random.uniform(0, 255, size=(len(self.classes), 3))
-        self.confidence_threshold = 0.5
+        self.confidence_threshold = CONFIDENCE_THRESHOLD
+        self.nms_threshold = 0.3
         # Init a modules for this
-        self.tracker = Tracker()
+        self.tracker = Tracker(class_names=self.classes)
+        self.scheduler = KeyframeScheduler(keyframe_interval, latency_budget)
+        self.flow = OpticalFlowRefiner() if optical_flow else None
+        self.gate = MotionGate(motion_threshold) if motion_threshold is not None else None
+        self.tiler = None
+        if tile_size is not None:
+            self.tiler = TiledInference(tile_size, tile_overlap, rois, active_only=active_tiles)
+        self.last_result = ([], False)
+        self.last_detections = np.empty((0, 7))
+        self.frame_detected = False
+        self.cache = DetectionCache.shared(cache_dir, cache_mb * 1024 * 1024) if cache_dir else None
+        self.replay = None  # the cache entry of the video file, see set_source
+        self.source_frame = -1  # index of the analysed frame in the video file
+
+    def set_source(self, path, first_frame=0):
+        """Tell the module that the frames are those of the video file `path`, in order
+        from `first_frame`, so that their detections are cached.
+        """
+        if self.cache is None:
+            return
+        model_paths = model_files(self.isTiny, self.backend)
+        config = {'input_size': INPUT_SIZE, 'letterbox': self.letterbox,
+                  'confidence_threshold': self.confidence_threshold,
+                  'backend': [self.backend.name, self.backend.target, self.backend.precision]}
+        self.replay = self.cache.entry(path, model_paths, config)
+        self.source_frame = first_frame - 1
+
+    def close(self):
+        """Write the detections cached meanwhile."""
+        if self.replay is not None:
+            self.replay.close()
+            print('Detection cache: {} frames replayed, {} detected'.format(self.replay.hits, self.replay.misses))
+            self.replay = None
 
     def load_image(self, frame):
         self.frame = frame
         height, width, channels = self.frame.shape
         return height, width, channels
 
-    def detect_object(self):
-        blob = cv2.dnn.blobFromImage(self.frame, scalefactor=1/255.0, size=(416, 416),
-                                    mean=(0, 0, 0), swapRB=True, crop=False)
-        self.net.setInput(blob)
-        outs = self.net.forward(self.output_layers)
-        return outs
+    def detect_object(self, image=None):
+        image = self.frame if image is None else image
+        if self.inference is not None:
+            # The blob is made by the service, the wait for the batch counts as forward time
+            with self.metrics.time('forward'):
+                return self.inference.infer(image, id(self))
+        with self.metrics.time('blob'):
+            blob = self.blobs.prepare([image])
+        with self.metrics.time('forward'):
+            return self.model.forward(blob)
+
+    def detect_images(self, images):
+        """Run the network on several images in one batch and return the output layers of each."""
+        if not images:
+            # The network can't run on an empty batch
+            return []
+        if self.inference is not None:
+            with self.metrics.time('forward'):
+                return self.inference.infer_many(images, id(self))
+        with self.metrics.time('blob'):
+            blob = self.blobs.prepare(images)
+        with self.metrics.time('forward'):
+            outs = self.model.forward(blob)
+        return split_batch_outputs(outs, len(images))
+
+    def detect_tiles(self, regions, height, width):
+        """Detect in the (x, y, w, h) regions of the frame and merge the detections in frame coordinates."""
+        if not regions:
+            # e.g. no known object in the active tiles of the regions of interest
+            return stack_detections(np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0))
+        outs = self.detect_images([self.frame[y:y + h, x:x + w] for x, y, w, h in regions])
+        with self.metrics.time('decode'):
+            boxes, areas, confidences, class_ids = decode_regions(outs, regions, height, width,
+                                                                  self.confidence_threshold, self.label_ids,
+                                                                  self.letterbox)
+        # Duplicates from overlapping crops, then objects cut by the tile seams
+        with self.metrics.time('nms'):
+            indices = nms_boxes(boxes, confidences, class_ids, self.confidence_threshold, self.nms_threshold)
+            merged = merge_seams(boxes[indices], areas[indices], confidences[indices], class_ids[indices],
+                                 height, width)
+        return stack_detections(*merged)
+
+    def detect_frame(self, height, width):
+        """Detect in the whole frame, tiled or as a single network input."""
+        if self.tiler is None:
+            if self.replay is not None:
+                return self.suppress(*self.replayed_candidates(height, width))
+            return self.get_boxes_dimension(self.detect_object(), height, width)
+        # The tiles holding the last detections or a track, for `active_tiles`
+        active_boxes = np.concatenate([self.last_detections[:, X:H + 1], self.tracker.boxes()])
+        return self.detect_tiles(self.tiler.regions(height, width, active_boxes=active_boxes), height, width)
+
+    def replayed_candidates(self, height, width):
+        """Return the candidate boxes of the frame from the detection cache, or run the
+        network and cache them. They are cached for every class, then filtered.
+        """
+        candidates = self.replay.get(self.source_frame)
+        if candidates is None:
+            outs = self.detect_object()
+            with self.metrics.time('decode'):
+                transform = box_transform(height, width, letterbox=True) if self.letterbox else None
+                candidates = decode_outputs(outs, height, width, self.confidence_threshold, None, transform)
+            self.replay.put(self.source_frame, candidates)
+        if self.label_ids is None:
+            return candidates
+        keep = np.isin(candidates[3], self.label_ids)
+        return tuple(column[keep] for column in candidates)
 
     def get_boxes_dimension(self, outs, height, width):
-        detections = []
-        boxes, areas, class_ids, confidences = [], [], [], []
-
-        for out in outs:
-            for detection in out:
-                scores = detection[5:]
-                class_id = np.argmax(scores)
-                confidence = scores[class_id]
-                if confidence > self.confidence_threshold:
-                    # Object detected
-                    center_x = int(detection[0] * width)
-                    center_y = int(detection[1] * height)
-                    w = int(detection[2] * width)
-                    h = int(detection[3] * height)
-                    # Rectangle coordinates
-                    x = int(center_x - w / 2)
-                    y = int(center_y - h / 2)
-                    boxes.append([x, y, w, h])
-                    confidences.append(float(confidence))
-                    class_ids.append(class_id)
-                    areas.append(detection[2] * detection[3])
-        # Apple non-maximum suppresion to get good bounding boxes
-        indices = cv2.dnn.NMSBoxes(boxes, confidences, self.confidence_threshold, 0.3)
-        # Append necessary attributes into Detection class
-        for i in range(len(boxes)):
-            if i in indices:
-                class_name = str(self.classes[class_ids[i]])
-                if class_name in self.labels:
-                    detections.append(Detection(boxes[i], areas[i], confidences[i], class_name))
-        return detections
+        with self.metrics.time('decode'):
+            transform = box_transform(height, width, letterbox=True) if self.letterbox else None
+            candidates = decode_outputs(outs, height, width, self.confidence_threshold, self.label_ids, transform)
+        return self.suppress(*candidates)
 
-    def draw_labels(self, detections, safety, winLength):
-        if safety:
-            self.tracker.update(detections, winLength)
-            for track in list(self.tracker.tracks.values()):
-                if not track.is_confirmed() or track.time_since_update > 1:
-                    continue
-                (x, y, w, h) = track.bbox
-                class_name = track.get_class()
-                color = track.color
-                cv2.rectangle(self.frame, (x, y), (x + w, y + h), color, 2)
-                cv2.putText(self.frame, class_name, (x, y-5), self.font, 1, color, 2)
+    def suppress(self, boxes, areas, confidences, class_ids):
+        """Return the detection array of the candidate boxes left by NMS."""
+        # Apply class-aware non-maximum suppresion to get good bounding boxes
+        with self.metrics.time('nms'):
+            indices = nms_boxes(boxes, confidences, class_ids, self.confidence_threshold, self.nms_threshold)
+        # One (x, y, w, h, area, confidence, class id) row per detection
+        return stack_detections(boxes[indices], areas[indices], confidences[indices], class_ids[indices])
+
+    def detect_region(self, region, height, width):
+        """Run the detector on the (x, y, w, h) region of the frame only. The last
+        detections centered inside the region are replaced by the new ones.
+        """
+        x, y, w, h = region
+        if self.tiler is not None:
+            detections = self.detect_tiles(self.tiler.regions(height, width, area=region), height, width)
         else:
-            for detection in detections:
-                (x, y, w, h) = detection.get_bbox()
-                confidence = detection.get_confidence()
-                color = self.colors[self.classes.index(detection.get_class())]
-                cv2.rectangle(self.frame, (x, y), (x + w, y + h), color, 2)
-                cv2.putText(self.frame, detection.get_class() + ": " + str(round(confidence, 2)), (x, y - 5),
-                            self.font, 1, (255, 255, 255), 2)
+            detections = self.get_boxes_dimension(self.detect_object(self.frame[y:y + h, x:x + w]), h, w)
+            detections[:, X] += x
+            detections[:, X + 1] += y
+            detections[:, AREA] *= (w * h) / float(width * height)
+        last = self.last_detections
+        centers = last[:, X:X + 2] + last[:, X + 2:H + 1] / 2.0
+        outside = ((centers[:, 0] < x) | (centers[:, 0] >= x + w) |
+                   (centers[:, 1] < y) | (centers[:, 1] >= y + h))
+        return np.concatenate([last[outside], detections])
 
-    def img_detect(self, frame, safety, winLength):
+    def get_overlays(self, detections, safety, winLength):
+        """Update the tracker and return the (bbox, text, box color, text color) to draw for this frame."""
+        if safety:
+            with self.metrics.time('track'):
+                self.tracker.update(detections, winLength)
+            return self.track_overlays()
+        overlays = []
+        for bbox, confidence, class_id in zip(detections[:, X:H + 1].astype(int).tolist(),
+                                              detections[:, CONFIDENCE].tolist(),
+                                              detections[:, CLASS_ID].astype(int).tolist()):
+            overlays.append((bbox, self.classes[class_id] + ": " + str(round(confidence, 2)),
+                             self.colors[class_id], (255, 255, 255)))
+        return overlays
+
+    def track_overlays(self):
+        _, boxes, colors, class_ids = self.tracker.visible()
+        return [(bbox, self.tracker.class_names[class_id], TRACK_COLORS[color], TRACK_COLORS[color])
+                for bbox, color, class_id in zip(boxes.tolist(), colors.tolist(), class_ids.tolist())]
+
+    def draw_overlays(self, frame, overlays):
+        for (x, y, w, h), text, color, text_color in overlays:
+            cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+            cv2.putText(frame, text, (x, y - 5), self.font, 1, text_color, 2)
+
+    def draw_labels(self, detections, safety, winLength):
+        self.draw_overlays(self.frame, self.get_overlays(detections, safety, winLength))
+
+    def analyse(self, frame, safety, winLength):
+        """Detect and track the objects in the frame without drawing on it.
+        Returns the overlays to draw and whether anything was detected.
+        """
         height, width, _ = self.load_image(frame)
-        outs = self.detect_object()
-        detections = self.get_boxes_dimension(outs, height, width)
-        if len(detections) == 0:
-            write = False
-        else:
-            write = True
-        self.draw_labels(detections, safety, winLength)
-        if height > self.frame_size[1] and width > self.frame_size[0]:
-            self.frame = cv2.resize(self.frame, self.frame_size)
+        self.source_frame += 1
+        start = time.time()
+        mode, region = (FULL, None) if self.scheduler.should_detect() else (None, None)
+        if mode is not None and self.gate is not None:
+            mode, region = self.gate.check(frame)
+        detected = mode in (FULL, REGION)
+        self.frame_detected = detected
+        if detected:
+            if mode == REGION:
+                detections = self.detect_region(region, height, width)
+            else:
+                detections = self.detect_frame(height, width)
+            self.last_detections = detections
+            if self.flow is not None:
+                self.flow.observe(frame)
+            self.last_result = (self.get_overlays(detections, safety, winLength), len(detections) > 0)
+        elif mode is None and safety:
+            # Between keyframes: move the tracks instead of detecting them
+            with self.metrics.time('track'):
+                offsets = None
+                if self.flow is not None:
+                    offsets = self.flow.track(frame, self.tracker.tracks)
+                self.tracker.predict(offsets)
+            self.last_result = (self.track_overlays(), self.last_result[1])
+        elif mode == SKIP and safety:
+            # The scene did not change: the last detections are observed again,
+            # without aging the tracks that they miss
+            with self.metrics.time('track'):
+                self.tracker.update(self.last_detections, winLength, age=False)
+            self.last_result = (self.track_overlays(), self.last_result[1])
+        # Without the safety assist there are no tracks, the last detections are drawn again.
+        self.scheduler.record(detected, (time.time() - start) * 1000)
+        if self.scheduler.is_enabled() and self.scheduler.n_frames % 120 == 0:
+            print("Detector duty cycle: {:.0%}, interval: {} frames".format(
+                self.scheduler.duty_cycle(), self.scheduler.current_interval()))
+        if self.gate is not None and self.gate.n_frames and self.gate.n_frames % 120 == 0 and mode is not None:
+            stats = self.gate.stats()
+            print("Motion gate: {:.0%} of the frames skipped, {} region and {} full detections".format(
+                stats['skip_ratio'], stats['regions'], stats['full']))
+        return self.last_result
+
+    def metadata(self):
+        """Return the results of the last analysed frame as JSON values: the detections,
+        when the detector ran on this frame, and the confirmed tracks that are drawn.
+        """
+        detections = self.last_detections if self.frame_detected else self.last_detections[:0]
+        track_ids, boxes, colors, class_ids = self.tracker.visible()
+        return {
+            'detected': self.frame_detected,
+            'detections': [{'class': self.classes[class_id], 'class_id': class_id, 'bbox': bbox,
+                            'confidence': round(confidence, 4)}
+                           for bbox, confidence, class_id in zip(detections[:, X:H + 1].astype(int).tolist(),
+                                                                 detections[:, CONFIDENCE].tolist(),
+                                                                 detections[:, CLASS_ID].astype(int).tolist())],
+            'tracks': [{'id': track_id, 'class': self.tracker.class_names[class_id], 'class_id': class_id,
+                        'bbox': bbox, 'color': COLOR_NAMES[color], 'state': 'confirmed'}
+                       for track_id, bbox, color, class_id in zip(track_ids.tolist(), boxes.tolist(),
+                                                                  colors.tolist(), class_ids.tolist())]}
+
+    def render(self, frame, overlays):
+        self.draw_overlays(frame, overlays)
+        return super().render(frame, overlays)
+
+    def img_detect(self, frame, safety, winLength):
+        overlays, write = self.analyse(frame, safety, winLength)
+        self.frame = self.render(self.frame, overlays)
         return self.frame, write
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+
+
+class StageQueue(object):
+    """A bounded FIFO queue between two pipeline stages.
+
+    When the queue is full, `put` either blocks until the next stage takes an
+    item (`drop_oldest=False`, used for files so that no frame is lost) or
+    discards the oldest item (`drop_oldest=True`, used for live sources so that
+    the pipeline never falls behind the camera).
+    """
+    def __init__(self, name, maxsize, drop_oldest=False):
+        self.name = name
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """Add an item, returns False if the queue has been closed."""
+        with self.condition:
+            while len(self.items) >= self.maxsize and not self.closed:
+                if self.drop_oldest:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.condition.wait()
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """Take the oldest item, returns None once the queue is closed and empty."""
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self, discard=False):
+        """No more items will be put. The remaining items can still be taken unless discarded."""
+        with self.condition:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.condition.notify_all()
+
+    def depth(self):
+        return len(self.items)
+
+
+class Pipeline(object):
+    """
+    A chain of stages each running on its own worker thread.
+
+    Every stage reads from one queue and writes to the next, so the throughput
+    is bounded by the slowest stage instead of the sum of all stages. Each stage
+    has a single worker and the queues are FIFO, so the frames keep their order.
+
+    A stage is `fn(item, emit)` where `emit(queue_name, item)` forwards an item
+    to a named queue. The first stage is a source `fn(emit)` that produces items
+    until it returns.
+
+    With `account`, the CPU time each stage spends on its items is passed to
+    `account(seconds)`, e.g. to charge the stream for it.
+    """
+    def __init__(self, account=None):
+        self.queues = {}
+        self.threads = []
+        self.error = None
+        self.account = account
+
+    def add_queue(self, name, maxsize, drop_oldest=False):
+        self.queues[name] = StageQueue(name, maxsize, drop_oldest)
+        return self.queues[name]
+
+    def emit(self, name, item):
+        return self.queues[name].put(item)
+
+    def add_source(self, name, fn, outputs):
+        if self.account is None:
+            self._start(name, lambda: fn(self.emit), outputs)
+            return
+
+        def run():
+            # The source runs until it returns, its time is accounted at each item
+            cpu = [time.thread_time()]
+
+            def emit(name, item):
+                self.account(time.thread_time() - cpu[0])
+                emitted = self.emit(name, item)
+                cpu[0] = time.thread_time()
+                return emitted
+            fn(emit)
+        self._start(name, run, outputs)
+
+    def add_stage(self, name, fn, input, outputs):
+        def run():
+            while True:
+                item = self.queues[input].get()
+                if item is None:
+                    break
+                if self.account is None:
+                    fn(item, self.emit)
+                    continue
+                cpu = time.thread_time()
+                fn(item, self.emit)
+                self.account(time.thread_time() - cpu)
+        self._start(name, run, outputs)
+
+    def _start(self, name, run, outputs):
+        def worker():
+            try:
+                run()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+                self.stop()
+            finally:
+                # Let the next stages drain what is left and finish
+                for output in outputs:
+                    self.queues[output].close()
+        thread = threading.Thread(target=worker, name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def stop(self):
+        """Abort every stage, dropping the frames still in flight."""
+        for queue in self.queues.values():
+            queue.close(discard=True)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def depths(self):
+        """Return the current depth, capacity and dropped count of each queue."""
+        return {name: {'depth': queue.depth(), 'maxsize': queue.maxsize, 'dropped': queue.dropped}
+                for name, queue in self.queues.items()}
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from pipeline import StageQueue
+from modules.inference.metrics import NULL_METRICS
+
+
+class EventRecorder(object):
+    """
+    Records the frames around detections into rotated clip files on its own thread.
+
+    The camera hands every frame over as the JPEG it already encoded for the
+    stream, so `write` never blocks: a frame is queued, and if the recorder is
+    behind (e.g. a slow disk) the oldest queued frame is dropped and counted.
+    The recorder thread keeps the last `pre_roll` seconds of frames in memory,
+    as JPEG bytes and at most `max_pre_roll_bytes`, so that a clip starts before
+    the event that triggered it. A clip goes on until `post_roll` seconds pass
+    without a detection, and is split into files of at most `segment_length`
+    seconds named `<output>_<start time>_<n>.<ext>`.
+
+    Attributes:
+    -----------
+    fps: float
+        The frame rate of the source, which the clips are written at.
+    dropped: int
+        The frames dropped because the recorder was behind.
+    """
+    def __init__(self, output, fps=20.0, pre_roll=5.0, post_roll=2.0, segment_length=60.0,
+                 max_pre_roll_bytes=32 * 1024 * 1024, queue_seconds=2.0, metrics=None):
+        self.output = output
+        self.fps = fps
+        self.pre_roll_frames = max(int(round(pre_roll * fps)), 0)
+        self.post_roll_frames = max(int(round(post_roll * fps)), 1)
+        self.segment_frames = max(int(round(segment_length * fps)), 1)
+        self.max_pre_roll_bytes = max_pre_roll_bytes
+        self.metrics = metrics or NULL_METRICS
+        self.queue = StageQueue('record', max(int(queue_seconds * fps), 1), drop_oldest=True)
+
+        self.pre_roll = deque()
+        self.pre_roll_bytes = 0
+        self.writer = None
+        self.frames_in_segment = 0
+        self.since_detection = 0
+        self.segment_count = 0
+        self.event_start = None
+        self.segments = []
+        self.n_events = 0
+        self.n_written = 0
+        self.thread = threading.Thread(target=self._thread, name='recorder', daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def write(self, jpeg, detected):
+        """Queue a frame (JPEG bytes) and whether anything was detected on it, without blocking."""
+        self.queue.put((time.time(), jpeg, detected))
+
+    def release(self):
+        """Write the frames still queued, close the current clip and stop the thread."""
+        self.queue.close()
+        self.thread.join()
+
+    def stats(self):
+        return {'events': self.n_events, 'segments': len(self.segments), 'written': self.n_written,
+                'dropped': self.dropped, 'queued': self.queue.depth(), 'pre_roll_frames': len(self.pre_roll),
+                'pre_roll_bytes': self.pre_roll_bytes}
+
+    def _thread(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self._record(*item)
+        finally:
+            self._close_segment()
+
+    def _record(self, timestamp, jpeg, detected):
+        if self.writer is None:
+            if not detected:
+                self._remember(jpeg)
+                return
+            # A new event: the clip starts with the pre-roll
+            self.n_events += 1
+            self.event_start = timestamp
+            self.since_detection = 0
+            for buffered in self.pre_roll:
+                self._write_frame(buffered)
+            self.pre_roll.clear()
+            self.pre_roll_bytes = 0
+        self._write_frame(jpeg)
+        self.since_detection = 0 if detected else self.since_detection + 1
+        if self.since_detection >= self.post_roll_frames:
+            self._close_segment()
+
+    def _remember(self, jpeg):
+        self.pre_roll.append(jpeg)
+        self.pre_roll_bytes += len(jpeg)
+        while self.pre_roll and (len(self.pre_roll) > self.pre_roll_frames or
+                                 self.pre_roll_bytes > self.max_pre_roll_bytes):
+            self.pre_roll_bytes -= len(self.pre_roll.popleft())
+
+    def _write_frame(self, jpeg):
+        with self.metrics.time('write'):
+            frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                return
+            if self.writer is not None and self.frames_in_segment >= self.segment_frames:
+                # Rotate, the event goes on in the next file
+                self.writer.release()
+                self.writer = None
+            if self.writer is None:
+                self._open_segment(frame.shape[1], frame.shape[0])
+            self.writer.write(frame)
+            self.frames_in_segment += 1
+            self.n_written += 1
+
+    def segment_path(self):
+        root, ext = os.path.splitext(self.output)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.event_start))
+        return '{}_{}_{:03d}{}'.format(root, stamp, self.segment_count, ext or '.mp4')
+
+    def _open_segment(self, width, height):
+        path = self.segment_path()
+        self.segment_count += 1
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.writer = cv2.VideoWriter(path, fourcc, self.fps, (width, height))
+        self.frames_in_segment = 0
+        self.segments.append(path)
+
+    def _close_segment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
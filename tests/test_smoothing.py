@@ -0,0 +1,53 @@
+"""The streaming area smoothing of `Track.update_color` against `scipy.signal.savgol_filter`.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+from scipy.signal import savgol_filter
+
+from benchmarks.bench_smoothing import area_sequence
+from modules.tracking_algorithm.centroid_detection import Detection
+from modules.tracking_algorithm.centroid_track import Track, TrackColor
+
+
+def reference_color(window, winLength):
+    """The color rule of Track.update_color computed with savgol_filter on the raw window."""
+    filtered_data = savgol_filter(window, winLength, 1)
+    if winLength == 21:
+        last_state_area = filtered_data[winLength//2 - 8]
+    else:
+        last_state_area = filtered_data[winLength//2 - 4]
+    ratio = filtered_data[-1] / last_state_area
+    if filtered_data[-1] <= 0.08:
+        low, high = 0.992, 1.05
+    elif filtered_data[-1] <= 0.2:
+        low, high = 0.985, 1.1
+    else:
+        low, high = 0.87, 1.19
+    if ratio <= low:
+        return TrackColor.Green
+    if ratio >= high:
+        return TrackColor.Red
+    return TrackColor.Yellow
+
+
+@pytest.mark.parametrize('winLength', [11, 21])
+def test_colors_match_savgol_filter(winLength):
+    rng = np.random.default_rng(winLength)
+    mismatches, colors = [], set()
+    for n_track in range(20):
+        areas = area_sequence(301, rng)
+        track = Track(0, 3, 30, [0, 0, 10, 10], areas[0], winLength, 'person')
+        window = [areas[0]] * winLength
+        for n_update, area in enumerate(areas[1:]):
+            track.update(Detection([0, 0, 10, 10], area, 0.9, 'person'))
+            window = window[1:] + [area]
+            expected = reference_color(window, winLength)
+            if track.color != expected:
+                mismatches.append((n_track, n_update, track.color, expected))
+            colors.add(expected)
+    assert mismatches == []
+    # The sequences move every way, so every branch of the color rule is checked
+    assert colors == {TrackColor.Green, TrackColor.Red, TrackColor.Yellow}
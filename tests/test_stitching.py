@@ -0,0 +1,28 @@
+"""Stitched segment tracks against the tracks of a sequential run, on a synthetic clip.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from benchmarks.verify_stitching import WIN_LENGTH, compare, make_clip, run_tracker
+from modules.tracking_algorithm.centroid_tracker import Tracker
+from modules.tracking_algorithm.stitching import segment_bounds, stitch_segments, warmup_frames
+
+
+@pytest.mark.parametrize('n_segments', [2, 4])
+def test_stitched_tracks_match_sequential(n_segments):
+    frames = make_clip(3000, np.random.default_rng(0))
+    tracker = Tracker()
+    overlap = warmup_frames(WIN_LENGTH, tracker.max_disappeared, tracker.n_init)
+    bounds = segment_bounds(len(frames), n_segments, overlap)
+    # The later segments start cold, after the first frame of the clip
+    assert all(warmup_start > 0 for warmup_start, _, _ in bounds[1:])
+    sequential = run_tracker(frames)
+    segments = [(first, end, run_tracker(frames[warmup_start:end], warmup_start))
+                for warmup_start, first, end in bounds]
+    mismatched, n_frames, one_to_one = compare(sequential, stitch_segments(segments))
+    assert n_frames > 0
+    assert mismatched == 0
+    assert one_to_one